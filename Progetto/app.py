@@ -1,32 +1,144 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify, Response, g
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import hashlib
+import threading
+import time
+from functools import wraps
 from datetime import datetime, timezone, timedelta
 
 def get_local_time():
     """Restituisce l'ora locale italiana (UTC+1)"""
     return datetime.now(timezone.utc) + timedelta(hours=1)
-from models import db, User, VMRequest
+from sqlalchemy import func, or_, and_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
+from models import db, User, VMRequest, ProvisioningJob
 from proxmox_api import ProxmoxAPI
+from provisioning import ProvisioningQueue
+from ip_resolver import IPResolver
+from reconciler import ClusterReconciler
+from retention import RetentionService
+from warm_pool import WarmPool
+from background import LeaseHeartbeat
+from migrations import apply_migrations, pending_migrations
+from progress import progress_broker, format_sse, TERMINAL_EVENTS
+from passwords import PasswordHasher, HasherBusyError
+from database import init_storage
+import metrics
+import tracing
 from config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
-db.init_app(app)
+tracing.configure_logging(app.config['LOG_LEVEL'], json_format=app.config['LOG_FORMAT'] == 'json')
+tracing.configure(slow_ms=app.config['TRACE_SLOW_MS'], slow_task_ms=app.config['TRACE_SLOW_TASK_MS'])
+
+init_storage(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Effettua il login per accedere.'
 
+password_hasher = PasswordHasher(app)
+# Avviato solo qui, prima di qualunque thread: i worker creati con fork passano a un pool di thread
+password_hasher.start()
+
 proxmox_api = ProxmoxAPI(
     host=os.getenv('PROXMOX_HOST', '192.168.56.15'),
     user=os.getenv('PROXMOX_USER', 'root@pam'),
     password=os.getenv('PROXMOX_PASSWORD', ''),
-    verify_ssl=os.getenv('PROXMOX_VERIFY_SSL', 'False').lower() == 'true'
+    verify_ssl=os.getenv('PROXMOX_VERIFY_SSL', 'False').lower() == 'true',
+    task_timeout=app.config['PROXMOX_TASK_TIMEOUT'],
+    inventory_ttls=app.config['PROXMOX_INVENTORY_TTLS'],
+    tier_requirements=app.config['VM_TIER_REQUIREMENTS'],
+    node_concurrency=app.config['PROVISIONING_NODE_CONCURRENCY'],
+    token_name=app.config['PROXMOX_TOKEN_NAME'],
+    token_value=app.config['PROXMOX_TOKEN_VALUE'],
+    pool_size=app.config['PROXMOX_POOL_SIZE'],
+    clone_strategy=app.config['PROXMOX_CLONE_STRATEGY']
 )
 
+provisioning_queue = ProvisioningQueue(app, proxmox_api)
+warm_pool = WarmPool(app, proxmox_api, provisioning_queue.vmid_allocator)
+provisioning_queue.warm_pool = warm_pool
+ip_resolver = IPResolver(app, proxmox_api)
+reconciler = ClusterReconciler(app, proxmox_api)
+retention_service = RetentionService(app)
+lease_heartbeat = LeaseHeartbeat(app)
+lease_heartbeat.add(provisioning_queue.renew_leases)
+if app.config['BACKGROUND_SERVICES']:
+    # Job rimasti a un worker terminato mentre gli altri continuano a servire
+    lease_heartbeat.add(provisioning_queue.resume_pending)
+
+_process_lock = threading.Lock()
+_process_started = None
+
+def start_process():
+    """
+    Prepara il processo a servire le richieste: aggiorna lo schema, riprende i job orfani
+    e avvia i servizi in background. Viene eseguita una sola volta per processo qualunque sia
+    il punto di ingresso (python app.py, flask run, server WSGI); nei server che creano i
+    worker con fork viene quindi eseguita in ogni worker, dopo il fork. I job restano del
+    worker che li esegue e i servizi esclusivi lavorano in un solo worker (lease nel database).
+    """
+    global _process_started
+    with _process_lock:
+        if _process_started == os.getpid():
+            return
+        if app.config['BACKGROUND_SERVICES']:
+            with app.app_context():
+                try:
+                    apply_migrations()
+                except SQLAlchemyError:
+                    # Un altro worker ha applicato le stesse migrazioni nello stesso momento
+                    db.session.rollback()
+                    if pending_migrations():
+                        raise
+                provisioning_queue.resume_pending()
+            ip_resolver.start()
+            reconciler.start()
+            retention_service.start()
+            warm_pool.start()
+        # Rinnova i lease dei job eseguiti qui anche senza servizi in background (dopo le migrazioni)
+        lease_heartbeat.start()
+        _process_started = os.getpid()
+
+@app.before_request
+def ensure_process_started():
+    if _process_started != os.getpid():
+        start_process()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Il trace_id arriva dal proxy (X-Request-ID) oppure viene generato qui
+    g.request_trace = tracing.trace(request.headers.get('X-Request-ID'), collect_timings=True)
+    g.request_trace.__enter__()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            elapsed,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=response.status_code
+        )
+        response.headers['Server-Timing'] = tracing.server_timing_header(total_ms=elapsed * 1000)
+    if tracing.current_trace_id():
+        response.headers['X-Request-ID'] = tracing.current_trace_id()
+    return response
+
+@app.teardown_request
+def close_request_trace(error=None):
+    request_trace = g.pop('request_trace', None)
+    if request_trace is not None:
+        request_trace.__exit__(None, None, None)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -49,7 +161,20 @@ def login():
         
         user = User.query.filter_by(username=username).first()
         
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            valid = user is not None and password_hasher.verify(user.password_hash, password)
+        except HasherBusyError:
+            flash('Troppi accessi in questo momento, riprova tra qualche secondo.', 'warning')
+            return render_template('login.html'), 503
+        
+        if valid:
+            if password_hasher.needs_rehash(user.password_hash):
+                # Parametri di hash cambiati: l'hash viene aggiornato ora che la password è nota
+                try:
+                    user.password_hash = password_hasher.hash(password)
+                    db.session.commit()
+                except HasherBusyError:
+                    pass
             login_user(user, remember=remember)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('dashboard'))
@@ -93,9 +218,15 @@ def register():
                 flash('Email già registrata.', 'error')
                 return render_template('register.html')
         
+        try:
+            password_hash = password_hasher.hash(password)
+        except HasherBusyError:
+            flash('Troppe richieste in questo momento, riprova tra qualche secondo.', 'warning')
+            return render_template('register.html'), 503
+        
         new_user = User(
             username=username,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
             email=email if email else None,
             is_admin=False
         )
@@ -115,16 +246,80 @@ def logout():
     flash('Logout effettuato con successo.', 'info')
     return redirect(url_for('login'))
 
+def count_requests_by_status(user_id=None):
+    """Conteggio delle richieste per stato con una sola query GROUP BY"""
+    query = db.session.query(VMRequest.status, func.count(VMRequest.id))
+    if user_id is not None:
+        query = query.filter(VMRequest.user_id == user_id)
+    return dict(query.group_by(VMRequest.status).all())
+
+def paginate_requests(query, cursor, page_size):
+    """
+    Paginazione keyset su (created_at, id) decrescenti: il cursore è l'ultima riga
+    della pagina precedente nel formato '<created_at ISO>_<id>'.
+    Restituisce (righe, cursore della pagina successiva o None).
+    """
+    if cursor:
+        try:
+            created_at, last_id = cursor.rsplit('_', 1)
+            created_at = datetime.fromisoformat(created_at)
+            last_id = int(last_id)
+        except ValueError:
+            abort(400)
+        query = query.filter(or_(
+            VMRequest.created_at < created_at,
+            and_(VMRequest.created_at == created_at, VMRequest.id < last_id)
+        ))
+    
+    rows = query.order_by(VMRequest.created_at.desc(), VMRequest.id.desc()).limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f"{rows[-1].created_at.isoformat()}_{rows[-1].id}"
+    return rows, next_cursor
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
+    cursor = request.args.get('after')
+    page_size = app.config['DASHBOARD_PAGE_SIZE']
+    
     if current_user.is_admin:
-        requests = VMRequest.query.order_by(VMRequest.created_at.desc()).all()
-        pending_requests = VMRequest.query.filter_by(status='pending').count()
-        return render_template('admin_dashboard.html', requests=requests, pending_requests=pending_requests)
+        query = VMRequest.query.options(joinedload(VMRequest.user))
+        requests, next_cursor = paginate_requests(query, cursor, page_size)
+        counts = count_requests_by_status()
+        return render_template(
+            'admin_dashboard.html',
+            requests=requests,
+            counts=counts,
+            total_requests=sum(counts.values()),
+            pending_requests=counts.get('pending', 0),
+            next_cursor=next_cursor,
+            is_first_page=not cursor
+        )
     else:
-        user_requests = VMRequest.query.filter_by(user_id=current_user.id).order_by(VMRequest.created_at.desc()).all()
-        return render_template('user_dashboard.html', requests=user_requests)
+        query = VMRequest.query.filter_by(user_id=current_user.id)
+        user_requests, next_cursor = paginate_requests(query, cursor, page_size)
+        counts = count_requests_by_status(user_id=current_user.id)
+        return render_template(
+            'user_dashboard.html',
+            requests=user_requests,
+            counts=counts,
+            total_requests=sum(counts.values()),
+            next_cursor=next_cursor,
+            is_first_page=not cursor
+        )
+
+def validate_vm_request(vm_type, vm_name):
+    """Restituisce il messaggio di errore per una nuova richiesta non valida, altrimenti None"""
+    if not vm_type or not vm_name:
+        return 'Compila tutti i campi obbligatori.'
+    
+    # Verifica che il tipo sia valido
+    valid_types = ['bronze', 'silver', 'gold']
+    if vm_type not in valid_types:
+        return 'Tipo di VM non valido.'
+    return None
 
 @app.route('/request_vm', methods=['GET', 'POST'])
 @login_required
@@ -139,14 +334,9 @@ def request_vm():
         vm_name = request.form.get('vm_name')
         description = request.form.get('description', '')
         
-        if not vm_type or not vm_name:
-            flash('Compila tutti i campi obbligatori.', 'error')
-            return render_template('request_vm.html')
-        
-        # Verifica che il tipo sia valido
-        valid_types = ['bronze', 'silver', 'gold']
-        if vm_type not in valid_types:
-            flash('Tipo di VM non valido.', 'error')
+        error = validate_vm_request(vm_type, vm_name)
+        if error:
+            flash(error, 'error')
             return render_template('request_vm.html')
         
         # Crea la richiesta
@@ -179,79 +369,113 @@ def approve_request(request_id):
         flash('Questa richiesta è già stata processata.', 'warning')
         return redirect(url_for('dashboard'))
     
-    try:
-        vm_configs = {
-            'bronze': {
-                'template': '3335'
-            },
-            'silver': {
-                'template': '3336'
-            },
-            'gold': {
-                'template': '3337'
-            }
-        }
-        
-        config = vm_configs[vm_request.vm_type]
-        
-        result = proxmox_api.create_vm(
-            vm_name=vm_request.vm_name,
-            vm_type=vm_request.vm_type,
-            template=config['template']
-        )
-        
-        if result['success']:
-            vm_request.status = 'approved'
-            vm_request.vm_id = result.get('vmid')
-            vm_request.approved_by = current_user.id
-            vm_request.approved_at = get_local_time()
-            
-            try:
-                nodes = proxmox_api.api.nodes.get()
-                node = nodes[0]['node'] if nodes else None
-            except:
-                node = None
-            
-            credentials = proxmox_api.generate_credentials(
-                vm_request.vm_name,
-                node=node,
-                vmid=result.get('vmid')
-            )
-            vm_request.hostname = credentials['hostname']
-            ip_address = credentials['ip_address']
-            if not ip_address or ip_address == "IP non disponibile" or ip_address.startswith("Verificare"):
-                ip_address = None
-            vm_request.ip_address = ip_address
-            vm_request.username = credentials['username']
-            vm_request.password = credentials['password']
-            vm_request.ssh_key = ''
-            
-            db.session.commit()
-            
-           
-            send_credentials(vm_request)
-            
-            flash(f'Container creato con successo! ID: {result.get("vmid")}', 'success')
-        else:
-            vm_request.status = 'rejected'
-            vm_request.rejected_by = current_user.id
-            vm_request.rejected_at = get_local_time()
-            vm_request.rejection_reason = "Impossibile creare il container a causa di problemi tecnici. Contattare l'amministratore per maggiori informazioni."
-            vm_request.error_message = result.get('error', 'Errore sconosciuto')  
-            db.session.commit()
-            flash(f'Impossibile creare il container. Richiesta automaticamente rifiutata.', 'error')
-    
-    except Exception as e:
-        vm_request.status = 'rejected'
-        vm_request.rejected_by = current_user.id
-        vm_request.rejected_at = get_local_time()
-        vm_request.rejection_reason = "Impossibile creare il container a causa di problemi tecnici. Contattare l'amministratore per maggiori informazioni."
-        vm_request.error_message = str(e)  
-        db.session.commit()
-        flash(f'Impossibile creare il container. Richiesta automaticamente rifiutata.', 'error')
+    job = provisioning_queue.enqueue(vm_request, requested_by=current_user.id)
+    if not job:
+        flash('Questa richiesta è già stata processata.', 'warning')
+        return redirect(url_for('dashboard'))
     
+    flash(f'Richiesta approvata. Creazione del container in corso (job #{job.id}).', 'info')
+    if request.form.get('next') == 'details':
+        return redirect(url_for('vm_details', request_id=request_id))
     return redirect(url_for('dashboard'))
 
+@app.route('/bulk_approve', methods=['POST'])
+@login_required
+def bulk_approve():
+    if not current_user.is_admin:
+        flash('Accesso negato.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    vm_type = request.form.get('vm_type')
+    if vm_type:
+        # Tutte le richieste in attesa del tier selezionato
+        rows = db.session.query(VMRequest.id).filter_by(status='pending', vm_type=vm_type).order_by(VMRequest.created_at).all()
+        request_ids = [row.id for row in rows]
+    else:
+        request_ids = [int(request_id) for request_id in request.form.getlist('request_ids') if request_id.isdigit()]
+    
+    if not request_ids:
+        flash('Nessuna richiesta selezionata.', 'warning')
+        return redirect(url_for('dashboard'))
+    
+    batch_id, outcomes = provisioning_queue.enqueue_many(request_ids, requested_by=current_user.id)
+    queued = sum(1 for job in outcomes.values() if job)
+    skipped = len(outcomes) - queued
+    
+    flash(f'{queued} richieste approvate e messe in coda per la creazione.', 'info')
+    if skipped:
+        flash(f'{skipped} richieste ignorate perché già processate.', 'warning')
+    if not queued:
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('provisioning_batch', batch_id=batch_id))
+
+@app.route('/bulk_decommission', methods=['POST'])
+@login_required
+def bulk_decommission():
+    if not current_user.is_admin:
+        flash('Accesso negato.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    if request.form.get('all_approved'):
+        # Tutti i container approvati, eventualmente di un solo tier
+        query = db.session.query(VMRequest.id).filter_by(status='approved')
+        vm_type = request.form.get('vm_type')
+        if vm_type:
+            query = query.filter_by(vm_type=vm_type)
+        request_ids = [row.id for row in query.order_by(VMRequest.id).all()]
+    else:
+        request_ids = [int(request_id) for request_id in request.form.getlist('request_ids') if request_id.isdigit()]
+    
+    if not request_ids:
+        flash('Nessun container selezionato.', 'warning')
+        return redirect(url_for('dashboard'))
+    
+    batch_id, outcomes = provisioning_queue.enqueue_decommission(request_ids, requested_by=current_user.id)
+    queued = sum(1 for job in outcomes.values() if job)
+    skipped = len(outcomes) - queued
+    
+    flash(f'{queued} container messi in coda per la dismissione.', 'info')
+    if skipped:
+        flash(f'{skipped} richieste ignorate perché non approvate o già in dismissione.', 'warning')
+    if not queued:
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('provisioning_batch', batch_id=batch_id))
+
+@app.route('/decommission_request/<int:request_id>', methods=['POST'])
+@login_required
+def decommission_request(request_id):
+    if not current_user.is_admin:
+        flash('Accesso negato.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    VMRequest.query.get_or_404(request_id)
+    _, outcomes = provisioning_queue.enqueue_decommission([request_id], requested_by=current_user.id)
+    job = outcomes.get(request_id)
+    if not job:
+        flash('Solo i container approvati possono essere dismessi.', 'warning')
+    else:
+        flash(f'Dismissione del container in corso (job #{job.id}).', 'info')
+    return redirect(url_for('vm_details', request_id=request_id))
+
+@app.route('/provisioning_batch/<batch_id>')
+@login_required
+def provisioning_batch(batch_id):
+    if not current_user.is_admin:
+        flash('Accesso negato.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    jobs = ProvisioningJob.query.filter_by(batch_id=batch_id).order_by(ProvisioningJob.id).all()
+    if not jobs:
+        flash('Operazione multipla non trovata.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    summary = {}
+    for job in jobs:
+        summary[job.status] = summary.get(job.status, 0) + 1
+    
+    decommission = jobs[0].action == 'decommission'
+    return render_template('provisioning_batch.html', jobs=jobs, summary=summary, batch_id=batch_id, decommission=decommission)
+
 @app.route('/reject_request/<int:request_id>', methods=['POST'])
 @login_required
 def reject_request(request_id):
@@ -286,6 +510,51 @@ def vm_details(request_id):
     
     return render_template('vm_details.html', request=vm_request)
 
+@app.route('/vm_details/<int:request_id>/events')
+@login_required
+def vm_progress_events(request_id):
+    vm_request = VMRequest.query.get_or_404(request_id)
+    
+    if not current_user.is_admin and vm_request.user_id != current_user.id:
+        abort(403)
+    
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    # Iscrizione prima della fotografia dello stato, così nessun evento va perso nel mezzo
+    subscription = progress_broker.subscribe(request_id, last_event_id=last_event_id)
+    snapshot = vm_request.to_dict(include_credentials=True)
+    snapshot['ip_attempts_exhausted'] = (vm_request.ip_attempts or 0) >= app.config['IP_RESOLVER_MAX_ATTEMPTS']
+    settled = vm_request.status in ('rejected', 'decommissioned') or (
+        vm_request.status == 'approved' and (vm_request.ip_address or snapshot['ip_attempts_exhausted'])
+    )
+    snapshot['settled'] = bool(settled)
+    db.session.remove()
+    
+    keepalive = app.config['PROGRESS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['PROGRESS_STREAM_TIMEOUT']
+    
+    def stream():
+        try:
+            yield format_sse(event='snapshot', data=snapshot, retry=3000)
+            if settled:
+                return
+            while time.monotonic() < deadline:
+                record = subscription.get(timeout=keepalive)
+                if record is None:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_sse(record)
+                if record['event'] in TERMINAL_EVENTS:
+                    break
+        finally:
+            subscription.close()
+    
+    response = Response(stream(), mimetype='text/event-stream')
+    # Se il client si disconnette prima del primo evento il generatore non parte mai
+    response.call_on_close(subscription.close)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/refresh_ip/<int:request_id>', methods=['POST'])
 @login_required
 def refresh_ip(request_id):
@@ -299,38 +568,123 @@ def refresh_ip(request_id):
         flash('Container non trovato.', 'error')
         return redirect(url_for('vm_details', request_id=request_id))
     
-    try:
-        nodes = proxmox_api.api.nodes.get()
-        node = nodes[0]['node'] if nodes else None
-        
-        if node:
-            ip_address = proxmox_api.refresh_vm_ip(node, vm_request.vm_id)
-            if ip_address:
-                vm_request.ip_address = ip_address
-                db.session.commit()
-                flash(f'IP aggiornato: {ip_address}', 'success')
-            else:
-                flash('Impossibile recuperare l\'IP. Il container potrebbe non essere ancora avviato o l\'agent non è disponibile.', 'warning')
+    ip_resolver.request_refresh(vm_request)
+    if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        return jsonify({'status': 'queued'}), 202
+    flash('Recupero dell\'IP in corso. L\'indirizzo comparirà appena il container lo ottiene.', 'info')
+    return redirect(url_for('vm_details', request_id=request_id))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+# --- API JSON ---------------------------------------------------------------
+
+def api_login_required(view):
+    """Come login_required, ma risponde 401 in JSON invece di reindirizzare al login"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify({'error': 'Autenticazione richiesta.'}), 401
+        return view(*args, **kwargs)
+    return wrapped
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+def conditional_json(etag, build):
+    """Risponde 304 se il client ha già la versione corrente, altrimenti costruisce il JSON"""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/dashboard')
+@api_login_required
+def api_dashboard():
+    cursor = request.args.get('after')
+    page_size = app.config['DASHBOARD_PAGE_SIZE']
+    user_id = None if current_user.is_admin else current_user.id
+    
+    # Versione dei dati visibili: ultima modifica e numero di righe (cambia anche con le cancellazioni)
+    version = db.session.query(func.max(VMRequest.updated_at), func.count(VMRequest.id))
+    if user_id is not None:
+        version = version.filter(VMRequest.user_id == user_id)
+    last_update, total = version.one()
+    etag = make_etag('dashboard', current_user.id, last_update, total, cursor, page_size)
+    
+    def build():
+        query = VMRequest.query
+        if user_id is None:
+            query = query.options(joinedload(VMRequest.user))
         else:
-            flash('Impossibile trovare il nodo ProxMox.', 'error')
-    except Exception as e:
-        flash(f'Errore nel recupero IP: {str(e)}', 'error')
+            query = query.filter_by(user_id=user_id)
+        rows, next_cursor = paginate_requests(query, cursor, page_size)
+        return {
+            'counts': count_requests_by_status(user_id=user_id),
+            'total': total,
+            'requests': [row.to_dict(include_user=user_id is None) for row in rows],
+            'next_cursor': next_cursor
+        }
     
-    return redirect(url_for('vm_details', request_id=request_id))
+    return conditional_json(etag, build)
 
-def send_credentials(vm_request):
-    """Invia le credenziali all'utente"""
-    pass
+@app.route('/api/vm/<int:request_id>')
+@api_login_required
+def api_vm_details(request_id):
+    version = db.session.query(VMRequest.user_id, VMRequest.updated_at).filter_by(id=request_id).first()
+    if not version:
+        return jsonify({'error': 'Richiesta non trovata.'}), 404
+    if not current_user.is_admin and version.user_id != current_user.id:
+        return jsonify({'error': 'Accesso negato.'}), 403
+    
+    etag = make_etag('vm', request_id, version.updated_at)
+    return conditional_json(etag, lambda: db.session.get(VMRequest, request_id).to_dict(include_credentials=True))
+
+@app.route('/api/requests', methods=['POST'])
+@api_login_required
+def api_request_vm():
+    if current_user.is_admin:
+        return jsonify({'error': 'Gli amministratori non possono richiedere container.'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    vm_type = data.get('vm_type')
+    vm_name = data.get('vm_name')
+    error = validate_vm_request(vm_type, vm_name)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    vm_request = VMRequest(
+        user_id=current_user.id,
+        vm_type=vm_type,
+        vm_name=vm_name,
+        description=data.get('description', ''),
+        status='pending'
+    )
+    db.session.add(vm_request)
+    db.session.commit()
+    
+    response = jsonify(vm_request.to_dict())
+    response.status_code = 201
+    response.headers['Location'] = url_for('api_vm_details', request_id=vm_request.id)
+    response.set_etag(make_etag('vm', vm_request.id, vm_request.updated_at))
+    return response
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        apply_migrations(verbose=True)
     
         admin = User.query.filter_by(username='admin').first()
         if not admin:
             admin = User(
                 username='admin',
-                password_hash=generate_password_hash('admin'),
+                password_hash=password_hasher.hash('admin'),
                 is_admin=True,
                 email='admin@example.com'
             )
@@ -338,4 +692,9 @@ if __name__ == '__main__':
             db.session.commit()
             print("Utente admin creato: username='admin', password='admin'")
     
+    # Il reloader di debug esegue questo blocco anche nel processo padre: i servizi partono
+    # subito solo nel processo che serve le richieste (negli altri casi alla prima richiesta)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_process()
+    
     app.run(host='0.0.0.0', port=5000, debug=True)
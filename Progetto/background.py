@@ -0,0 +1,142 @@
+"""
+Servizi periodici in background (risoluzione IP, riconciliazione, ...):
+un thread daemon esegue run_once() a intervalli regolari dentro un app context.
+
+Con più processi (worker di gunicorn, più istanze) i servizi esclusivi lavorano
+in un solo processo alla volta: prima di ogni ciclo il processo prende o rinnova
+il lease del servizio nella tabella service_lease, e LeaseHeartbeat lo rinnova
+durante i cicli lunghi. Se il processo termina il lease scade e il servizio
+passa a un altro processo.
+"""
+
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ServiceLease, get_local_time
+from tracing import trace
+
+logger = logging.getLogger(__name__)
+
+
+def process_owner():
+    """Identificativo del processo corrente (host:pid), diverso in ogni worker dopo il fork"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire_lease(name, ttl):
+    """Prende o rinnova il lease del servizio per questo processo; False se lo tiene un altro processo"""
+    now = get_local_time()
+    owner = process_owner()
+    values = {'owner': owner, 'expires_at': now + timedelta(seconds=ttl)}
+    taken = ServiceLease.query.filter(
+        ServiceLease.name == name,
+        or_(ServiceLease.owner == owner, ServiceLease.expires_at < now)
+    ).update(values, synchronize_session=False)
+    if not taken:
+        if db.session.get(ServiceLease, name) is not None:
+            db.session.rollback()
+            return False
+        db.session.add(ServiceLease(name=name, **values))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Creato nello stesso momento da un altro processo
+        db.session.rollback()
+        return False
+    return True
+
+
+def renew_leases(ttl):
+    """Proroga tutti i lease dei servizi tenuti da questo processo"""
+    ServiceLease.query.filter_by(owner=process_owner()).update(
+        {'expires_at': get_local_time() + timedelta(seconds=ttl)}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+class PeriodicService:
+    name = 'servizio'
+    # True per i servizi che devono lavorare in un solo processo (lease nel database)
+    exclusive = False
+
+    def __init__(self, app=None, interval=10):
+        self.app = None
+        self.interval = interval
+        self.lease_ttl = 60
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.lease_ttl = app.config.get('BACKGROUND_LEASE_TTL', self.lease_ttl)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Anticipa il prossimo ciclo senza attendere l'intervallo"""
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.run_cycle()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_cycle(self):
+        """Un ciclo del servizio; un servizio esclusivo lo esegue solo se questo processo ne tiene il lease"""
+        # Ogni ciclo ha il proprio trace_id per correlare le chiamate a ProxMox
+        with self.app.app_context(), trace():
+            try:
+                if not self.exclusive or acquire_lease(self.name, self.lease_ttl):
+                    self.run_once()
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Errore nel servizio %s: %s", self.name, e)
+            finally:
+                db.session.remove()
+
+    def run_once(self):
+        raise NotImplementedError
+
+
+class LeaseHeartbeat(PeriodicService):
+    """
+    Rinnova i lease di questo processo a un terzo della loro durata, così un ciclo lungo
+    (refill del warm pool, archiviazione) non perde il servizio. Le funzioni registrate
+    con add() vengono chiamate a ogni battito (ad esempio il rinnovo dei lease dei job).
+    """
+    name = 'lease-heartbeat'
+
+    def __init__(self, app=None):
+        self._callbacks = []
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.interval = max(1, self.lease_ttl // 3)
+
+    def add(self, callback):
+        self._callbacks.append(callback)
+
+    def run_once(self):
+        renew_leases(self.lease_ttl)
+        for callback in self._callbacks:
+            callback()
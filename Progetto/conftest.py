@@ -0,0 +1,50 @@
+"""
+Ambiente dei test: database SQLite temporaneo, nessun servizio in background e
+un cluster simulato (fake_proxmox.py) per i test che importano l'applicazione.
+Le variabili vanno impostate prima che config.py venga importato (lo importa già test_proxmox.py).
+"""
+
+import os
+import tempfile
+
+import pytest
+
+from fake_proxmox import FakeCluster, FakeProxmoxServer, SimulationProfile
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='vm-portal-test-'), 'test.db')
+os.environ['BACKGROUND_SERVICES'] = 'False'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+@pytest.fixture(scope='session')
+def cluster():
+    """Cluster simulato; l'applicazione viene importata dopo l'avvio, collegata a questo cluster"""
+    cluster = FakeCluster(SimulationProfile(
+        task_durations={'vzclone': 1.0, 'vzlinkclone': 1.0, 'vzstart': 0.1}, ip_delay=0.1, jitter=0
+    ))
+    server = FakeProxmoxServer(cluster).start()
+    os.environ['PROXMOX_HOST'] = server.address
+    os.environ['PROXMOX_PASSWORD'] = 'test'
+
+    from app import app, db
+    from migrations import apply_migrations
+    from models import User
+    with app.app_context():
+        apply_migrations()
+        db.session.add(User(username='test', password_hash='x'))
+        db.session.commit()
+    yield cluster
+    server.stop()
+
+
+@pytest.fixture
+def ctx(cluster):
+    from app import app
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def user_id(ctx):
+    from models import User
+    return User.query.filter_by(username='test').one().id
@@ -0,0 +1,104 @@
+"""
+Profilo di storage del database.
+
+Con SQLite ogni nuova connessione riceve i pragma configurati: WAL permette
+alle pagine di leggere mentre i worker di provisioning scrivono e il busy
+timeout fa attendere chi scrive invece di fallire subito con "database is
+locked". Con PostgreSQL vengono impostati dimensioni del pool, verifica delle
+connessioni riusate e lock_timeout.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+SQLITE_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+SQLITE_SYNCHRONOUS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
+
+def _is_memory_sqlite(url):
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS per il database indicato in SQLALCHEMY_DATABASE_URI"""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if _is_memory_sqlite(url):
+        # Database in memoria (test): SQLAlchemy usa un pool a connessione singola
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT']
+    }
+    if url.get_backend_name() == 'postgresql':
+        options.update({
+            'pool_recycle': config['DB_POOL_RECYCLE'],
+            'pool_pre_ping': True
+        })
+        if url.get_driver_name() in ('psycopg2', 'psycopg', ''):
+            # Un'attesa su un lock oltre la soglia fa fallire la query invece di bloccare il worker
+            options['connect_args'] = {'options': f"-c lock_timeout={config['DB_BUSY_TIMEOUT_MS']}"}
+    return options
+
+
+def configure_engine(engine, config):
+    """Registra i pragma SQLite sulle nuove connessioni dell'engine (nessun effetto sugli altri database)"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    journal_mode = config['DB_SQLITE_JOURNAL_MODE'].upper()
+    synchronous = config['DB_SQLITE_SYNCHRONOUS'].upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"DB_SQLITE_JOURNAL_MODE non valido: {journal_mode}")
+    if synchronous not in SQLITE_SYNCHRONOUS:
+        raise ValueError(f"DB_SQLITE_SYNCHRONOUS non valido: {synchronous}")
+    pragmas = [
+        f'PRAGMA busy_timeout = {int(config["DB_BUSY_TIMEOUT_MS"])}',
+        f'PRAGMA journal_mode = {journal_mode}',
+        f'PRAGMA synchronous = {synchronous}',
+        # Valore negativo = dimensione in KiB invece che in pagine
+        f'PRAGMA cache_size = -{int(config["DB_SQLITE_CACHE_SIZE_KB"])}',
+        'PRAGMA temp_store = MEMORY'
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def init_storage(app, db):
+    """Da chiamare al posto di db.init_app(app)"""
+    # Le opzioni impostate esplicitamente nella configurazione hanno la precedenza
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+
+
+def storage_profile(engine):
+    """Impostazioni effettive del database, registrate nei risultati dei load test"""
+    profile = {
+        'dialect': engine.dialect.name,
+        'driver': engine.dialect.driver,
+        'pool': type(engine.pool).__name__
+    }
+    if hasattr(engine.pool, 'size'):
+        profile['pool_size'] = engine.pool.size()
+    if hasattr(engine.pool, '_max_overflow'):
+        profile['max_overflow'] = engine.pool._max_overflow
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size'):
+                profile[pragma] = connection.exec_driver_sql(f'PRAGMA {pragma}').scalar()
+        elif engine.dialect.name == 'postgresql':
+            profile['server_version'] = connection.exec_driver_sql('SHOW server_version').scalar()
+            profile['lock_timeout'] = connection.exec_driver_sql('SHOW lock_timeout').scalar()
+    return profile
@@ -0,0 +1,613 @@
+"""
+Simulatore locale di ProxMox VE per sviluppo, test e benchmark senza cluster.
+
+Implementa via HTTPS le API usate da ProxmoxAPI (nodi, container LXC, clone e
+avvio con task asincroni, interfacce di rete, storage, cluster/nextid,
+cluster/resources) con latenze e probabilità di errore configurabili per
+operazione. I nomi delle operazioni sono quelli delle metriche, ad esempio
+clone.post, status.start.post, interfaces.get, cluster.nextid.get.
+
+Uso:
+    python fake_proxmox.py --port 8006 --nodes 3 --latency default=0.02 --latency clone.post=0.5 \\
+        --task-duration clone=3 --fail status.start.post=0.05
+
+Il portale (o test_proxmox.py) si collega con PROXMOX_HOST=127.0.0.1:8006 e PROXMOX_VERIFY_SSL=False.
+Il certificato autofirmato viene generato all'avvio con il comando openssl.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from metrics import proxmox_operation
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+API_PREFIX = '/api2/json/'
+
+# Template creati all'avvio, allineati ai default di VM_TEMPLATES
+DEFAULT_TEMPLATES = {
+    3335: 'ct-temp',
+    3336: 'ct-temp2',
+    3337: 'ct-temp3'
+}
+
+
+class FakeProxmoxError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class SimulationProfile:
+    """
+    Latenze (secondi) e probabilità di errore per operazione, durata dei task
+    per tipo (clone, start, ...) e ritardo con cui un container avviato ottiene l'IP.
+    """
+
+    def __init__(self, latencies=None, failures=None, task_durations=None, task_failures=None,
+                 ip_delay=1.0, jitter=0.2, seed=None):
+        self.latencies = {'default': 0.0}
+        self.latencies.update(latencies or {})
+        self.failures = dict(failures or {})
+        # vzlinkclone: durata dei linked clone (per ProxMox sono comunque task vzclone)
+        self.task_durations = {'default': 0.5, 'vzclone': 2.0, 'vzlinkclone': 0.2, 'vzstart': 1.0}
+        self.task_durations.update(task_durations or {})
+        self.task_failures = dict(task_failures or {})
+        self.ip_delay = ip_delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def vary(self, value):
+        if not value or not self.jitter:
+            return value
+        return max(0.0, value * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def latency(self, operation):
+        return self.vary(self.latencies.get(operation, self.latencies['default']))
+
+    def should_fail(self, operation):
+        rate = self.failures.get(operation, self.failures.get('default', 0))
+        return rate > 0 and self.random.random() < rate
+
+    def task_duration(self, task_type):
+        return self.vary(self.task_durations.get(task_type, self.task_durations['default']))
+
+    def task_fails(self, task_type):
+        rate = self.task_failures.get(task_type, self.task_failures.get('default', 0))
+        return rate > 0 and self.random.random() < rate
+
+
+class FakeCluster:
+    """Stato in memoria del cluster simulato; i task si completano in modo pigro al primo accesso scaduto"""
+
+    def __init__(self, profile=None, nodes=3, templates=None, node_cores=16, node_memory_gb=64, storage_gb=500,
+                 container_memory_mb=512, container_disk_gb=8):
+        self.profile = profile or SimulationProfile()
+        self.container_memory = container_memory_mb * MB
+        self.container_disk = container_disk_gb * GB
+        self._lock = threading.RLock()
+        self._pid = 0x1000
+        self._ip_counter = 0
+        self.nodes = {
+            f'pve{index + 1}': {'maxcpu': node_cores, 'maxmem': node_memory_gb * GB, 'maxdisk': storage_gb * GB}
+            for index in range(nodes)
+        }
+        self.containers = {}
+        self.tasks = {}
+        first_node = next(iter(self.nodes))
+        for vmid, name in (templates or DEFAULT_TEMPLATES).items():
+            self.containers[vmid] = self._new_container(vmid, name, first_node, template=1)
+
+    # --- stato -------------------------------------------------------------
+
+    def _new_container(self, vmid, name, node, template=0):
+        return {
+            'vmid': vmid,
+            'name': name,
+            'node': node,
+            'status': 'stopped',
+            'template': template,
+            'lock': None,
+            'ip': None,
+            'ip_ready_at': None,
+            'started_at': None
+        }
+
+    def _next_ip(self):
+        self._ip_counter += 1
+        return f'10.10.{self._ip_counter // 250}.{self._ip_counter % 250 + 2}'
+
+    def _new_task(self, node, task_type, vmid, on_success, duration_type=None):
+        self._pid += 1
+        now = time.time()
+        upid = f'UPID:{node}:{self._pid:08X}:{int(now * 100) & 0xFFFFFFFF:08X}:{int(now):08X}:{task_type}:{vmid}:root@pam:'
+        self.tasks[upid] = {
+            'upid': upid,
+            'node': node,
+            'type': task_type,
+            'id': str(vmid),
+            'starttime': int(now),
+            'finish_at': now + self.profile.task_duration(duration_type or task_type),
+            'fails': self.profile.task_fails(task_type),
+            'on_success': on_success,
+            'status': 'running',
+            'exitstatus': None
+        }
+        return upid
+
+    def _advance(self):
+        now = time.time()
+        for task in self.tasks.values():
+            if task['status'] == 'running' and now >= task['finish_at']:
+                task['status'] = 'stopped'
+                if task['fails']:
+                    task['exitstatus'] = f"simulated {task['type']} failure"
+                    task['on_success'](failed=True)
+                else:
+                    task['exitstatus'] = 'OK'
+                    task['on_success'](failed=False)
+
+    def _container(self, vmid, node=None):
+        container = self.containers.get(int(vmid))
+        if container is None or (node is not None and container['node'] != node):
+            raise FakeProxmoxError(500, f"Configuration file 'nodes/{node}/lxc/{vmid}.conf' does not exist")
+        return container
+
+    def _node(self, node):
+        if node not in self.nodes:
+            raise FakeProxmoxError(500, f"hostname lookup '{node}' failed - failed to get address info")
+        return self.nodes[node]
+
+    def _node_usage(self, node):
+        running = [c for c in self.containers.values() if c['node'] == node and c['status'] == 'running']
+        disks = [c for c in self.containers.values() if c['node'] == node and not c['template']]
+        return len(running), len(running) * self.container_memory, len(disks) * self.container_disk
+
+    # --- rappresentazioni ---------------------------------------------------
+
+    def _node_resource(self, node):
+        spec = self.nodes[node]
+        running, mem, _ = self._node_usage(node)
+        return {
+            'id': f'node/{node}',
+            'type': 'node',
+            'node': node,
+            'status': 'online',
+            'cpu': min(0.95, 0.02 + running * 0.01),
+            'maxcpu': spec['maxcpu'],
+            'mem': 2 * GB + mem,
+            'maxmem': spec['maxmem'],
+            'uptime': 86400
+        }
+
+    def _storage_resource(self, node):
+        spec = self.nodes[node]
+        _, _, disk = self._node_usage(node)
+        return {
+            'id': f'storage/{node}/local-zfs',
+            'type': 'storage',
+            'node': node,
+            'storage': 'local-zfs',
+            'plugintype': 'zfspool',
+            'content': 'rootdir,images',
+            'status': 'available',
+            'disk': disk,
+            'maxdisk': spec['maxdisk']
+        }
+
+    def _container_resource(self, container):
+        running = container['status'] == 'running'
+        return {
+            'id': f"lxc/{container['vmid']}",
+            'type': 'lxc',
+            'vmid': container['vmid'],
+            'name': container['name'],
+            'node': container['node'],
+            'status': container['status'],
+            'template': container['template'],
+            'uptime': int(time.time() - container['started_at']) if running else 0,
+            'cpu': 0.01 if running else 0,
+            'mem': self.container_memory // 4 if running else 0,
+            'maxmem': self.container_memory,
+            'maxdisk': self.container_disk
+        }
+
+    # --- API ---------------------------------------------------------------
+
+    def handle(self, method, path, params):
+        """Esegue una chiamata API; restituisce il campo 'data' della risposta"""
+        operation = proxmox_operation(path, method.lower())
+        latency = self.profile.latency(operation)
+        if latency:
+            time.sleep(latency)
+        if self.profile.should_fail(operation):
+            raise FakeProxmoxError(500, f'simulated failure for {operation}')
+
+        segments = [unquote(segment) for segment in path.strip('/').split('/') if segment]
+        with self._lock:
+            self._advance()
+            return self._route(method, segments, params)
+
+    def _route(self, method, segments, params):
+        if segments == ['access', 'ticket'] and method == 'POST':
+            return {
+                'ticket': f'PVE:{params.get("username", "root@pam")}:{uuid.uuid4().hex}',
+                'CSRFPreventionToken': uuid.uuid4().hex,
+                'username': params.get('username', 'root@pam')
+            }
+        if segments == ['version']:
+            return {'version': '8.1.0', 'release': '8.1', 'repoid': 'fake'}
+        if segments == ['cluster', 'nextid']:
+            vmid = 100
+            while vmid in self.containers:
+                vmid += 1
+            return str(vmid)
+        if segments == ['cluster', 'resources']:
+            return self._cluster_resources(params.get('type'))
+        if segments == ['nodes'] and method == 'GET':
+            return [self._node_resource(node) for node in self.nodes]
+        if len(segments) >= 2 and segments[0] == 'nodes':
+            node = segments[1]
+            self._node(node)
+            return self._route_node(method, node, segments[2:], params)
+        raise FakeProxmoxError(501, f"Method '{method} /{'/'.join(segments)}' not implemented")
+
+    def _cluster_resources(self, resource_type=None):
+        resources = []
+        if resource_type in (None, 'node'):
+            resources.extend(self._node_resource(node) for node in self.nodes)
+        if resource_type in (None, 'storage'):
+            resources.extend(self._storage_resource(node) for node in self.nodes)
+        if resource_type in (None, 'vm'):
+            resources.extend(self._container_resource(c) for c in self.containers.values())
+        return resources
+
+    def _route_node(self, method, node, rest, params):
+        if rest == ['status']:
+            return self._node_resource(node)
+        if rest == ['storage'] and method == 'GET':
+            storage = self._storage_resource(node)
+            return [{
+                'storage': 'local-zfs', 'type': 'zfspool', 'content': storage['content'], 'shared': 0,
+                'active': 1, 'enabled': 1, 'total': storage['maxdisk'], 'used': storage['disk'],
+                'avail': storage['maxdisk'] - storage['disk']
+            }, {
+                'storage': 'local', 'type': 'dir', 'content': 'vztmpl,iso,backup', 'shared': 0,
+                'active': 1, 'enabled': 1, 'total': 100 * GB, 'used': 10 * GB, 'avail': 90 * GB
+            }]
+        if len(rest) == 3 and rest[0] == 'storage' and rest[2] == 'content':
+            if rest[1] != 'local':
+                return []
+            return [{'volid': 'local:vztmpl/alpine-3.18-default_20230607_amd64.tar.xz', 'content': 'vztmpl'}]
+        if len(rest) == 3 and rest[0] == 'tasks' and rest[2] == 'status':
+            task = self.tasks.get(rest[1])
+            if task is None:
+                raise FakeProxmoxError(500, f"no such task '{rest[1]}'")
+            return {key: task[key] for key in ('upid', 'node', 'type', 'id', 'starttime', 'status', 'exitstatus')
+                    if task[key] is not None}
+        if rest and rest[0] == 'lxc':
+            return self._route_lxc(method, node, rest[1:], params)
+        raise FakeProxmoxError(501, f"Method '{method} /nodes/{node}/{'/'.join(rest)}' not implemented")
+
+    def _route_lxc(self, method, node, rest, params):
+        if not rest:
+            if method == 'GET':
+                return [
+                    {key: value for key, value in self._container_resource(c).items() if key not in ('id', 'type', 'node')}
+                    for c in self.containers.values() if c['node'] == node
+                ]
+            if method == 'POST':
+                return self._create(node, params)
+
+        vmid = int(rest[0])
+        action = rest[1:]
+        container = self._container(vmid, node)
+
+        if not action and method == 'DELETE':
+            return self._destroy(node, container)
+        if action == ['status', 'current']:
+            resource = self._container_resource(container)
+            resource['lock'] = container['lock']
+            return resource
+        if action == ['config']:
+            if method == 'PUT':
+                if 'hostname' in params:
+                    container['name'] = params['hostname']
+                return None
+            prefix = 'base' if container['template'] else 'subvol'
+            return {
+                'hostname': container['name'], 'memory': self.container_memory // MB, 'template': container['template'],
+                'rootfs': f"local-zfs:{prefix}-{vmid}-disk-0,size={self.container_disk // GB}G"
+            }
+        if action == ['interfaces']:
+            if container['status'] != 'running':
+                raise FakeProxmoxError(500, f'CT {vmid} not running')
+            interfaces = [{'name': 'lo', 'inet': '127.0.0.1/8', 'hwaddr': '00:00:00:00:00:00'}]
+            if container['ip'] and time.time() >= container['ip_ready_at']:
+                interfaces.append({'name': 'eth0', 'inet': f"{container['ip']}/24", 'hwaddr': 'bc:24:11:00:00:01'})
+            return interfaces
+        if action == ['clone'] and method == 'POST':
+            return self._clone(node, container, params)
+        if action == ['status', 'start'] and method == 'POST':
+            return self._start(node, container)
+        if action == ['status', 'stop'] and method == 'POST':
+            return self._stop(node, container)
+        if action == ['migrate'] and method == 'POST':
+            return self._migrate(node, container, params)
+        raise FakeProxmoxError(501, f"Method '{method} /nodes/{node}/lxc/{'/'.join(rest)}' not implemented")
+
+    def _check_unlocked(self, container):
+        if container['lock']:
+            raise FakeProxmoxError(500, f"CT is locked ({container['lock']})")
+
+    def _clone(self, node, source, params):
+        if not source['template']:
+            raise FakeProxmoxError(500, 'clone is only supported for templates in this simulator')
+        newid = int(params.get('newid', 0))
+        if not newid:
+            raise FakeProxmoxError(400, "parameter verification failed: newid: property is missing")
+        if newid in self.containers:
+            raise FakeProxmoxError(500, f'CT {newid} already exists')
+        target = params.get('target') or node
+        self._node(target)
+        linked = not int(params.get('full', 0))
+        if linked and target != node:
+            # local-zfs non è condiviso: il volume base esiste solo sul nodo del template
+            raise FakeProxmoxError(500, "Can't clone to other node if you use a non-shared storage (linked clone)")
+
+        container = self._new_container(newid, params.get('hostname') or f'CT{newid}', target)
+        container['lock'] = 'create'
+        self.containers[newid] = container
+
+        def done(failed):
+            if failed:
+                self.containers.pop(newid, None)
+            else:
+                container['lock'] = None
+        return self._new_task(node, 'vzclone', source['vmid'], done, duration_type='vzlinkclone' if linked else None)
+
+    def _create(self, node, params):
+        vmid = int(params.get('vmid', 0))
+        if not vmid or vmid in self.containers:
+            raise FakeProxmoxError(500, f'CT {vmid} already exists')
+        container = self._new_container(vmid, params.get('hostname') or f'CT{vmid}', node)
+        container['lock'] = 'create'
+        self.containers[vmid] = container
+
+        def done(failed):
+            if failed:
+                self.containers.pop(vmid, None)
+            else:
+                container['lock'] = None
+        return self._new_task(node, 'vzcreate', vmid, done)
+
+    def _start(self, node, container):
+        self._check_unlocked(container)
+        if container['status'] == 'running':
+            raise FakeProxmoxError(500, f"CT {container['vmid']} already running")
+
+        def done(failed):
+            if not failed:
+                container['status'] = 'running'
+                container['started_at'] = time.time()
+                container['ip'] = container['ip'] or self._next_ip()
+                container['ip_ready_at'] = time.time() + self.profile.vary(self.profile.ip_delay)
+        return self._new_task(node, 'vzstart', container['vmid'], done)
+
+    def _stop(self, node, container):
+        self._check_unlocked(container)
+
+        def done(failed):
+            if not failed:
+                container['status'] = 'stopped'
+                container['started_at'] = None
+        return self._new_task(node, 'vzstop', container['vmid'], done)
+
+    def _destroy(self, node, container):
+        self._check_unlocked(container)
+        if container['status'] == 'running':
+            raise FakeProxmoxError(500, f"CT {container['vmid']} is running - destroy failed")
+        container['lock'] = 'destroyed'
+
+        def done(failed):
+            if failed:
+                container['lock'] = None
+            else:
+                self.containers.pop(container['vmid'], None)
+        return self._new_task(node, 'vzdestroy', container['vmid'], done)
+
+    def _migrate(self, node, container, params):
+        self._check_unlocked(container)
+        target = params.get('target')
+        self._node(target)
+        container['lock'] = 'migrate'
+
+        def done(failed):
+            container['lock'] = None
+            if not failed:
+                container['node'] = target
+        return self._new_task(node, 'vzmigrate', container['vmid'], done)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pve-api-daemon/3.0'
+
+    def _dispatch(self, method):
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body or '{}'))
+            else:
+                params.update(parse_qsl(body))
+
+        if not parts.path.startswith(API_PREFIX):
+            self._send(404, {'data': None}, 'Not Found')
+            return
+        try:
+            data = self.server.cluster.handle(method, parts.path[len(API_PREFIX):], params)
+        except FakeProxmoxError as e:
+            self._send(e.status, {'data': None, 'errors': {'message': e.message}}, e.message)
+            return
+        self._send(200, {'data': data})
+
+    def _send(self, status, payload, reason=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def generate_certificate(directory, openssl=None):
+    """Crea un certificato autofirmato per localhost; restituisce (certfile, keyfile)"""
+    openssl = openssl or os.getenv('OPENSSL') or shutil.which('openssl')
+    if not openssl:
+        raise RuntimeError("Comando openssl non trovato: impostare OPENSSL o passare certfile/keyfile")
+    certfile = os.path.join(directory, 'fake-proxmox.crt')
+    keyfile = os.path.join(directory, 'fake-proxmox.key')
+    subprocess.run(
+        [openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+         '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return certfile, keyfile
+
+
+class FakeProxmoxServer:
+    """Server HTTPS del simulatore, eseguito in un thread in background"""
+
+    def __init__(self, cluster=None, host='127.0.0.1', port=0, certfile=None, keyfile=None, verbose=False):
+        self.cluster = cluster or FakeCluster()
+        self._tempdir = None
+        if not certfile:
+            self._tempdir = tempfile.TemporaryDirectory(prefix='fake-proxmox-')
+            certfile, keyfile = generate_certificate(self._tempdir.name)
+
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.cluster = self.cluster
+        self.httpd.verbose = verbose
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def address(self):
+        """Valore da usare come PROXMOX_HOST (host:porta)"""
+        host, port = self.httpd.server_address[:2]
+        return f'{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-proxmox', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._tempdir:
+            self._tempdir.cleanup()
+
+
+def parse_assignments(values, cast=float):
+    """Converte argomenti 'chiave=valore' ripetuti in un dizionario"""
+    result = {}
+    for value in values or ():
+        key, _, raw = value.partition('=')
+        if not raw:
+            raise argparse.ArgumentTypeError(f"Formato atteso chiave=valore: {value}")
+        result[key.strip()] = cast(raw)
+    return result
+
+
+def _task_types(values):
+    # I tipi di task ProxMox per i container hanno il prefisso vz (vzclone, vzstart, ...)
+    return {key if key == 'default' or key.startswith('vz') else f'vz{key}': value for key, value in values.items()}
+
+
+def build_profile(args):
+    return SimulationProfile(
+        latencies=parse_assignments(args.latency),
+        failures=parse_assignments(args.fail),
+        task_durations=_task_types(parse_assignments(args.task_duration)),
+        task_failures=_task_types(parse_assignments(args.task_fail)),
+        ip_delay=args.ip_delay,
+        jitter=args.jitter,
+        seed=args.seed
+    )
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--nodes', type=int, default=3, help='Numero di nodi simulati')
+    parser.add_argument('--latency', action='append', metavar='OP=SECONDI',
+                        help="Latenza per operazione (es. clone.post=0.5, default=0.02)")
+    parser.add_argument('--fail', action='append', metavar='OP=PROB',
+                        help='Probabilità di errore HTTP 500 per operazione')
+    parser.add_argument('--task-duration', action='append', metavar='TIPO=SECONDI',
+                        help='Durata dei task asincroni (clone, linkclone, start, stop, destroy, migrate, create)')
+    parser.add_argument('--task-fail', action='append', metavar='TIPO=PROB',
+                        help='Probabilità che un task termini con errore')
+    parser.add_argument('--ip-delay', type=float, default=1.0, help="Secondi dopo l'avvio prima che il container abbia l'IP")
+    parser.add_argument('--jitter', type=float, default=0.2, help='Variazione relativa casuale di latenze e durate')
+    parser.add_argument('--seed', type=int, default=None, help='Seme per latenze ed errori riproducibili')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulatore locale di ProxMox VE')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8006)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    parser.add_argument('--verbose', action='store_true', help='Stampa ogni richiesta ricevuta')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    cluster = FakeCluster(build_profile(args), nodes=args.nodes)
+    server = FakeProxmoxServer(cluster, args.host, args.port, args.certfile, args.keyfile, verbose=args.verbose)
+    print(f"Simulatore ProxMox in ascolto su https://{server.address} ({args.nodes} nodi)")
+    print(f"Configurare il portale con PROXMOX_HOST={server.address} PROXMOX_VERIFY_SSL=False")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
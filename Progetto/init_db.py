@@ -5,20 +5,22 @@ Script per inizializzare il database e creare utenti di test
 
 from app import app, db
 from models import User
+from migrations import apply_migrations
 from werkzeug.security import generate_password_hash
+from config import Config
 
 def init_database():
     """Inizializza il database e crea utenti di test"""
     with app.app_context():
-        # Crea tutte le tabelle
-        db.create_all()
+        # Crea le tabelle mancanti e aggiorna lo schema esistente
+        apply_migrations(verbose=True)
         print("Database inizializzato")
         
         admin = User.query.filter_by(username='admin').first()
         if not admin:
             admin = User(
                 username='admin',
-                password_hash=generate_password_hash('admin'),
+                password_hash=generate_password_hash('admin', Config.PASSWORD_HASH_METHOD),
                 is_admin=True,
                 email='admin@example.com'
             )
@@ -32,7 +34,7 @@ def init_database():
         if not test_user:
             test_user = User(
                 username='user1',
-                password_hash=generate_password_hash('user1'),
+                password_hash=generate_password_hash('user1', Config.PASSWORD_HASH_METHOD),
                 is_admin=False,
                 email='user1@example.com'
             )
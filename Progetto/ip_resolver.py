@@ -0,0 +1,171 @@
+"""
+Risoluzione degli IP in background: le richieste approvate senza IP vengono
+interrogate a blocchi con backoff esponenziale e il risultato viene salvato
+nel database, così le pagine leggono solo il valore memorizzato.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy import bindparam, or_, update
+
+from background import PeriodicService
+from models import db, VMRequest, get_local_time
+from progress import progress_broker
+from metrics import IP_DISCOVERY_ATTEMPTS, IP_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+class IPResolver(PeriodicService):
+    name = 'ip-resolver'
+    exclusive = True
+
+    def __init__(self, app=None, proxmox_api=None, interval=5, batch_size=50, base_backoff=5, max_backoff=300,
+                 max_attempts=40, concurrency=4):
+        self.proxmox_api = proxmox_api
+        self.batch_size = batch_size
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        super().__init__(app, interval=interval)
+
+    def init_app(self, app, proxmox_api=None):
+        super().init_app(app)
+        if proxmox_api is not None:
+            self.proxmox_api = proxmox_api
+        self.interval = app.config.get('IP_RESOLVER_INTERVAL', self.interval)
+        self.batch_size = app.config.get('IP_RESOLVER_BATCH_SIZE', self.batch_size)
+        self.max_backoff = app.config.get('IP_RESOLVER_MAX_BACKOFF', self.max_backoff)
+        self.max_attempts = app.config.get('IP_RESOLVER_MAX_ATTEMPTS', self.max_attempts)
+
+    def due_requests(self, now):
+        return (
+            VMRequest.query
+            .filter(
+                VMRequest.status == 'approved',
+                VMRequest.ip_address.is_(None),
+                VMRequest.vm_id.isnot(None),
+                VMRequest.ip_attempts < self.max_attempts,
+                or_(VMRequest.ip_next_check_at.is_(None), VMRequest.ip_next_check_at <= now)
+            )
+            .order_by(VMRequest.ip_next_check_at)
+            .limit(self.batch_size)
+            .all()
+        )
+
+    def _default_node(self):
+        nodes = self.proxmox_api.get_nodes()
+        return nodes[0]['node'] if nodes else None
+
+    def _lookup(self, target):
+        request_id, node, vmid = target
+        try:
+            ip_address = self.proxmox_api.get_vm_ip(node, vmid)
+        except Exception as e:
+            IP_LOOKUPS.inc(result='error')
+            logger.warning("Errore nel recupero IP per container %s: %s", vmid, e)
+            return request_id, None
+        IP_LOOKUPS.inc(result='found' if ip_address else 'missing')
+        return request_id, ip_address
+
+    @staticmethod
+    def _statements():
+        """
+        UPDATE per chiave primaria limitati alle richieste ancora approvate e senza IP: una richiesta
+        dismessa o modificata durante le interrogazioni non viene toccata
+        """
+        table = VMRequest.__table__
+        guard = (
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .where(table.c.status == 'approved')
+            .where(table.c.vm_id == bindparam('b_vmid'))
+            .where(table.c.ip_address.is_(None))
+        )
+        found = guard.values(
+            ip_address=bindparam('b_ip'),
+            ip_next_check_at=None,
+            updated_at=bindparam('b_now')
+        )
+        # updated_at invariato (anche rispetto a onupdate): un tentativo fallito non è una modifica
+        # visibile della richiesta e non deve cambiarne l'ETag
+        retry = guard.values(
+            ip_attempts=table.c.ip_attempts + 1,
+            ip_next_check_at=bindparam('b_next'),
+            updated_at=table.c.updated_at
+        )
+        return found, retry
+
+    def run_once(self):
+        now = get_local_time()
+        pending = self.due_requests(now)
+        if not pending:
+            return 0
+
+        default_node = None
+        if any(not req.node for req in pending):
+            default_node = self._default_node()
+        targets = [(req.id, req.node or default_node, req.vm_id) for req in pending if req.node or default_node]
+        attempts = {req.id: req.ip_attempts or 0 for req in pending}
+        vmids = {req.id: req.vm_id for req in pending}
+        # Le interrogazioni durano: nessuna transazione resta aperta nel frattempo
+        db.session.rollback()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self._lookup, targets))
+
+        found = []
+        retry = []
+        for request_id, ip_address in results:
+            if ip_address:
+                found.append({'b_id': request_id, 'b_vmid': vmids[request_id], 'b_ip': ip_address, 'b_now': now})
+            else:
+                delay = min(self.base_backoff * 2 ** attempts[request_id], self.max_backoff)
+                retry.append({
+                    'b_id': request_id,
+                    'b_vmid': vmids[request_id],
+                    'b_next': now + timedelta(seconds=delay)
+                })
+
+        # Aggiornamento massivo per chiave primaria
+        found_statement, retry_statement = self._statements()
+        if found:
+            db.session.execute(found_statement, found)
+        if retry:
+            db.session.execute(retry_statement, retry)
+        db.session.commit()
+
+        # Eventi solo per le righe effettivamente aggiornate
+        ids = [row['b_id'] for row in found + retry]
+        current = {
+            row.id: row for row in
+            db.session.query(VMRequest.id, VMRequest.ip_address, VMRequest.ip_attempts)
+            .filter(VMRequest.id.in_(ids), VMRequest.status == 'approved')
+        }
+        updated = 0
+        for row in found:
+            saved = current.get(row['b_id'])
+            if saved is None or saved.ip_address != row['b_ip']:
+                continue
+            updated += 1
+            IP_DISCOVERY_ATTEMPTS.observe(attempts[row['b_id']] + 1, outcome='found')
+            progress_broker.publish(row['b_id'], 'ip_acquired', ip_address=row['b_ip'])
+        for row in retry:
+            saved = current.get(row['b_id'])
+            # Tentativi esauriti proprio in questo ciclo
+            if saved and not saved.ip_address and attempts[row['b_id']] < self.max_attempts <= saved.ip_attempts:
+                IP_DISCOVERY_ATTEMPTS.observe(saved.ip_attempts, outcome='exhausted')
+                progress_broker.publish(row['b_id'], 'ip_unavailable', attempts=saved.ip_attempts)
+        return updated
+
+    def request_refresh(self, vm_request):
+        """Rimette in coda la richiesta per un nuovo recupero immediato dell'IP"""
+        vm_request.ip_address = None
+        vm_request.ip_attempts = 0
+        vm_request.ip_next_check_at = None
+        db.session.commit()
+        progress_broker.publish(vm_request.id, 'ip_refresh')
+        self.wake()
@@ -0,0 +1,252 @@
+"""
+Metriche dell'applicazione esposte in formato testo Prometheus su /metrics.
+Contatori e istogrammi sono thread-safe e vivono in memoria nel processo.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Limiti (secondi) adatti sia alle chiamate API veloci sia ai task lunghi di ProxMox
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Etichette per {self.name}: attese {self.labelnames}, ricevute {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """Valore corrente per combinazione di etichette"""
+        with self._lock:
+            return dict(self._values)
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Misura la durata del blocco; l'etichetta 'outcome', se prevista, vale ok o error"""
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            if 'outcome' in self.labelnames:
+                labels = dict(labels, outcome=outcome)
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self):
+        """Numero di osservazioni e somma per combinazione di etichette"""
+        with self._lock:
+            return {
+                key: (sum(state['counts']), state['sum'])
+                for key, state in self._values.items()
+            }
+
+    def _render_samples(self, items):
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+PROXMOX_REQUEST_SECONDS = Histogram(
+    'proxmox_request_duration_seconds',
+    'Durata delle chiamate API verso ProxMox per operazione',
+    ('operation', 'outcome')
+)
+PROVISIONING_SECONDS = Histogram(
+    'provisioning_duration_seconds',
+    'Durata della creazione di un container, dalla presa in carico del job al termine',
+    ('tier', 'outcome')
+)
+PROVISIONING_QUEUE_SECONDS = Histogram(
+    'provisioning_queue_wait_seconds',
+    'Attesa in coda dei job di creazione prima che un worker li prenda in carico',
+    ('tier',)
+)
+IP_DISCOVERY_ATTEMPTS = Histogram(
+    'ip_discovery_attempts',
+    'Tentativi necessari per ottenere l\'IP di un container',
+    ('outcome',),
+    buckets=(1, 2, 3, 5, 10, 20, 40)
+)
+IP_LOOKUPS = Counter(
+    'ip_lookups_total',
+    'Interrogazioni dell\'IP di un container per esito',
+    ('result',)
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Durata delle richieste HTTP per endpoint Flask',
+    ('endpoint', 'method', 'status')
+)
+DECOMMISSION_SECONDS = Histogram(
+    'decommission_duration_seconds',
+    'Durata della dismissione di un container (arresto e distruzione), dalla presa in carico del job al termine',
+    ('outcome',)
+)
+WARM_POOL_CLAIMS = Counter(
+    'warm_pool_claims_total',
+    'Approvazioni servite da un container del warm pool (hit) o con un clone completo (miss)',
+    ('tier', 'result')
+)
+WARM_POOL_REFILLS = Counter(
+    'warm_pool_refills_total',
+    'Container clonati in background per ricostituire il warm pool, per esito',
+    ('tier', 'outcome')
+)
+INVENTORY_CACHE_LOOKUPS = Counter(
+    'proxmox_inventory_cache_lookups_total',
+    'Letture dalla cache dell\'inventario del cluster per tipo (nodes, lxc, storage, ...) ed esito (hit o miss)',
+    ('kind', 'result')
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    'password_hash_duration_seconds',
+    'Durata di hash e verifica delle password, attesa nel pool compresa',
+    ('operation', 'outcome')
+)
+
+def percentile(values, pct):
+    """Percentile con il metodo nearest-rank, per i report di benchmark e load test"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5 - 1e-9)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+    summary = {'count': len(values)}
+    for pct in percentiles:
+        summary[f'p{pct}'] = percentile(values, pct)
+    summary['max'] = max(values) if values else None
+    return summary
+
+
+# Segmenti del percorso seguiti da un identificativo (nome del nodo, VMID, UPID, ...)
+_PARAMETER_PARENTS = {'nodes', 'lxc', 'qemu', 'storage', 'tasks'}
+
+
+def proxmox_operation(path, method):
+    """
+    Nome dell'operazione per un percorso API senza identificativi, ad esempio
+    nodes/pve1/lxc/105/status/start + post -> status.start.post
+    """
+    segments = [segment for segment in path.split('/') if segment]
+    names = []
+    skip = False
+    for segment in segments:
+        if skip:
+            skip = False
+            continue
+        names.append(segment)
+        skip = segment in _PARAMETER_PARENTS
+    # Il contenitore (nodes, lxc) non serve quando la chiamata riguarda una sua sotto-risorsa
+    while len(names) > 1 and names[0] in ('nodes', 'lxc', 'qemu'):
+        names.pop(0)
+    return '.'.join(names + [method])
@@ -0,0 +1,182 @@
+"""
+Migrazioni versionate dello schema.
+
+db.create_all() crea solo le tabelle mancanti: colonne e indici aggiunti in
+seguito a tabelle esistenti (es. instance/vm_portal.db) vengono applicati
+qui, in ordine di versione. Ogni passo è idempotente, così su un database
+nuovo (già completo dopo create_all) le migrazioni vengono solo registrate.
+"""
+
+from sqlalchemy import inspect, text
+
+from models import db, VMRequest, get_local_time
+
+
+def add_column(table, column, ddl):
+    columns = {col['name'] for col in inspect(db.engine).get_columns(table)}
+    if db.engine.dialect.name == 'postgresql':
+        # DATETIME esiste solo in SQLite/MySQL
+        ddl = ddl.replace('DATETIME', 'TIMESTAMP')
+    if column not in columns:
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def create_index(name, table, columns):
+    db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+
+def _m001_vm_request_node():
+    add_column('vm_request', 'node', 'VARCHAR(100)')
+
+
+def _m002_provisioning_job_batch():
+    add_column('provisioning_job', 'batch_id', 'VARCHAR(32)')
+
+
+def _m003_hot_query_indexes():
+    create_index('ix_vm_request_created', 'vm_request', ['created_at', 'id'])
+    create_index('ix_vm_request_user_created', 'vm_request', ['user_id', 'created_at', 'id'])
+    create_index('ix_vm_request_status_type', 'vm_request', ['status', 'vm_type', 'created_at'])
+    create_index('ix_provisioning_job_status', 'provisioning_job', ['status'])
+    create_index('ix_provisioning_job_batch', 'provisioning_job', ['batch_id'])
+
+
+def _m004_ip_resolver():
+    add_column('vm_request', 'ip_attempts', 'INTEGER NOT NULL DEFAULT 0')
+    add_column('vm_request', 'ip_next_check_at', 'DATETIME')
+    create_index('ix_vm_request_ip_pending', 'vm_request', ['status', 'ip_address', 'ip_next_check_at'])
+
+
+def _m005_cluster_state():
+    add_column('vm_request', 'vm_status', 'VARCHAR(20)')
+    add_column('vm_request', 'uptime', 'INTEGER')
+    add_column('vm_request', 'cpu_usage', 'FLOAT')
+    add_column('vm_request', 'mem_usage', 'BIGINT')
+    add_column('vm_request', 'mem_max', 'BIGINT')
+    add_column('vm_request', 'last_seen_at', 'DATETIME')
+    add_column('vm_request', 'status_checked_at', 'DATETIME')
+
+
+def _m006_etag_indexes():
+    create_index('ix_vm_request_updated', 'vm_request', ['updated_at'])
+    create_index('ix_vm_request_user_updated', 'vm_request', ['user_id', 'updated_at'])
+
+
+def _m007_provisioning_job_trace():
+    add_column('provisioning_job', 'trace_id', 'VARCHAR(64)')
+
+
+def _m008_decommission():
+    add_column('provisioning_job', 'action', "VARCHAR(20) NOT NULL DEFAULT 'create'")
+    add_column('vm_request', 'decommissioned_by', 'INTEGER')
+    add_column('vm_request', 'decommissioned_at', 'DATETIME')
+
+
+def _m009_warm_pool():
+    # La tabella warm_container è creata da create_all
+    create_index('ix_warm_container_tier_status', 'warm_container', ['tier', 'status', 'created_at'])
+
+
+def _m010_clone_strategy():
+    add_column('vm_request', 'clone_strategy', 'VARCHAR(10)')
+    add_column('warm_container', 'clone_strategy', 'VARCHAR(10)')
+
+
+def _m011_leases():
+    # La tabella service_lease è creata da create_all
+    add_column('provisioning_job', 'owner', 'VARCHAR(64)')
+    add_column('provisioning_job', 'lease_expires_at', 'DATETIME')
+
+
+def _m012_drop_vm_name_index():
+    # Lo usava solo lo script di pulizia per nome, rimosso: l'indice pesava solo sulle scritture
+    db.session.execute(text('DROP INDEX IF EXISTS ix_vm_request_vm_name'))
+
+
+MIGRATIONS = [
+    (1, 'Nodo ProxMox su vm_request', _m001_vm_request_node),
+    (2, 'Batch di approvazione su provisioning_job', _m002_provisioning_job_batch),
+    (3, 'Indici per le query delle dashboard', _m003_hot_query_indexes),
+    (4, 'Stato del recupero IP in background', _m004_ip_resolver),
+    (5, 'Stato dei container dal cluster', _m005_cluster_state),
+    (6, 'Indici per gli ETag delle API', _m006_etag_indexes),
+    (7, 'Trace ID di correlazione su provisioning_job', _m007_provisioning_job_trace),
+    (8, 'Dismissione dei container', _m008_decommission),
+    (9, 'Warm pool di container per tier', _m009_warm_pool),
+    (10, 'Strategia di clone (linked/full) dei container', _m010_clone_strategy),
+    (11, 'Lease dei job e dei servizi in background', _m011_leases),
+    (12, "Rimozione dell'indice per nome su vm_request", _m012_drop_vm_name_index),
+]
+
+
+def _ensure_version_table():
+    db.session.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY, '
+        'description VARCHAR(255), '
+        'applied_at TIMESTAMP)'
+    ))
+    db.session.commit()
+
+
+def current_version():
+    _ensure_version_table()
+    return db.session.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+def pending_migrations():
+    version = current_version()
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def apply_migrations(verbose=False):
+    """Crea le tabelle mancanti e applica le migrazioni non ancora eseguite. Restituisce le versioni applicate"""
+    db.create_all()
+    applied = []
+    for version, description, upgrade in pending_migrations():
+        upgrade()
+        db.session.execute(
+            text('INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)'),
+            {'v': version, 'd': description, 't': get_local_time()}
+        )
+        db.session.commit()
+        applied.append(version)
+        if verbose:
+            print(f"Migrazione {version:03d} applicata: {description}")
+    
+    if applied:
+        # Le connessioni già aperte nel pool possono avere in cache lo schema precedente
+        db.session.remove()
+        db.engine.dispose()
+    return applied
+
+
+def dashboard_queries():
+    """Query rappresentative delle pagine più usate, con il nome dell'indice che dovrebbero usare"""
+    page = VMRequest.query.order_by(VMRequest.created_at.desc(), VMRequest.id.desc()).limit(51)
+    return [
+        ('dashboard admin', 'ix_vm_request_created', page),
+        ('dashboard utente', 'ix_vm_request_user_created',
+         VMRequest.query.filter(VMRequest.user_id == 1)
+         .order_by(VMRequest.created_at.desc(), VMRequest.id.desc()).limit(51)),
+        ('conteggi per stato', 'ix_vm_request_status_type',
+         db.session.query(VMRequest.status, db.func.count(VMRequest.id)).group_by(VMRequest.status)),
+        ('approvazione per tier', 'ix_vm_request_status_type',
+         db.session.query(VMRequest.id).filter_by(status='pending', vm_type='bronze').order_by(VMRequest.created_at)),
+    ]
+
+
+def check_query_plans():
+    """
+    Esegue EXPLAIN sulle query delle dashboard e verifica che usino l'indice previsto.
+    Restituisce una lista di (nome, indice atteso, ok, piano).
+    """
+    dialect = db.engine.dialect
+    explain = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    results = []
+    for name, index, query in dashboard_queries():
+        sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+        rows = db.session.execute(text(explain + sql)).fetchall()
+        plan = '\n'.join(str(row[-1]) for row in rows)
+        results.append((name, index, index in plan, plan))
+    return results
@@ -30,6 +30,19 @@ class User(db.Model):
         return str(self.id)
 
 class VMRequest(db.Model):
+    __table_args__ = (
+        # Dashboard admin (ordinamento keyset) e dashboard utente
+        db.Index('ix_vm_request_created', 'created_at', 'id'),
+        db.Index('ix_vm_request_user_created', 'user_id', 'created_at', 'id'),
+        # Conteggi per stato e approvazione multipla per tier
+        db.Index('ix_vm_request_status_type', 'status', 'vm_type', 'created_at'),
+        # Versione dei dati per gli ETag delle API
+        db.Index('ix_vm_request_updated', 'updated_at'),
+        db.Index('ix_vm_request_user_updated', 'user_id', 'updated_at'),
+        # Richieste approvate in attesa di IP, per il servizio di risoluzione
+        db.Index('ix_vm_request_ip_pending', 'status', 'ip_address', 'ip_next_check_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     vm_type = db.Column(db.String(20), nullable=False)  
@@ -39,8 +52,21 @@ class VMRequest(db.Model):
     
     # Dettagli VM dopo la creazione
     vm_id = db.Column(db.Integer, nullable=True)
+    node = db.Column(db.String(100), nullable=True)
+    clone_strategy = db.Column(db.String(10), nullable=True)  # linked, full
     hostname = db.Column(db.String(255), nullable=True)
     ip_address = db.Column(db.String(45), nullable=True)
+    ip_attempts = db.Column(db.Integer, default=0, nullable=False)
+    ip_next_check_at = db.Column(db.DateTime, nullable=True)
+    
+    # Stato del container rilevato dalla riconciliazione periodica
+    vm_status = db.Column(db.String(20), nullable=True)  # running, stopped, missing
+    uptime = db.Column(db.Integer, nullable=True)
+    cpu_usage = db.Column(db.Float, nullable=True)
+    mem_usage = db.Column(db.BigInteger, nullable=True)
+    mem_max = db.Column(db.BigInteger, nullable=True)
+    last_seen_at = db.Column(db.DateTime, nullable=True)
+    status_checked_at = db.Column(db.DateTime, nullable=True)
     username = db.Column(db.String(100), nullable=True)
     password = db.Column(db.String(255), nullable=True)
     ssh_key = db.Column(db.Text, nullable=True)
@@ -53,15 +79,22 @@ class VMRequest(db.Model):
     rejection_reason = db.Column(db.Text, nullable=True)
     error_message = db.Column(db.Text, nullable=True)
     
+    # Dismissione (container arrestato e distrutto)
+    decommissioned_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    decommissioned_at = db.Column(db.DateTime, nullable=True)
+    
     created_at = db.Column(db.DateTime, default=get_local_time)
     updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time)
     
     def get_status_badge_class(self):
         status_classes = {
             'pending': 'warning',
+            'provisioning': 'info',
             'approved': 'success',
             'rejected': 'danger',
-            'failed': 'danger' 
+            'failed': 'danger',
+            'decommissioning': 'info',
+            'decommissioned': 'secondary'
         }
         return status_classes.get(self.status, 'secondary')
     
@@ -71,12 +104,77 @@ class VMRequest(db.Model):
             return 'Rifiutata (Fallita)'
         status_names = {
             'pending': 'In Attesa',
+            'provisioning': 'In Creazione',
             'approved': 'Approvata',
             'rejected': 'Rifiutata',
-            'failed': 'Fallita'
+            'failed': 'Fallita',
+            'decommissioning': 'In Dismissione',
+            'decommissioned': 'Dismessa'
         }
         return status_names.get(self.status, self.status.capitalize())
     
+    def get_vm_status_badge_class(self):
+        status_classes = {
+            'running': 'success',
+            'stopped': 'secondary',
+            'missing': 'danger'
+        }
+        return status_classes.get(self.vm_status, 'light')
+    
+    def get_vm_status_display(self):
+        status_names = {
+            'running': 'In Esecuzione',
+            'stopped': 'Arrestato',
+            'missing': 'Non Trovato'
+        }
+        if not self.vm_status:
+            return 'Sconosciuto'
+        return status_names.get(self.vm_status, self.vm_status.capitalize())
+    
+    def get_uptime_display(self):
+        if not self.uptime:
+            return '-'
+        days, rest = divmod(self.uptime, 86400)
+        hours, rest = divmod(rest, 3600)
+        minutes = rest // 60
+        if days:
+            return f'{days}g {hours}h {minutes}m'
+        return f'{hours}h {minutes}m'
+    
+    def to_dict(self, include_user=False, include_credentials=False):
+        """Rappresentazione JSON per le API"""
+        def iso(value):
+            return value.isoformat() if value else None
+        
+        data = {
+            'id': self.id,
+            'vm_name': self.vm_name,
+            'vm_type': self.vm_type,
+            'description': self.description,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'vm_id': self.vm_id,
+            'node': self.node,
+            'hostname': self.hostname,
+            'ip_address': self.ip_address,
+            'vm_status': self.vm_status,
+            'rejection_reason': self.rejection_reason,
+            'created_at': iso(self.created_at),
+            'approved_at': iso(self.approved_at),
+            'rejected_at': iso(self.rejected_at),
+            'decommissioned_at': iso(self.decommissioned_at),
+            'updated_at': iso(self.updated_at)
+        }
+        if include_user:
+            data['username'] = self.user.username
+        if include_credentials and self.status == 'approved':
+            data['credentials'] = {
+                'username': self.username,
+                'password': self.password,
+                'ssh_key': self.ssh_key
+            }
+        return data
+    
     def get_vm_type_display(self):
         type_names = {
             'bronze': 'Bronze',
@@ -84,3 +182,72 @@ class VMRequest(db.Model):
             'gold': 'Gold'
         }
         return type_names.get(self.vm_type, self.vm_type.capitalize())
+
+
+class VMIDReservation(db.Model):
+    """Registro dei VMID prenotati dal portale, per evitare collisioni tra provisioning paralleli"""
+    vmid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    vm_request_id = db.Column(db.Integer, db.ForeignKey('vm_request.id'), nullable=True)
+    status = db.Column(db.String(20), default='reserved', nullable=False)  # reserved, in_use
+    reserved_at = db.Column(db.DateTime, default=get_local_time)
+    updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time)
+
+class ServiceLease(db.Model):
+    """Lease di un servizio in background: lo esegue solo il processo che lo tiene (vedi background.py)"""
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(64), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class WarmContainer(db.Model):
+    """Container già clonato e fermo, pronto per essere assegnato a una richiesta del suo tier"""
+    __table_args__ = (
+        db.Index('ix_warm_container_tier_status', 'tier', 'status', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tier = db.Column(db.String(20), nullable=False)
+    template = db.Column(db.String(100), nullable=False)
+    vmid = db.Column(db.Integer, unique=True, nullable=False)
+    node = db.Column(db.String(100), nullable=True)
+    clone_strategy = db.Column(db.String(10), nullable=True)  # linked, full
+    status = db.Column(db.String(20), default='cloning', nullable=False)  # cloning, ready, claimed
+    vm_request_id = db.Column(db.Integer, db.ForeignKey('vm_request.id'), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=get_local_time)
+    updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time)
+
+class ProvisioningJob(db.Model):
+    """Job di creazione o dismissione di un container, persistito ed eseguito dai worker in background"""
+    __table_args__ = (
+        db.Index('ix_provisioning_job_status', 'status'),
+        db.Index('ix_provisioning_job_batch', 'batch_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    vm_request_id = db.Column(db.Integer, db.ForeignKey('vm_request.id'), nullable=False)
+    requested_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    batch_id = db.Column(db.String(32), nullable=True)  # approvazioni multiple
+    trace_id = db.Column(db.String(64), nullable=True)  # correlazione con la richiesta di approvazione
+    action = db.Column(db.String(20), default='create', nullable=False)  # create, decommission
+    status = db.Column(db.String(20), default='queued', nullable=False)  # queued, running, completed, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    error_message = db.Column(db.Text, nullable=True)
+    # Processo (host:pid) che ha in coda o esegue il job e scadenza del suo lease, rinnovato finché è vivo
+    owner = db.Column(db.String(64), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=get_local_time)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=get_local_time, onupdate=get_local_time)
+
+    vm_request = db.relationship('VMRequest', backref=db.backref('provisioning_jobs', lazy=True))
+
+    def get_status_display(self):
+        status_names = {
+            'queued': 'In Coda',
+            'running': 'In Esecuzione',
+            'completed': 'Completato',
+            'failed': 'Fallito'
+        }
+        return status_names.get(self.status, self.status.capitalize())
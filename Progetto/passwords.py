@@ -0,0 +1,132 @@
+"""
+Hash e verifica delle password fuori dai thread delle richieste: il lavoro
+CPU-bound di scrypt/pbkdf2 viene eseguito da un pool di processi con un numero
+limitato di operazioni in attesa, così un picco di login non blocca le altre
+pagine. Il metodo di hash è configurabile e gli hash con parametri diversi
+vengono aggiornati al primo login riuscito.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusyError(Exception):
+    """Troppe operazioni di hash in attesa: la richiesta va ritentata più tardi"""
+
+
+def _warmup():
+    return True
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.max_pending = 64
+        self.timeout = 10
+        self.pool_type = 'process'
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._method_prefix = None
+        self._forked = False
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING', self.max_pending)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', self.timeout)
+        self.pool_type = app.config.get('PASSWORD_HASH_POOL', self.pool_type)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._method_prefix = None
+
+    def start(self):
+        """
+        Crea il pool. Va chiamato una sola volta all'import, prima di qualunque thread: con il
+        metodo fork i processi del pool nascono subito. Un processo nato a sua volta da un fork
+        (worker del server WSGI) non crea altri processi e usa un pool di thread.
+        """
+        with self._lock:
+            if self._executor is not None:
+                return
+            if self.pool_type == 'process' and not self._forked and 'fork' in multiprocessing.get_all_start_methods():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('fork')
+                )
+                self._executor.submit(_warmup).result()
+            else:
+                # Senza fork (Windows) un processo figlio reimporterebbe app.py: si usano thread,
+                # hashlib rilascia il GIL durante scrypt e pbkdf2
+                if self.pool_type == 'process' and not self._forked:
+                    logger.info("Start method fork non disponibile: hash delle password in un pool di thread")
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _after_fork(self):
+        # Il pool del padre non è utilizzabile nel figlio (mancano i suoi thread di gestione) e
+        # rifare il fork da un thread delle richieste non è sicuro: il figlio passa a un pool di thread
+        started = self._executor is not None
+        self._executor = None
+        self._forked = True
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        if started:
+            self.start()
+
+    def _run(self, func, *args):
+        executor = self._executor
+        if executor is None:
+            raise RuntimeError("Pool di hash delle password non avviato")
+        slots = self._slots
+        if not slots.acquire(timeout=self.timeout):
+            raise HasherBusyError("Coda di hash delle password piena")
+        try:
+            future = executor.submit(func, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # Il posto resta occupato finché il worker non ha davvero finito, anche dopo la scadenza
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HasherBusyError("Hash della password non completato entro la scadenza")
+
+    def hash(self, password):
+        with metrics.PASSWORD_HASH_SECONDS.time(operation='hash'):
+            return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        with metrics.PASSWORD_HASH_SECONDS.time(operation='verify'):
+            return self._run(check_password_hash, password_hash, password)
+
+    @property
+    def method_prefix(self):
+        """Metodo con i parametri espliciti (es. scrypt:32768:8:1), come compare all'inizio dell'hash"""
+        if self._method_prefix is None:
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return self._method_prefix
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method_prefix
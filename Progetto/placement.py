@@ -0,0 +1,150 @@
+"""
+Scelta del nodo su cui creare un container in base alle risorse libere
+(CPU, memoria, storage per rootfs) riportate da una singola interrogazione
+di cluster/resources, e dello storage del rootfs sul nodo scelto in base
+allo spazio riportato da nodes/{node}/storage.
+"""
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+DEFAULT_WEIGHTS = {
+    'cpu': 0.4,
+    'memory': 0.4,
+    'disk': 0.2
+}
+
+# Piccolo vantaggio al nodo che ospita già il template, per evitare migrazioni a parità di carico
+PREFERRED_NODE_BONUS = 0.05
+
+# Scelta dello storage del rootfs: quota libera dello storage dopo il posizionamento e spazio
+# libero rispetto al più capiente dei candidati
+DEFAULT_STORAGE_WEIGHTS = {
+    'free_ratio': 0.6,
+    'capacity': 0.4
+}
+
+
+class PlacementScheduler:
+    def __init__(self, tier_requirements, weights=None, storage_weights=None):
+        # Risorse per tier (memoria in MB, disco in GB), da Config.VM_TIER_REQUIREMENTS
+        self.tier_requirements = dict(tier_requirements)
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        self.storage_weights = dict(DEFAULT_STORAGE_WEIGHTS)
+        self.storage_weights.update(storage_weights or {})
+
+    @staticmethod
+    def _rootfs_storages(resources, node):
+        storages = []
+        for res in resources:
+            if res.get('type') != 'storage' or res.get('node') != node:
+                continue
+            if res.get('status', 'available') != 'available':
+                continue
+            content = res.get('content')
+            if content is not None and 'rootdir' not in content:
+                continue
+            storages.append(res)
+        return storages
+
+    def score_node(self, resources, node_res, tier):
+        """
+        Restituisce il punteggio del nodo (frazione di risorse libere dopo il
+        posizionamento, pesata) oppure None se il nodo non può ospitare il tier.
+        """
+        if node_res.get('status') != 'online':
+            return None
+
+        req = self.requirements(tier)
+        node = node_res['node']
+
+        maxcpu = node_res.get('maxcpu') or 0
+        maxmem = node_res.get('maxmem') or 0
+        if not maxcpu or not maxmem:
+            return None
+
+        cpu_free = (maxcpu * (1 - (node_res.get('cpu') or 0)) - req['cores']) / maxcpu
+        mem_free = (maxmem - (node_res.get('mem') or 0) - req['memory'] * MB) / maxmem
+
+        disk_free = None
+        for storage in self._rootfs_storages(resources, node):
+            total = storage.get('maxdisk') or 0
+            if not total:
+                continue
+            free = (total - (storage.get('disk') or 0) - req['disk'] * GB) / total
+            if disk_free is None or free > disk_free:
+                disk_free = free
+
+        if disk_free is None:
+            return None
+        if cpu_free < 0 or mem_free < 0 or disk_free < 0:
+            return None
+
+        return (
+            self.weights['cpu'] * cpu_free
+            + self.weights['memory'] * mem_free
+            + self.weights['disk'] * disk_free
+        )
+
+    def rank_nodes(self, resources, tier, preferred=None):
+        """Nodi idonei ordinati dal migliore al peggiore: lista di (punteggio, nodo)"""
+        ranking = []
+        for res in resources:
+            if res.get('type') != 'node':
+                continue
+            score = self.score_node(resources, res, tier)
+            if score is None:
+                continue
+            if res['node'] == preferred:
+                score += PREFERRED_NODE_BONUS
+            ranking.append((score, res['node']))
+        ranking.sort(key=lambda item: item[0], reverse=True)
+        return ranking
+
+    def choose_node(self, resources, tier, preferred=None):
+        ranking = self.rank_nodes(resources, tier, preferred=preferred)
+        return ranking[0][1] if ranking else None
+
+    def requirements(self, tier):
+        try:
+            return self.tier_requirements[tier]
+        except KeyError:
+            raise ValueError(f"Tier senza requisiti di risorse: {tier}") from None
+
+    def disk_requirement(self, tier):
+        """Disco (GB) richiesto dal rootfs di un container del tier"""
+        return self.requirements(tier)['disk']
+
+    def rank_storages(self, storages, disk_gb=0):
+        """
+        Storage adatti a un rootfs di disk_gb GB (attivi, con content rootdir e spazio
+        sufficiente) ordinati dal migliore: lista di (punteggio, storage).
+        storages è la risposta di nodes/{node}/storage (campi total, used, avail).
+        """
+        required = disk_gb * GB
+        candidates = []
+        for storage in storages:
+            if not int(storage.get('active', 1)) or not int(storage.get('enabled', 1)):
+                continue
+            if 'rootdir' not in (storage.get('content') or ''):
+                continue
+            total = storage.get('total') or 0
+            if not total:
+                continue
+            avail = storage.get('avail')
+            if avail is None:
+                avail = total - (storage.get('used') or 0)
+            if avail - required < 0:
+                continue
+            candidates.append((avail - required, total, storage))
+
+        if not candidates:
+            return []
+        largest = max(free for free, _, _ in candidates) or 1
+        ranking = [
+            (self.storage_weights['free_ratio'] * free / total + self.storage_weights['capacity'] * free / largest, storage)
+            for free, total, storage in candidates
+        ]
+        ranking.sort(key=lambda item: item[0], reverse=True)
+        return ranking
@@ -0,0 +1,120 @@
+"""
+Eventi di avanzamento del provisioning per singola richiesta, pubblicati dai
+worker e dai servizi in background e inoltrati alle pagine aperte tramite
+Server-Sent Events.
+
+Il broker vive in memoria nel processo dell'applicazione: con più processi
+ognuno vede solo gli eventi generati al proprio interno.
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+# Eventi dopo i quali la richiesta non cambia più senza un'azione dell'utente
+TERMINAL_EVENTS = {'failed', 'ip_acquired', 'ip_unavailable', 'decommissioned', 'decommission_failed'}
+
+
+class Subscription:
+    def __init__(self, broker, request_id):
+        self.broker = broker
+        self.request_id = request_id
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """Prossimo evento oppure None se entro il timeout non arriva nulla"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class ProgressBroker:
+    def __init__(self, history=50, retention=900):
+        self.history = history
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._events = {}
+        self._subscribers = {}
+        self._listeners = []
+
+    def publish(self, request_id, event, **data):
+        with self._lock:
+            self._sequence += 1
+            record = {
+                'id': self._sequence,
+                'event': event,
+                'data': data,
+                'time': time.time()
+            }
+            self._events.setdefault(request_id, deque(maxlen=self.history)).append(record)
+            subscribers = list(self._subscribers.get(request_id, ()))
+            self._prune(record['time'])
+        for subscription in subscribers:
+            subscription.queue.put(record)
+        for listener in self._listeners:
+            listener(request_id, record)
+        return record
+
+    def add_listener(self, callback):
+        """Registra callback(request_id, evento) chiamata per ogni evento di ogni richiesta"""
+        self._listeners.append(callback)
+
+    def subscribe(self, request_id, last_event_id=None):
+        """
+        Registra un nuovo ascoltatore. Se last_event_id è indicato (riconnessione
+        del browser) gli eventi successivi ancora in memoria vengono riaccodati.
+        """
+        subscription = Subscription(self, request_id)
+        with self._lock:
+            self._subscribers.setdefault(request_id, set()).add(subscription)
+            if last_event_id is not None:
+                for record in self._events.get(request_id, ()):
+                    if record['id'] > last_event_id:
+                        subscription.queue.put(record)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.request_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.request_id]
+
+    def recent(self, request_id):
+        with self._lock:
+            return list(self._events.get(request_id, ()))
+
+    def _prune(self, now):
+        # Chiamato con il lock già acquisito: elimina le storie delle richieste ferme da tempo
+        expired = [
+            request_id for request_id, events in self._events.items()
+            if events and now - events[-1]['time'] > self.retention and request_id not in self._subscribers
+        ]
+        for request_id in expired:
+            del self._events[request_id]
+
+
+def format_sse(record=None, event=None, data=None, retry=None):
+    """Serializza un evento nel formato text/event-stream"""
+    lines = []
+    if retry is not None:
+        lines.append(f"retry: {retry}")
+    if record is not None:
+        lines.append(f"id: {record['id']}")
+        event = record['event']
+        data = record['data']
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data or {})}")
+    return '\n'.join(lines) + '\n\n'
+
+
+progress_broker = ProgressBroker()
@@ -0,0 +1,419 @@
+"""
+Coda di provisioning asincrona: le approvazioni creano un ProvisioningJob
+persistito che viene eseguito da un pool limitato di worker in background,
+così la richiesta HTTP dell'amministratore ritorna subito. Con la stessa coda
+vengono eseguite le dismissioni (arresto e distruzione dei container).
+
+Ogni job appartiene al processo che lo ha in coda o lo esegue (owner) finché
+il suo lease viene rinnovato; solo i job con il lease scaduto, cioè rimasti a
+un processo terminato, vengono ripresi da un altro processo.
+"""
+
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy import or_
+
+from background import process_owner
+from models import db, VMRequest, ProvisioningJob, get_local_time
+from progress import progress_broker
+from metrics import PROVISIONING_SECONDS, PROVISIONING_QUEUE_SECONDS, IP_DISCOVERY_ATTEMPTS, DECOMMISSION_SECONDS
+from tracing import trace, span, current_trace_id
+from vmid_allocator import VMIDAllocator
+
+logger = logging.getLogger(__name__)
+
+REJECTION_REASON = "Impossibile creare il container a causa di problemi tecnici. Contattare l'amministratore per maggiori informazioni."
+
+
+def send_credentials(vm_request):
+    """Invia le credenziali all'utente"""
+    pass
+
+
+class ProvisioningQueue:
+    def __init__(self, app=None, proxmox_api=None, max_workers=4):
+        self.app = None
+        self.proxmox_api = None
+        self.max_workers = max_workers
+        self.lease_ttl = 60
+        self._executor = None
+        self.vmid_allocator = None
+        # Impostato dall'applicazione se il warm pool è configurato
+        self.warm_pool = None
+        if app is not None:
+            self.init_app(app, proxmox_api)
+
+    def init_app(self, app, proxmox_api):
+        self.app = app
+        self.proxmox_api = proxmox_api
+        self.max_workers = app.config.get('PROVISIONING_WORKERS', self.max_workers)
+        self.lease_ttl = app.config.get('BACKGROUND_LEASE_TTL', self.lease_ttl)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='provisioning'
+        )
+        self.vmid_allocator = VMIDAllocator(
+            proxmox_api,
+            start=app.config['VMID_RANGE_START'],
+            end=app.config['VMID_RANGE_END'],
+            block_size=app.config['VMID_BLOCK_SIZE']
+        )
+
+    def enqueue(self, vm_request, requested_by):
+        """
+        Porta la richiesta da 'pending' a 'provisioning' e crea il job.
+        Restituisce None se la richiesta è già stata processata da qualcun altro.
+        """
+        claimed = VMRequest.query.filter_by(id=vm_request.id, status='pending').update(
+            {'status': 'provisioning'}, synchronize_session=False
+        )
+        if not claimed:
+            db.session.rollback()
+            return None
+
+        job = ProvisioningJob(
+            vm_request_id=vm_request.id, requested_by=requested_by, trace_id=current_trace_id(), **self._lease()
+        )
+        db.session.add(job)
+        db.session.commit()
+
+        progress_broker.publish(vm_request.id, 'queued', job_id=job.id)
+        self.submit(job.id)
+        return job
+
+    def enqueue_many(self, request_ids, requested_by):
+        """
+        Approva più richieste in un'unica transazione.
+        Restituisce (batch_id, esiti) dove esiti associa a ogni id il job creato oppure None.
+        """
+        return self._enqueue_batch(request_ids, requested_by, 'pending', 'provisioning', 'create', 'queued')
+
+    def enqueue_decommission(self, request_ids, requested_by):
+        """
+        Mette in coda la dismissione dei container approvati (arresto e distruzione).
+        Restituisce (batch_id, esiti) come enqueue_many; le richieste non approvate restano invariate.
+        """
+        return self._enqueue_batch(
+            request_ids, requested_by, 'approved', 'decommissioning', 'decommission', 'decommission_queued'
+        )
+
+    def _enqueue_batch(self, request_ids, requested_by, from_status, to_status, action, event):
+        batch_id = uuid.uuid4().hex
+        outcomes = {}
+        jobs = []
+        for request_id in request_ids:
+            claimed = VMRequest.query.filter_by(id=request_id, status=from_status).update(
+                {'status': to_status}, synchronize_session=False
+            )
+            if not claimed:
+                outcomes[request_id] = None
+                continue
+            job = ProvisioningJob(
+                vm_request_id=request_id,
+                requested_by=requested_by,
+                batch_id=batch_id,
+                trace_id=current_trace_id(),
+                action=action,
+                **self._lease()
+            )
+            db.session.add(job)
+            jobs.append(job)
+            outcomes[request_id] = job
+        db.session.commit()
+
+        for job in jobs:
+            progress_broker.publish(job.vm_request_id, event, job_id=job.id, batch_id=batch_id)
+            self.submit(job.id)
+        return batch_id, outcomes
+
+    def submit(self, job_id):
+        self._executor.submit(self._run, job_id)
+
+    def _lease(self):
+        return {'owner': process_owner(), 'lease_expires_at': get_local_time() + timedelta(seconds=self.lease_ttl)}
+
+    def renew_leases(self):
+        """Proroga il lease dei job in coda o in esecuzione in questo processo"""
+        ProvisioningJob.query.filter(
+            ProvisioningJob.owner == process_owner(),
+            ProvisioningJob.status.in_(['queued', 'running'])
+        ).update({'lease_expires_at': self._lease()['lease_expires_at']}, synchronize_session=False)
+        db.session.commit()
+
+    def resume_pending(self):
+        """
+        Rimette in coda in questo processo i job rimasti a un processo terminato (lease scaduto).
+        Ogni job viene preso con un UPDATE condizionato: più processi possono chiamarlo insieme,
+        e i job di un processo ancora vivo non vengono toccati.
+        """
+        orphaned = (
+            ProvisioningJob.status.in_(['queued', 'running']),
+            or_(ProvisioningJob.lease_expires_at.is_(None), ProvisioningJob.lease_expires_at < get_local_time())
+        )
+        candidates = [row.id for row in db.session.query(ProvisioningJob.id).filter(*orphaned)]
+        resumed = []
+        for job_id in candidates:
+            adopted = ProvisioningJob.query.filter(ProvisioningJob.id == job_id, *orphaned).update(
+                dict(self._lease(), status='queued'), synchronize_session=False
+            )
+            if adopted:
+                resumed.append(job_id)
+        db.session.commit()
+
+        for job_id in resumed:
+            logger.info("Ripreso il job %s rimasto a un processo terminato", job_id)
+            self.submit(job_id)
+        return len(resumed)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            job_trace = db.session.query(ProvisioningJob.trace_id).filter_by(id=job_id).scalar()
+            # Il worker prosegue la traccia della richiesta di approvazione
+            with trace(job_trace):
+                claimed = ProvisioningJob.query.filter_by(id=job_id, status='queued', owner=process_owner()).update(
+                    {
+                        'status': 'running',
+                        'started_at': get_local_time(),
+                        'attempts': ProvisioningJob.attempts + 1
+                    },
+                    synchronize_session=False
+                )
+                db.session.commit()
+                if not claimed:
+                    return
+
+                job = db.session.get(ProvisioningJob, job_id)
+                try:
+                    if job.action == 'decommission':
+                        self._run_decommission(job)
+                    else:
+                        self._run_create(job)
+                finally:
+                    db.session.remove()
+
+    def _run_create(self, job):
+        job_id = job.id
+        tier = job.vm_request.vm_type
+        if job.created_at and job.started_at:
+            PROVISIONING_QUEUE_SECONDS.observe((job.started_at - job.created_at).total_seconds(), tier=tier)
+        progress_broker.publish(job.vm_request_id, 'started', job_id=job.id, attempt=job.attempts)
+        start = time.perf_counter()
+        with span('provisioning.job', kind='task', job_id=job_id, vm_request_id=job.vm_request_id, tier=tier) as job_span:
+            try:
+                self._provision(job)
+            except Exception as e:
+                logger.exception("Errore nel job di creazione %s: %s", job_id, e)
+                db.session.rollback()
+                job = db.session.get(ProvisioningJob, job_id)
+                self._reject(job, str(e))
+            finally:
+                outcome = 'ok' if job.status == 'completed' else 'error'
+                job_span.set(outcome=outcome)
+                PROVISIONING_SECONDS.observe(time.perf_counter() - start, tier=tier, outcome=outcome)
+
+    def _run_decommission(self, job):
+        job_id = job.id
+        progress_broker.publish(job.vm_request_id, 'decommission_started', job_id=job.id, attempt=job.attempts)
+        start = time.perf_counter()
+        with span('decommission.job', kind='task', job_id=job_id, vm_request_id=job.vm_request_id) as job_span:
+            try:
+                self._decommission(job)
+            except Exception as e:
+                logger.exception("Errore nel job di dismissione %s: %s", job_id, e)
+                db.session.rollback()
+                job = db.session.get(ProvisioningJob, job_id)
+                self._decommission_failed(job, str(e))
+            finally:
+                outcome = 'ok' if job.status == 'completed' else 'error'
+                job_span.set(outcome=outcome)
+                DECOMMISSION_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+
+    def _start_warm(self, vm_request, progress):
+        """Avvia un container del warm pool; None se il pool è vuoto o il container non parte"""
+        warm = self.warm_pool.claim(vm_request.vm_type, vm_request.id)
+        if warm is None:
+            return None, None
+        progress('warm_claimed', vmid=warm.vmid, node=warm.node)
+        result = self.proxmox_api.start_prepared_vm(warm.node, warm.vmid, vm_request.vm_name, progress=progress)
+        if not result['success']:
+            logger.warning("Container %s del warm pool non avviato, si procede con un clone: %s", warm.vmid, result.get('error'))
+            self.warm_pool.discard(warm)
+            return None, None
+        return warm, result
+
+    def _resume_clone(self, vm_request, vmid, progress):
+        """
+        Job ripreso dopo un riavvio con il VMID già prenotato. Se il container esiste il clone
+        era partito prima dell'interruzione: viene adottato (hostname e avvio) oppure, se non
+        parte, distrutto per clonare di nuovo con lo stesso VMID.
+        Restituisce il risultato dell'avvio, oppure None se serve un nuovo clone.
+        """
+        node = self.proxmox_api.locate_guest(None, vmid)
+        if node is None:
+            return None
+        progress('clone_resumed', vmid=vmid, node=node)
+        result = self.proxmox_api.start_prepared_vm(node, vmid, vm_request.vm_name, progress=progress)
+        if result['success']:
+            return result
+
+        logger.warning("Container %s del clone interrotto non avviato, viene distrutto: %s", vmid, result.get('error'))
+        destroyed = self.proxmox_api.destroy_vm(node, vmid)
+        if not destroyed['success']:
+            # Il VMID resta prenotato: il container esiste ancora e non deve essere riassegnato
+            raise RuntimeError(f"Container {vmid} di un clone interrotto non distrutto: {destroyed.get('error')}")
+        return None
+
+    def _provision(self, job):
+        vm_request = job.vm_request
+        template = self.app.config['VM_TEMPLATES'][vm_request.vm_type]
+
+        def progress(event, **data):
+            progress_broker.publish(vm_request.id, event, **data)
+
+        warm, result = None, None
+        if self.warm_pool is not None and self.warm_pool.enabled:
+            warm, result = self._start_warm(vm_request, progress)
+
+        if warm is not None:
+            vmid = warm.vmid
+            vm_request.clone_strategy = warm.clone_strategy
+            # Il container ora appartiene alla richiesta: esce dal pool con il commit finale
+            db.session.delete(warm)
+        else:
+            resumed = self.vmid_allocator.reserved_for(vm_request.id)
+            vmid = self.vmid_allocator.claim(vm_request.id)
+            progress_broker.publish(vm_request.id, 'vmid_allocated', vmid=vmid)
+
+            if resumed is not None:
+                result = self._resume_clone(vm_request, vmid, progress)
+            if result is None:
+                result = self.proxmox_api.create_vm(
+                    vm_name=vm_request.vm_name,
+                    vm_type=vm_request.vm_type,
+                    template=template,
+                    vmid=vmid,
+                    progress=progress
+                )
+
+            if not result['success']:
+                self._discard_clone(vmid)
+                self._reject(job, result.get('error', 'Errore sconosciuto'))
+                return
+
+            self.vmid_allocator.mark_in_use(vmid)
+            vm_request.clone_strategy = result.get('clone_strategy')
+
+        vm_request.status = 'approved'
+        vm_request.vm_id = result.get('vmid')
+        vm_request.node = result.get('node')
+        vm_request.approved_by = job.requested_by
+        vm_request.approved_at = get_local_time()
+
+        credentials = self.proxmox_api.generate_credentials(
+            vm_request.vm_name,
+            node=vm_request.node,
+            vmid=result.get('vmid')
+        )
+        vm_request.hostname = credentials['hostname']
+        ip_address = credentials['ip_address']
+        if not ip_address or ip_address == "IP non disponibile" or ip_address.startswith("Verificare"):
+            ip_address = None
+        vm_request.ip_address = ip_address
+        vm_request.username = credentials['username']
+        vm_request.password = credentials['password']
+        vm_request.ssh_key = ''
+
+        job.status = 'completed'
+        job.finished_at = get_local_time()
+        db.session.commit()
+
+        progress_broker.publish(
+            vm_request.id, 'completed',
+            vmid=vm_request.vm_id, node=vm_request.node, hostname=vm_request.hostname
+        )
+        if ip_address:
+            IP_DISCOVERY_ATTEMPTS.observe(1, outcome='found')
+            progress_broker.publish(vm_request.id, 'ip_acquired', ip_address=ip_address)
+
+        send_credentials(vm_request)
+
+    def _discard_clone(self, vmid):
+        """
+        Distrugge il container lasciato da un clone fallito e libera il VMID solo quando il
+        container non esiste più: un task già partito (scadenza, errore dopo l'UPID) può averlo
+        creato. Se la distruzione non riesce il VMID resta prenotato e lo riprova il reconciler.
+        """
+        result = self.proxmox_api.destroy_vm(None, vmid)
+        if not result['success']:
+            logger.warning("Container %s del clone fallito non distrutto, il VMID resta prenotato: %s",
+                           vmid, result.get('error'))
+            return False
+        self.vmid_allocator.release(vmid)
+        return True
+
+    def _decommission(self, job):
+        vm_request = job.vm_request
+        vmid = vm_request.vm_id
+        if vmid:
+            result = self.proxmox_api.destroy_vm(
+                vm_request.node, vmid,
+                progress=lambda event, **data: progress_broker.publish(vm_request.id, event, **data)
+            )
+            if not result['success']:
+                self._decommission_failed(job, result.get('error', 'Errore sconosciuto'))
+                return
+            # Il VMID torna libero solo se il container non compare più nel cluster
+            if self.proxmox_api.locate_guest(result.get('node'), vmid) is not None:
+                self._decommission_failed(job, f"Container {vmid} ancora presente dopo la distruzione")
+                return
+
+        # Richiesta, VMID e job cambiano nella stessa transazione
+        now = get_local_time()
+        VMRequest.query.filter_by(id=vm_request.id, status='decommissioning').update({
+            'status': 'decommissioned',
+            'decommissioned_by': job.requested_by,
+            'decommissioned_at': now,
+            'vm_status': None,
+            'ip_next_check_at': None,
+            'password': None,
+            'ssh_key': None,
+            'updated_at': now
+        }, synchronize_session=False)
+        if vmid:
+            self.vmid_allocator.release(vmid)
+        job.status = 'completed'
+        job.finished_at = now
+        db.session.commit()
+
+        progress_broker.publish(vm_request.id, 'decommissioned', vmid=vmid)
+
+    def _decommission_failed(self, job, error_message):
+        # Il container (o parte di esso) esiste ancora: la richiesta torna approvata e può essere ritentata
+        VMRequest.query.filter_by(id=job.vm_request_id, status='decommissioning').update(
+            {'status': 'approved', 'error_message': error_message}, synchronize_session=False
+        )
+        job.status = 'failed'
+        job.error_message = error_message
+        job.finished_at = get_local_time()
+        db.session.commit()
+
+        progress_broker.publish(job.vm_request_id, 'decommission_failed')
+
+    def _reject(self, job, error_message):
+        vm_request = job.vm_request
+        vm_request.status = 'rejected'
+        vm_request.rejected_by = job.requested_by
+        vm_request.rejected_at = get_local_time()
+        vm_request.rejection_reason = REJECTION_REASON
+        vm_request.error_message = error_message
+
+        job.status = 'failed'
+        job.error_message = error_message
+        job.finished_at = get_local_time()
+        db.session.commit()
+
+        progress_broker.publish(vm_request.id, 'failed', reason=REJECTION_REASON)
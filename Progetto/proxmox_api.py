@@ -1,90 +1,449 @@
 from proxmoxer import ProxmoxAPI as ProxmoxAPIClient
+from proxmoxer import AuthenticationError, ResourceException
+from config import Config
+from placement import PlacementScheduler
+from metrics import INVENTORY_CACHE_LOOKUPS, PROXMOX_REQUEST_SECONDS, proxmox_operation
+from tracing import span, traced
+import logging
 import random
+import re
 import string
-import ipaddress
-import subprocess
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class ProxmoxTaskError(Exception):
+    """Task ProxMox terminato con errore o non completato entro la scadenza"""
+
+    def __init__(self, upid, message):
+        super().__init__(message)
+        self.upid = upid
+
+
+class CloneRejectedError(Exception):
+    """Richiesta di clone rifiutata da ProxMox prima che esistesse un task (nessun container creato)"""
+
+
+class ProxmoxClientPool:
+    """
+    Pool thread-safe di client proxmoxer. Ogni client mantiene la propria sessione
+    HTTP keep-alive; con autenticazione a password il ticket viene rinnovato prima
+    della scadenza (2 ore) e un 401 provoca una nuova autenticazione e un solo retry.
+    Con un token API non serve il login.
+    """
+    # Età (secondi) oltre la quale il ticket viene rinnovato, sotto la scadenza di 2 ore
+    TICKET_RENEW_AGE = 5400
+
+    def __init__(self, host, user, password=None, token_name=None, token_value=None, verify_ssl=False,
+                 size=8, timeout=10):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.token_name = token_name
+        self.token_value = token_value
+        self.verify_ssl = verify_ssl
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _new_client(self):
+        if self.token_name:
+            client = ProxmoxAPIClient(
+                self.host,
+                user=self.user,
+                token_name=self.token_name,
+                token_value=self.token_value,
+                verify_ssl=self.verify_ssl,
+                timeout=self.timeout
+            )
+        else:
+            # Con la password il costruttore esegue il login per ottenere il ticket
+            with PROXMOX_REQUEST_SECONDS.time(operation='access.ticket.post'):
+                client = ProxmoxAPIClient(
+                    self.host,
+                    user=self.user,
+                    password=self.password,
+                    verify_ssl=self.verify_ssl,
+                    timeout=self.timeout
+                )
+        return {'client': client, 'born': time.monotonic()}
+
+    def connect(self):
+        """Crea il primo client, verificando host e credenziali"""
+        self._idle.put(self._new_client())
+
+    def _checkout(self):
+        try:
+            entry = self._idle.get_nowait()
+        except queue.Empty:
+            return self._new_client()
+        if not self.token_name and time.monotonic() - entry['born'] >= self.TICKET_RENEW_AGE:
+            return self._new_client()
+        return entry
+
+    def _discard_older(self, born):
+        """Scarta i client inattivi con un ticket ottenuto non dopo quello appena rifiutato"""
+        keep = []
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if entry['born'] > born:
+                keep.append(entry)
+        for entry in reversed(keep):
+            self._idle.put(entry)
+
+    @staticmethod
+    def _is_auth_error(error):
+        return isinstance(error, AuthenticationError) or (
+            isinstance(error, ResourceException) and error.status_code == 401
+        )
+
+    def request(self, path, method, params):
+        operation = proxmox_operation(path, method)
+        with self._slots:
+            entry = self._checkout()
+            for attempt in range(2):
+                try:
+                    with span(f'proxmox.{operation}', path=path), PROXMOX_REQUEST_SECONDS.time(operation=operation):
+                        result = getattr(entry['client'](path), method)(**params)
+                except Exception as e:
+                    if attempt == 0 and self._is_auth_error(e):
+                        # Sessione scaduta: il client viene scartato con gli inattivi più vecchi
+                        # (ticket altrettanto scaduti) e il retry usa un nuovo login
+                        self._discard_older(entry['born'])
+                        entry = self._new_client()
+                        continue
+                    self._idle.put(entry)
+                    raise
+                self._idle.put(entry)
+                return result
+
+
+class PooledResource:
+    """
+    Risorsa ProxMox che costruisce il percorso come proxmoxer (api.nodes(node).lxc.get())
+    ma esegue ogni chiamata con un client preso dal pool.
+    """
+
+    def __init__(self, pool, path=()):
+        self._pool = pool
+        self._path = path
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return PooledResource(self._pool, self._path + (item,))
+
+    def __call__(self, resource_id=None):
+        if resource_id in (None, ''):
+            return self
+        return PooledResource(self._pool, self._path + tuple(str(resource_id).split('/')))
+
+    def _request(self, method, params):
+        return self._pool.request('/'.join(self._path), method, params)
+
+    def get(self, **params):
+        return self._request('get', params)
+
+    def post(self, **data):
+        return self._request('post', data)
+
+    def put(self, **data):
+        return self._request('put', data)
+
+    def delete(self, **params):
+        return self._request('delete', params)
+
+
+class InventoryCache:
+    """
+    Cache con TTL dell'inventario del cluster (nodi, container per nodo, storage per nodo).
+    Le chiavi sono tuple (tipo, nodo); richieste concorrenti per la stessa chiave
+    scaduta eseguono una sola chiamata verso ProxMox. Hit e miss per tipo sono
+    esportati su /metrics (proxmox_inventory_cache_lookups_total).
+    """
+    DEFAULT_TTLS = {
+        'nodes': 60,
+        'lxc': 15,
+        'storage': 15,
+        'resources': 5,
+        'template_storage': 300
+    }
+
+    def __init__(self, ttls=None):
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                INVENTORY_CACHE_LOOKUPS.inc(kind=key[0], result='hit')
+                return entry[1]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Un altro thread potrebbe aver già ricaricato la chiave nel frattempo
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > time.monotonic():
+                    INVENTORY_CACHE_LOOKUPS.inc(kind=key[0], result='hit')
+                    return entry[1]
+            INVENTORY_CACHE_LOOKUPS.inc(kind=key[0], result='miss')
+
+            value = loader()
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttls.get(key[0], 30), value)
+            return value
+
+    def invalidate(self, kind=None, node=None):
+        """Invalida le voci che corrispondono a tipo e/o nodo (tutte se non specificati)"""
+        with self._lock:
+            for key in list(self._entries):
+                if kind is not None and key[0] != kind:
+                    continue
+                if node is not None and (len(key) < 2 or key[1] != node):
+                    continue
+                del self._entries[key]
+
+
+class TemplateIndex:
+    """
+    Indice dei template LXC (template=1) di un nodo, per vmid e per nome normalizzato.
+    Viene aggiornato in modo incrementale solo quando cambia la lista dei container in cache.
+    """
+
+    def __init__(self):
+        self.by_vmid = {}
+        self.by_name = {}
+        self._source = None
+
+    @staticmethod
+    def normalize(name):
+        return (name or '').strip().lower()
+
+    def refresh(self, containers):
+        if containers is self._source:
+            return
+
+        seen = set()
+        for container in containers:
+            if not int(container.get('template') or 0):
+                continue
+            vmid = int(container['vmid'])
+            name = self.normalize(container.get('name'))
+            seen.add(vmid)
+
+            previous = self.by_vmid.get(vmid)
+            if previous == name:
+                continue
+            if previous and self.by_name.get(previous) == vmid:
+                del self.by_name[previous]
+            self.by_vmid[vmid] = name
+            if name:
+                self.by_name[name] = vmid
+
+        for vmid in set(self.by_vmid) - seen:
+            name = self.by_vmid.pop(vmid)
+            if self.by_name.get(name) == vmid:
+                del self.by_name[name]
+
+        self._source = containers
+
+    def lookup(self, template_name):
+        """Cerca per vmid, poi per nome esatto, infine per corrispondenza parziale del nome"""
+        key = self.normalize(str(template_name))
+        if key.isdigit() and int(key) in self.by_vmid:
+            return int(key)
+        if key in self.by_name:
+            return self.by_name[key]
+        for name, vmid in self.by_name.items():
+            if key and key in name:
+                return vmid
+        return None
+
+
+# Tipi di storage su cui ProxMox crea linked clone dei container (snapshot/clone del volume base)
+LINKED_CLONE_STORAGE_TYPES = {'zfspool', 'lvmthin', 'rbd', 'btrfs'}
+CLONE_STRATEGIES = ('auto', 'linked', 'full')
+
 
 class ProxmoxAPI:
-    def __init__(self, host, user, password, verify_ssl=False):
+    def __init__(self, host, user, password, verify_ssl=False, task_timeout=600, inventory_ttls=None,
+                 tier_requirements=None, node_concurrency=2, token_name=None, token_value=None, pool_size=8,
+                 clone_strategy='auto'):
         self.host = host
         self.user = user
         self.password = password
         self.verify_ssl = verify_ssl
+        self.pool = ProxmoxClientPool(
+            host,
+            user,
+            password=password,
+            token_name=token_name,
+            token_value=token_value,
+            verify_ssl=verify_ssl,
+            size=pool_size
+        )
+        self.task_timeout = task_timeout
+        self.inventory = InventoryCache(inventory_ttls)
+        self._template_indexes = {}
+        self._template_lock = threading.Lock()
+        self.scheduler = PlacementScheduler(
+            tier_requirements if tier_requirements is not None else Config.VM_TIER_REQUIREMENTS
+        )
+        self.node_concurrency = node_concurrency
+        if clone_strategy not in CLONE_STRATEGIES:
+            raise ValueError(f"Strategia di clone non valida: {clone_strategy} (ammesse: {', '.join(CLONE_STRATEGIES)})")
+        self.clone_strategy = clone_strategy
+        self._node_slots = {}
+        self._node_slots_lock = threading.Lock()
         self.api = None
         self._connect()
     
     def _connect(self):
         try:
-            self.api = ProxmoxAPIClient(
-                self.host,
-                user=self.user,
-                password=self.password,
-                verify_ssl=self.verify_ssl
-            )
+            self.pool.connect()
+            self.api = PooledResource(self.pool)
         except Exception as e:
-            
-            pass
+            logger.error("Impossibile connettersi a ProxMox (%s): %s", self.host, e)
     
-    def get_available_storage(self, node, storage_type='zfspool'):
-        """Ottiene lo storage disponibile per ZFS"""
-        try:
-            if not self.api:
-                self._connect()
-            
-
-            storages = self.api.nodes(node).storage.get()
-            
-            print(f"Storage disponibili sul nodo {node}:")
-            for storage in storages:
-                storage_name = storage.get('storage', 'N/A')
-                storage_type_info = storage.get('type', 'N/A')
-                content = storage.get('content', '')
-                print(f"  - {storage_name} (tipo: {storage_type_info}, content: {content})")
-            
-
-            for storage in storages:
-                storage_type_info = storage.get('type', '')
-                if storage_type_info == storage_type or storage_type_info == 'zfspool':
-                    storage_name = storage.get('storage')
-                    print(f"Storage ZFS trovato per tipo: {storage_name} (tipo: {storage_type_info})")
-                    return storage_name
-            
-            for storage in storages:
-                storage_name = storage.get('storage', '')
-                if storage_name and 'zfs' in storage_name.lower():
-                    print(f"Storage ZFS trovato per nome: {storage_name}")
-                    return storage_name
-            
-
-            for storage in storages:
-                storage_name = storage.get('storage', '')
-                if storage_name and storage_name.lower() in ['localzfs', 'local-zfs']:
-                    print(f"Storage trovato (localzfs): {storage_name}")
-                    return storage_name
+    def get_nodes(self):
+        """Lista dei nodi del cluster (da cache)"""
+        if not self.api:
+            self._connect()
+        return self.inventory.get(('nodes',), lambda: self.api.nodes.get())
+    
+    def get_containers(self, node):
+        """Lista dei container LXC del nodo (da cache)"""
+        if not self.api:
+            self._connect()
+        return self.inventory.get(('lxc', node), lambda: self.api.nodes(node).lxc.get())
+    
+    def get_storages(self, node):
+        """Lista degli storage del nodo (da cache)"""
+        if not self.api:
+            self._connect()
+        return self.inventory.get(('storage', node), lambda: self.api.nodes(node).storage.get())
+    
+    def get_cluster_resources(self, resource_type=None):
+        """
+        Risorse di nodi, storage e guest del cluster con una sola chiamata a cluster/resources (da cache).
+        resource_type ('vm', 'storage', 'node') limita la risposta a un solo tipo.
+        """
+        if not self.api:
+            self._connect()
+        if resource_type:
+            return self.inventory.get(('resources', resource_type),
+                                      lambda: self.api.cluster.resources.get(type=resource_type))
+        return self.inventory.get(('resources',), lambda: self.api.cluster.resources.get())
+    
+    def invalidate_inventory(self, node=None, kind=None):
+        """Da chiamare dopo operazioni che modificano il cluster (clone, destroy)"""
+        self.inventory.invalidate(kind=kind, node=node)
+    
+    @contextmanager
+    def node_slot(self, node):
+        """Limita il numero di operazioni pesanti (clone, avvio, distruzione) in parallelo sullo stesso nodo"""
+        with self._node_slots_lock:
+            slot = self._node_slots.setdefault(node, threading.BoundedSemaphore(self.node_concurrency))
+        with slot:
+            yield
+    
+    @traced(kind='task', attrs=('node',))
+    def wait_for_task(self, upid, node=None, timeout=None, initial_interval=0.25, max_interval=5, backoff=1.5):
+        """
+        Attende il completamento di un task ProxMox interrogando nodes/{node}/tasks/{upid}/status.
+        L'intervallo di polling cresce in modo esponenziale fino a max_interval;
+        solleva ProxmoxTaskError se il task fallisce o supera la scadenza.
+        """
+        if not node:
+            # Formato UPID:<nodo>:<pid>:<pstart>:<starttime>:<tipo>:<id>:<utente>:
+            node = upid.split(':')[1]
+        timeout = timeout or self.task_timeout
+        deadline = time.monotonic() + timeout
+        interval = initial_interval
+        
+        while True:
+            status = self.api.nodes(node).tasks(upid).status.get()
+            if status.get('status') == 'stopped':
+                exitstatus = status.get('exitstatus', '')
+                if exitstatus != 'OK' and not exitstatus.startswith('WARNINGS'):
+                    raise ProxmoxTaskError(upid, f"Task {status.get('type', upid)} fallito: {exitstatus}")
+                return status
             
-
-            for storage in storages:
-                content = storage.get('content', '')
-                if 'rootdir' in content or 'images' in content:
-                    storage_name = storage.get('storage')
-                    storage_type_info = storage.get('type', '')
-                    if storage_type_info in ['dir', 'zfspool', 'lvm', 'lvmthin']:
-                        print(f"Storage disponibile per container: {storage_name} (tipo: {storage_type_info})")
-                        return storage_name
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProxmoxTaskError(upid, f"Task {status.get('type', upid)} non completato entro {timeout}s")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+    
+    @traced(kind='task', attrs=('node', 'vmid', 'expected'))
+    def wait_for_status(self, node, vmid, expected='running', timeout=60, initial_interval=0.25, max_interval=2, backoff=1.5):
+        """Attende che il container raggiunga lo stato indicato (es. 'running')"""
+        deadline = time.monotonic() + timeout
+        interval = initial_interval
+        
+        while True:
+            status = self.api.nodes(node).lxc(vmid).status.current.get()
+            if status.get('status') == expected:
+                return status
             
-            for storage in storages:
-                if storage.get('storage') == 'local':
-                    print(f"Usando storage fallback: local")
-                    return 'local'
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProxmoxTaskError(None, f"Container {vmid} non in stato '{expected}' entro {timeout}s")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+    
+    def wait_for_unlock(self, node, vmid, timeout=None, initial_interval=0.25, max_interval=5, backoff=1.5):
+        """Attende che il container non sia più bloccato da un task (es. clone ancora in corso) e ne restituisce lo stato"""
+        timeout = timeout or self.task_timeout
+        deadline = time.monotonic() + timeout
+        interval = initial_interval
+        
+        while True:
+            status = self.api.nodes(node).lxc(vmid).status.current.get()
+            if not status.get('lock'):
+                return status
             
-            print("⚠️ Nessuno storage adatto trovato!")
-            return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ProxmoxTaskError(None, f"Container {vmid} ancora bloccato ({status['lock']}) dopo {timeout}s")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_interval)
+    
+    @traced(attrs=('node', 'disk_gb'))
+    def get_available_storage(self, node, disk_gb=0):
+        """
+        Storage del nodo più adatto a un rootfs di disk_gb GB: quello con più spazio libero
+        in proporzione e in assoluto, dall'unica interrogazione (in cache) di nodes/{node}/storage.
+        Restituisce None se nessuno storage ha content rootdir e spazio sufficiente.
+        """
+        try:
+            ranking = self.scheduler.rank_storages(self.get_storages(node), disk_gb)
         except Exception as e:
-            print(f"Errore nell'ottenere lo storage: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Errore nell'ottenere lo storage: %s", e)
+            return None
+        
+        if not ranking:
+            logger.warning("Nessuno storage con spazio sufficiente per %s GB sul nodo %s", disk_gb, node)
             return None
+        logger.debug("Storage per il rootfs sul nodo %s: %s", node,
+                     ', '.join(f"{storage['storage']} ({score:.2f})" for score, storage in ranking))
+        return ranking[0][1]['storage']
     
+    @traced()
     def get_next_vmid(self):
         try:
             if not self.api:
@@ -93,50 +452,193 @@ class ProxmoxAPI:
             cluster = self.api.cluster.nextid.get()
             return int(cluster)
         except Exception as e:
-            print(f"Errore nell'ottenere il prossimo VMID: {e}")
-            return random.randint(100, 999)
+            logger.error("Errore nell'ottenere il prossimo VMID: %s", e)
+            return None
+    
+    def get_template_index(self, node):
+        """Indice dei template del nodo, allineato all'inventario in cache"""
+        containers = self.get_containers(node)
+        with self._template_lock:
+            index = self._template_indexes.setdefault(node, TemplateIndex())
+            index.refresh(containers)
+            return index
     
+    @traced(attrs=('template_name', 'node'))
     def find_template(self, template_name, node):
         try:
-            containers = self.api.nodes(node).lxc.get()
-            
-            if template_name.isdigit():
-                template_id = int(template_name)
-                for container in containers:
-                    if container.get('vmid') == template_id:
-                        vmid = container.get('vmid')
-                        name = container.get('name', 'N/A')
-                        print(f"Template trovato per ID: {vmid} (Nome: {name})")
-                        return vmid
-            
-            for container in containers:
-                name = container.get('name', '')
-                vmid = container.get('vmid')
-                
-                if name and name.lower() == template_name.lower():
-                    print(f"Container trovato per nome: {name} (ID: {vmid})")
-                    return vmid
-                
-                if str(vmid) == template_name:
-                    print(f"Container trovato per ID: {vmid} (Nome: {name})")
-                    return vmid
-            
-            for container in containers:
-                name = container.get('name', '')
-                if name and template_name.lower() in name.lower():
-                    vmid = container.get('vmid')
-                    print(f"Container trovato per corrispondenza parziale: {name} (ID: {vmid})")
-                    return vmid
-            
-            print(f"Template '{template_name}' non trovato")
-            return None
+            template_vmid = self.get_template_index(node).lookup(template_name)
+            if template_vmid is None:
+                logger.info("Template '%s' non trovato sul nodo %s", template_name, node)
+            return template_vmid
         except Exception as e:
-            print(f"Errore nella ricerca del template: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Errore nella ricerca del template: %s", e)
             return None
     
-    def create_vm(self, vm_name, vm_type, template):
+    @traced(attrs=('template',))
+    def locate_template(self, template, nodes):
+        """Cerca il template sui nodi online; restituisce (nodo, vmid) oppure (None, None)"""
+        for n in nodes:
+            if n.get('status', 'online') != 'online':
+                continue
+            try:
+                template_vmid = self.get_template_index(n['node']).lookup(template)
+            except Exception as e:
+                logger.warning("Errore nella ricerca del template sul nodo %s: %s", n['node'], e)
+                continue
+            if template_vmid is not None:
+                return n['node'], template_vmid
+        logger.warning("Template '%s' non trovato", template)
+        return None, None
+    
+    @traced(attrs=('tier', 'template_node'))
+    def choose_node(self, tier, template_node=None):
+        """Nodo con più risorse libere per il tier; in caso di errore resta sul nodo del template"""
+        try:
+            node = self.scheduler.choose_node(self.get_cluster_resources(), tier, preferred=template_node)
+        except Exception as e:
+            logger.error("Errore nella scelta del nodo: %s", e)
+            node = None
+        return node or template_node
+    
+    def get_template_storage(self, template_node, template_vmid):
+        """
+        Storage del rootfs del template (da cache): {'storage', 'type', 'shared'}.
+        Il tipo viene dalla lista degli storage del nodo, la stessa usata da get_available_storage.
+        """
+        def load():
+            rootfs = self.api.nodes(template_node).lxc(template_vmid).config.get().get('rootfs', '')
+            # es. 'local-zfs:base-3335-disk-0,size=8G'
+            name = rootfs.split(',', 1)[0].split(':', 1)[0] if ':' in rootfs else None
+            info = {'storage': name, 'type': None, 'shared': False}
+            for storage in self.get_storages(template_node):
+                if name and storage.get('storage') == name:
+                    info['type'] = storage.get('type')
+                    info['shared'] = bool(int(storage.get('shared') or 0))
+            return info
+        return self.inventory.get(('template_storage', template_node, template_vmid), load)
+    
+    @traced(attrs=('tier', 'template_node'))
+    def plan_clone(self, tier, template_node, template_vmid):
+        """
+        Sceglie nodo e strategia del clone: (nodo, 'linked' o 'full').
+        Il linked clone condivide i blocchi del template ed è quasi immediato, ma richiede uno
+        storage che lo supporti e un nodo di destinazione che veda il volume base (lo stesso
+        nodo del template o uno storage condiviso). Con la strategia 'auto' vince il nodo scelto
+        dallo scheduler; con 'linked' il container resta sul nodo del template se ha posto.
+        """
+        node = self.choose_node(tier, template_node)
+        if self.clone_strategy == 'full':
+            return node, 'full'
+        
+        try:
+            storage = self.get_template_storage(template_node, template_vmid)
+        except Exception as e:
+            logger.warning("Storage del template %s non determinato, clone completo: %s", template_vmid, e)
+            return node, 'full'
+        
+        if storage['type'] not in LINKED_CLONE_STORAGE_TYPES:
+            return node, 'full'
+        if node == template_node or storage['shared']:
+            return node, 'linked'
+        if self.clone_strategy == 'linked':
+            try:
+                ranking = self.scheduler.rank_nodes(self.get_cluster_resources(), tier, preferred=template_node)
+            except Exception as e:
+                logger.warning("Errore nella verifica delle risorse del nodo %s: %s", template_node, e)
+                ranking = []
+            if template_node in (candidate for _, candidate in ranking):
+                return template_node, 'linked'
+        return node, 'full'
+    
+    def _clone_template(self, template_node, template_vmid, node, clone_config, strategy, tier):
+        """
+        Clona con la strategia indicata e restituisce (nodo, strategia usata).
+        Se ProxMox rifiuta subito il linked clone perché lo storage non lo supporta si ripiega
+        sul clone completo, che va sullo storage del nodo con più spazio libero. Ogni altro
+        errore, e qualunque errore dopo l'avvio del task (il container può esistere), si propaga.
+        """
+        if strategy == 'linked':
+            try:
+                return self._clone_to_node(template_node, template_vmid, node, dict(clone_config, full=0)), 'linked'
+            except CloneRejectedError as e:
+                if not self._is_linked_clone_unsupported(e.__cause__):
+                    raise
+                logger.warning("Linked clone del template %s non supportato, clone completo: %s", template_vmid, e)
+        
+        full_config = dict(clone_config, full=1)
+        storage = self.get_available_storage(node, self.scheduler.disk_requirement(tier))
+        if storage:
+            full_config['storage'] = storage
+        try:
+            return self._clone_to_node(template_node, template_vmid, node, full_config), 'full'
+        finally:
+            self.invalidate_inventory(kind='storage')
+    
+    @staticmethod
+    def _is_linked_clone_unsupported(error):
+        return isinstance(error, ResourceException) and re.search(
+            r'linked clone.*not (available|supported)', str(error), re.IGNORECASE
+        ) is not None
+    
+    @traced(kind='task', attrs=('template_node', 'node'))
+    def _clone_to_node(self, template_node, template_vmid, node, clone_config):
+        """
+        Clona il template sul nodo scelto e restituisce il nodo su cui si trova il nuovo container.
+        Se il nodo è diverso da quello del template prova il clone con 'target'
+        (storage condiviso); altrimenti clona in locale e migra il container.
+        """
+        template = self.api.nodes(template_node).lxc(template_vmid)
+        vmid = clone_config['newid']
+        
+        if node != template_node:
+            try:
+                clone_upid = template.clone.post(target=node, **clone_config)
+            except Exception as e:
+                logger.info("Clone diretto su %s non possibile (%s), clone su %s e migrazione", node, e, template_node)
+                clone_upid = None
+            
+            if clone_upid:
+                self.invalidate_inventory(node=node, kind='lxc')
+                self.invalidate_inventory(kind='resources')
+                self.wait_for_task(clone_upid, node=template_node)
+                return node
+        
+        if node != template_node:
+            # Lo storage scelto è quello del nodo di destinazione: in locale si usa quello del template
+            clone_config = {key: value for key, value in clone_config.items() if key != 'storage'}
+        try:
+            clone_upid = template.clone.post(**clone_config)
+        except ResourceException as e:
+            raise CloneRejectedError(f"Clone del template {template_vmid} rifiutato: {e}") from e
+        self.invalidate_inventory(node=template_node, kind='lxc')
+        self.invalidate_inventory(kind='resources')
+        # Il clone è asincrono: finché il task non termina il container resta bloccato
+        self.wait_for_task(clone_upid, node=template_node)
+        
+        if node == template_node:
+            return node
+        
+        try:
+            migrate_upid = self.api.nodes(template_node).lxc(vmid).migrate.post(target=node)
+            self.wait_for_task(migrate_upid, node=template_node)
+        except Exception as e:
+            logger.warning("Migrazione del container %s su %s fallita, resta su %s: %s", vmid, node, template_node, e)
+            return template_node
+        finally:
+            self.invalidate_inventory(node=node, kind='lxc')
+            self.invalidate_inventory(node=template_node, kind='lxc')
+        return node
+    
+    @traced(kind='task', attrs=('vm_name', 'vm_type', 'vmid'))
+    def create_vm(self, vm_name, vm_type, template, vmid=None, progress=None):
+        """
+        Clona il template del tier e avvia il container.
+        progress, se indicato, viene chiamato come progress(evento, **dati) a ogni fase.
+        """
+        def notify(event, **data):
+            if progress:
+                progress(event, **data)
+        
         try:
             if not self.api:
                 self._connect()
@@ -144,76 +646,78 @@ class ProxmoxAPI:
             if not self.api:
                 return {'success': False, 'error': 'Impossibile connettersi a ProxMox'}
             
-            nodes = self.api.nodes.get()
+            nodes = self.get_nodes()
             if not nodes:
                 return {'success': False, 'error': 'Nessun nodo disponibile'}
             
-            node = None
-            for n in nodes:
-                if n.get('node') == 'px1':
-                    node = 'px1'
-                    break
-            
-            if not node:
-                node = nodes[0]['node']
-            
-            print(f"Usando nodo: {node}")
-            
-            vmid = self.get_next_vmid()
-            template_vmid = self.find_template(template, node)
+            template_node, template_vmid = self.locate_template(template, nodes)
             
             if template_vmid:
+                node, strategy = self.plan_clone(vm_type, template_node, template_vmid)
+                logger.info("Usando nodo: %s (clone %s)", node, strategy)
+                
+                vmid = vmid or self.get_next_vmid()
+                if not vmid:
+                    return {'success': False, 'error': 'Impossibile ottenere un VMID libero'}
                 clone_success = False
                 container_created = False
                 try:
                     clone_config = {
                         'newid': vmid,
-                        'hostname': vm_name,
-                        'full': 1
+                        'hostname': vm_name
                     }
                     
-                    clone_result = self.api.nodes(node).lxc(template_vmid).clone.post(**clone_config)
+                    notify('clone_started', vmid=vmid, node=node, template=template, strategy=strategy)
+                    with self.node_slot(template_node):
+                        node, strategy = self._clone_template(template_node, template_vmid, node, clone_config, strategy, vm_type)
                     clone_success = True
                     container_created = True
+                    notify('clone_finished', vmid=vmid, node=node)
                     
-                    import time
-                    time.sleep(3)
+                    errors = []
                     
                     try:
-                        self.api.nodes(node).lxc(vmid).status.start.post()
-                        time.sleep(10)
-                    except:
-                        pass
-                    
-                    errors = []
+                        with self.node_slot(node):
+                            notify('start_started', vmid=vmid, node=node)
+                            start_upid = self.api.nodes(node).lxc(vmid).status.start.post()
+                            self.wait_for_task(start_upid, node=node)
+                            self.wait_for_status(node, vmid, 'running')
+                        notify('running', vmid=vmid, node=node)
+                    except Exception as e:
+                        errors.append(f"Avvio non confermato: {e}")
+                        notify('start_unconfirmed', vmid=vmid, node=node, error=str(e))
                     
                     if errors:
-                        print(f"⚠️ Container creato ma con avvisi: {errors}")
+                        logger.warning("Container %s creato ma con avvisi: %s", vmid, errors)
                         return {
                             'success': True,
                             'vmid': vmid,
+                            'node': node,
+                            'clone_strategy': strategy,
                             'message': f'Container creato con successo dal template {template}. Avvisi: {"; ".join(errors)}'
                         }
                     else:
                         return {
                             'success': True,
                             'vmid': vmid,
+                            'node': node,
+                            'clone_strategy': strategy,
                             'message': f'Container creato con successo dal template {template}'
                         }
                 except Exception as e:
                     error_msg = str(e)
-                    print(f"Errore durante il processo: {error_msg}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("Errore durante il processo: %s", error_msg)
                     
                     if clone_success or container_created:
-                        print(f"Clone riuscito, container {vmid} creato nonostante errori nella configurazione")
+                        logger.warning("Clone riuscito, container %s creato nonostante errori nella configurazione", vmid)
                         try:
                             check = self.api.nodes(node).lxc(vmid).status.current.get()
-                            print(f"Container {vmid} verificato esistente in ProxMox")
+                            logger.info("Container %s verificato esistente in ProxMox", vmid)
                             return {
                                 'success': True,
                                 'vmid': vmid,
+                                'node': node,
+                                'clone_strategy': strategy,
                                 'message': f'Container creato con successo dal template {template}. Errore nella configurazione: {error_msg}'
                             }
                         except:
@@ -221,6 +725,8 @@ class ProxmoxAPI:
                                 return {
                                     'success': True,
                                     'vmid': vmid,
+                                    'node': node,
+                                    'clone_strategy': strategy,
                                     'message': f'Container creato con successo dal template {template}. Errore nella configurazione: {error_msg}'
                                 }
                     
@@ -240,10 +746,127 @@ class ProxmoxAPI:
                 'error': f'Errore nella comunicazione con ProxMox: {str(e)}'
             }
     
+    @traced(kind='task', attrs=('vm_type', 'vmid'))
+    def clone_stopped(self, vm_type, template, vmid, hostname):
+        """
+        Clona il template del tier senza avviarlo (container per il warm pool).
+        Restituisce un dizionario come create_vm.
+        """
+        try:
+            if not self.api:
+                self._connect()
+            if not self.api:
+                return {'success': False, 'error': 'Impossibile connettersi a ProxMox'}
+            
+            template_node, template_vmid = self.locate_template(template, self.get_nodes())
+            if not template_vmid:
+                return {'success': False, 'error': f'Template "{template}" non trovato'}
+            
+            node, strategy = self.plan_clone(vm_type, template_node, template_vmid)
+            with self.node_slot(template_node):
+                node, strategy = self._clone_template(
+                    template_node, template_vmid, node, {'newid': vmid, 'hostname': hostname}, strategy, vm_type
+                )
+            return {'success': True, 'vmid': vmid, 'node': node, 'clone_strategy': strategy}
+        except Exception as e:
+            logger.warning("Clone di %s per il warm pool fallito: %s", template, e)
+            return {'success': False, 'error': f'Errore nel clonare il template {template}: {e}'}
+    
+    @traced(kind='task', attrs=('node', 'vmid', 'vm_name'))
+    def start_prepared_vm(self, node, vmid, vm_name, progress=None):
+        """
+        Assegna l'hostname a un container già clonato (warm pool o clone di un job interrotto)
+        e lo avvia se non è già in esecuzione. Restituisce un dizionario come create_vm.
+        """
+        def notify(event, **data):
+            if progress:
+                progress(event, **data)
+        
+        try:
+            if not self.api:
+                self._connect()
+            if not self.api:
+                return {'success': False, 'error': 'Impossibile connettersi a ProxMox'}
+            
+            guest = self.api.nodes(node).lxc(vmid)
+            with self.node_slot(node):
+                current = self.wait_for_unlock(node, vmid)
+                guest.config.put(hostname=vm_name)
+                if current.get('status') != 'running':
+                    notify('start_started', vmid=vmid, node=node)
+                    self.wait_for_task(guest.status.start.post(), node=node)
+                    self.wait_for_status(node, vmid, 'running')
+            notify('running', vmid=vmid, node=node)
+            return {'success': True, 'vmid': vmid, 'node': node, 'message': 'Container già clonato avviato'}
+        except Exception as e:
+            logger.warning("Avvio del container già clonato %s fallito: %s", vmid, e)
+            return {'success': False, 'error': f'Errore nell\'avvio del container {vmid}: {e}'}
+        finally:
+            self.invalidate_inventory(node=node, kind='lxc')
+    
+    @staticmethod
+    def _is_missing_guest(error):
+        return isinstance(error, ResourceException) and 'does not exist' in str(error)
+    
+    def locate_guest(self, node, vmid):
+        """Nodo su cui si trova il container (può essere stato migrato), None se non esiste più"""
+        if node:
+            try:
+                self.api.nodes(node).lxc(vmid).status.current.get()
+                return node
+            except Exception as e:
+                if not self._is_missing_guest(e):
+                    raise
+        self.invalidate_inventory(kind='resources')
+        for resource in self.get_cluster_resources('vm'):
+            if resource.get('vmid') is not None and int(resource['vmid']) == int(vmid):
+                return resource.get('node')
+        return None
+    
+    @traced(kind='task', attrs=('node', 'vmid'))
+    def destroy_vm(self, node, vmid, progress=None):
+        """
+        Arresta e distrugge il container attendendo il completamento dei task.
+        Un container che non esiste più è considerato già distrutto (already_absent).
+        progress, se indicato, viene chiamato come progress(evento, **dati) a ogni fase.
+        """
+        def notify(event, **data):
+            if progress:
+                progress(event, **data)
+        
+        if not self.api:
+            self._connect()
+        if not self.api:
+            return {'success': False, 'error': 'Impossibile connettersi a ProxMox'}
+        
+        located = None
+        try:
+            located = self.locate_guest(node, vmid)
+            if not located:
+                logger.info("Container %s non presente nel cluster: considerato già distrutto", vmid)
+                return {'success': True, 'vmid': vmid, 'node': node, 'already_absent': True}
+            
+            with self.node_slot(located):
+                guest = self.api.nodes(located).lxc(vmid)
+                if guest.status.current.get().get('status') == 'running':
+                    notify('stopping', vmid=vmid, node=located)
+                    self.wait_for_task(guest.status.stop.post(), node=located)
+                    notify('stopped', vmid=vmid, node=located)
+                notify('destroying', vmid=vmid, node=located)
+                self.wait_for_task(guest.delete(purge=1, **{'destroy-unreferenced-disks': 1}), node=located)
+            return {'success': True, 'vmid': vmid, 'node': located, 'already_absent': False}
+        except Exception as e:
+            logger.exception("Errore nella distruzione del container %s: %s", vmid, e)
+            return {'success': False, 'error': f'Errore nella distruzione del container {vmid}: {e}'}
+        finally:
+            if located:
+                self.invalidate_inventory(node=located, kind='lxc')
+            self.invalidate_inventory(kind='resources')
+    
     def _create_container_from_scratch(self, node, vmid, vm_name, cores, memory, swap, disk, storage_name=None):
         try:
             if not storage_name:
-                storage_name = self.get_available_storage(node) or 'local'
+                storage_name = self.get_available_storage(node, disk) or 'local'
             try:
                 storage_info = self.api.nodes(node).storage('local').content.get()
                 alpine_template = None
@@ -278,10 +901,14 @@ class ProxmoxAPI:
             }
             
             # Crea il container
-            result = self.api.nodes(node).lxc.post(**config)
+            create_upid = self.api.nodes(node).lxc.post(**config)
+            self.invalidate_inventory(node=node, kind='lxc')
+            self.invalidate_inventory(node=node, kind='storage')
+            self.wait_for_task(create_upid, node=node)
             
             # Avvia il container
-            self.api.nodes(node).lxc(vmid).status.start.post()
+            start_upid = self.api.nodes(node).lxc(vmid).status.start.post()
+            self.wait_for_task(start_upid, node=node)
             
             return {
                 'success': True,
@@ -294,6 +921,7 @@ class ProxmoxAPI:
                 'error': f'Errore nella creazione del container: {str(e)}'
             }
     
+    @traced(kind='task', attrs=('node', 'vmid'))
     def generate_credentials(self, vm_name, node=None, vmid=None):
         username = 'root'
         password = 'Admin00$$'
@@ -301,7 +929,11 @@ class ProxmoxAPI:
         
         ip_address = None
         if node and vmid:
-            ip_address = self._get_vm_ip(node, vmid)
+            # Una sola lettura: se l'IP non è ancora assegnato lo recupera IPResolver
+            try:
+                ip_address = self.get_vm_ip(node, vmid)
+            except Exception as e:
+                logger.debug("Interfacce del container %s non leggibili: %s", vmid, e)
         
         return {
             'hostname': hostname,
@@ -315,45 +947,27 @@ class ProxmoxAPI:
         characters = string.ascii_letters + string.digits + "!@#$%^&*"
         return ''.join(random.choice(characters) for _ in range(length))
     
-    def _get_vm_ip(self, node, vmid):
+    @staticmethod
+    def _parse_vm_ip(interfaces):
+        """Primo indirizzo non di loopback tra le interfacce del container"""
+        for iface in interfaces or []:
+            if iface.get('name') != 'lo':
+                inet = iface.get('inet')
+                if inet:
+                    ip = inet.split('/')[0]
+                    if ip and not ip.startswith('127.'):
+                        return ip
+        return None
+    
+    @traced(attrs=('node', 'vmid'))
+    def get_vm_ip(self, node, vmid):
         """
-        Recupera l'IP del container interrogando le interfacce di rete rilevate da ProxMox.
-        Metodo robusto per LXC che non richiede l'agent attivo.
+        Singola lettura delle interfacce di rete rilevate da ProxMox (non richiede l'agent),
+        senza attese: i nuovi tentativi li pianifica IPResolver. Gli errori API si propagano
         """
-        try:
-            if not self.api:
-                self._connect()
-            
-            import time
-            
-            for attempt in range(15):
-                if attempt > 0:
-                    time.sleep(2)
-                
-                try:
-                    interfaces = self.api.nodes(node).lxc(vmid).interfaces.get()
-                    
-                    if interfaces:
-                        for iface in interfaces:
-                            if iface.get('name') != 'lo':
-                                inet = iface.get('inet')
-                                if inet:
-                                    ip = inet.split('/')[0]
-                                    if ip and not ip.startswith('127.'):
-                                        return ip
-                except Exception as e:
-                    try:
-                        status = self.api.nodes(node).lxc(vmid).status.current.get()
-                    except:
-                        pass
-                    
-            return None
-        except Exception as e:
-            print(f"Errore critico nel recupero IP per container {vmid}: {e}")
-            return None
-    
-    def refresh_vm_ip(self, node, vmid):
-        return self._get_vm_ip(node, vmid)
+        if not self.api:
+            self._connect()
+        return self._parse_vm_ip(self.api.nodes(node).lxc(vmid).interfaces.get())
     
     def _generate_ssh_key(self, vm_name):
         return f"ssh-rsa AAAAB3NzaC1yc2E... (chiave SSH per {vm_name})"
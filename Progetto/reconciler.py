@@ -0,0 +1,122 @@
+"""
+Riconciliazione periodica dello stato dei container: una sola chiamata a
+cluster/resources?type=vm per ciclo, confrontata con tutte le richieste
+approvate e salvata con aggiornamenti massivi. Con lo stesso elenco vengono
+liberati i VMID rimasti prenotati da clone falliti, una volta distrutto il container.
+"""
+
+from sqlalchemy import and_, bindparam, case, func, or_, update
+
+from background import PeriodicService
+from models import db, VMIDReservation, VMRequest, get_local_time
+
+
+class ClusterReconciler(PeriodicService):
+    name = 'reconciler'
+    exclusive = True
+
+    def __init__(self, app=None, proxmox_api=None, interval=30, chunk_size=500):
+        self.proxmox_api = proxmox_api
+        self.chunk_size = chunk_size
+        super().__init__(app, interval=interval)
+
+    def init_app(self, app, proxmox_api=None):
+        super().init_app(app)
+        if proxmox_api is not None:
+            self.proxmox_api = proxmox_api
+        self.interval = app.config.get('RECONCILER_INTERVAL', self.interval)
+
+    @staticmethod
+    def _statement():
+        table = VMRequest.__table__
+        status = bindparam('b_status')
+        node = bindparam('b_node')
+        checked_at = bindparam('b_checked_at')
+        # updated_at cambia solo se cambiano stato o nodo: uptime e consumi non invalidano le pagine in cache
+        changed = or_(
+            table.c.vm_status.is_distinct_from(status),
+            and_(node.isnot(None), table.c.node.is_distinct_from(node))
+        )
+        # Una richiesta dismessa mentre il ciclo è in corso non riceve lo stato del container
+        return (
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .where(table.c.status == 'approved')
+            .where(table.c.vm_id == bindparam('b_vmid'))
+            .values(
+                vm_status=status,
+                node=func.coalesce(node, table.c.node),
+                uptime=bindparam('b_uptime'),
+                cpu_usage=bindparam('b_cpu'),
+                mem_usage=bindparam('b_mem'),
+                mem_max=bindparam('b_maxmem'),
+                last_seen_at=func.coalesce(bindparam('b_seen_at'), table.c.last_seen_at),
+                status_checked_at=checked_at,
+                updated_at=case((changed, checked_at), else_=table.c.updated_at)
+            )
+        )
+
+    def _release_failed_clones(self, guests):
+        """VMID ancora prenotati per richieste rifiutate: distrugge il container se esiste e libera il VMID"""
+        rows = (
+            db.session.query(VMIDReservation.vmid)
+            .join(VMRequest, VMIDReservation.vm_request_id == VMRequest.id)
+            .filter(VMIDReservation.status == 'reserved', VMRequest.status == 'rejected')
+            .all()
+        )
+        for row in rows:
+            guest = guests.get(row.vmid)
+            if guest and not self.proxmox_api.destroy_vm(guest.get('node'), row.vmid)['success']:
+                continue
+            VMIDReservation.query.filter_by(vmid=row.vmid, status='reserved').delete(synchronize_session=False)
+            db.session.commit()
+
+    def run_once(self):
+        resources = self.proxmox_api.get_cluster_resources('vm')
+        guests = {int(res['vmid']): res for res in resources if res.get('vmid') is not None}
+        self._release_failed_clones(guests)
+
+        rows = (
+            db.session.query(VMRequest.id, VMRequest.vm_id)
+            .filter(VMRequest.status == 'approved', VMRequest.vm_id.isnot(None))
+            .all()
+        )
+        if not rows:
+            return 0
+
+        now = get_local_time()
+        params = []
+        for row in rows:
+            guest = guests.get(row.vm_id)
+            if guest:
+                params.append({
+                    'b_id': row.id,
+                    'b_vmid': row.vm_id,
+                    'b_status': guest.get('status'),
+                    'b_node': guest.get('node'),
+                    'b_uptime': guest.get('uptime'),
+                    'b_cpu': guest.get('cpu'),
+                    'b_mem': guest.get('mem'),
+                    'b_maxmem': guest.get('maxmem'),
+                    'b_seen_at': now,
+                    'b_checked_at': now
+                })
+            else:
+                params.append({
+                    'b_id': row.id,
+                    'b_vmid': row.vm_id,
+                    'b_status': 'missing',
+                    'b_node': None,
+                    'b_uptime': None,
+                    'b_cpu': None,
+                    'b_mem': None,
+                    'b_maxmem': None,
+                    'b_seen_at': None,
+                    'b_checked_at': now
+                })
+
+        statement = self._statement()
+        for start in range(0, len(params), self.chunk_size):
+            db.session.execute(statement, params[start:start + self.chunk_size])
+            db.session.commit()
+        return len(params)
@@ -0,0 +1,271 @@
+"""
+Conservazione delle richieste: le righe che non cambieranno più (rifiutate,
+fallite, dismesse) e più vecchie della soglia della propria regola vengono
+spostate da vm_request in un archivio JSON Lines compresso con gzip, insieme
+ai relativi provisioning_job. Si lavora a blocchi di dimensione fissa, ognuno
+con una transazione breve, così la tabella resta piccola senza tenere il lock
+di scrittura per tutta la durata dell'operazione.
+
+Ripresa dopo un'interruzione: accanto all'archivio un file di stato registra
+la dimensione confermata dell'archivio e gli id del blocco in cancellazione.
+Alla ripartenza i byte scritti oltre la dimensione confermata vengono scartati
+(il blocco viene riscritto) e un blocco già archiviato ma non ancora
+cancellato viene cancellato, quindi nessuna riga va persa o archiviata due volte.
+Archivio e file di stato vanno usati da un solo processo alla volta: ogni
+esecuzione tiene un flock esclusivo su un file .lock accanto all'archivio (il
+file di stato viene sostituito a ogni salvataggio) e chi lo trova occupato salta.
+"""
+
+import gzip
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: nessun lock tra processi, resta il lease del servizio
+    fcntl = None
+
+from sqlalchemy import delete, func, update
+
+from background import PeriodicService
+from models import db, ProvisioningJob, VMIDReservation, VMRequest, get_local_time
+
+logger = logging.getLogger(__name__)
+
+# Stati finali: una richiesta in questi stati non viene più modificata
+ARCHIVABLE_STATUSES = ('rejected', 'failed', 'decommissioned')
+
+
+class RetentionRule:
+    def __init__(self, status, days):
+        self.status = status
+        self.days = days
+
+    def cutoff(self, now):
+        return now - timedelta(days=self.days)
+
+    def __repr__(self):
+        return f'{self.status}:{self.days}'
+
+
+def parse_rules(spec):
+    """'rejected:90,failed:90' -> regole; sono ammessi solo gli stati conclusi (ARCHIVABLE_STATUSES)"""
+    rules = []
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        status, _, days = item.partition(':')
+        if not days.strip().isdigit():
+            raise ValueError(f"Regola di conservazione non valida: {item!r} (formato stato:giorni)")
+        if status.strip() not in ARCHIVABLE_STATUSES:
+            raise ValueError(
+                f"Le richieste in stato {status.strip()!r} non possono essere archiviate "
+                f"(ammessi: {', '.join(ARCHIVABLE_STATUSES)})"
+            )
+        rules.append(RetentionRule(status.strip(), int(days)))
+    return rules
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Valore non serializzabile: {type(value).__name__}")
+
+
+def _columns(row):
+    return {column.name: getattr(row, column.key) for column in row.__mapper__.columns}
+
+
+def iter_archive(path):
+    """Record dell'archivio, uno per richiesta archiviata"""
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ArchiveWriter:
+    """Archivio gzip a cui ogni blocco aggiunge un membro gzip completo"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = path + '.state'
+        self.lock_path = path + '.lock'
+
+    @contextmanager
+    def lock(self):
+        """Lock esclusivo tra processi su archivio e stato; restituisce False se lo tiene un altro processo"""
+        if fcntl is None:
+            yield True
+            return
+        directory = os.path.dirname(self.lock_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Il lock si rilascia alla chiusura del file, anche se il processo termina
+        with open(self.lock_path, 'a') as handle:
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return {'size': os.path.getsize(self.path) if os.path.exists(self.path) else 0, 'pending': []}
+
+    def save_state(self, size, pending):
+        temporary = self.state_path + '.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump({'size': size, 'pending': pending}, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temporary, self.state_path)
+
+    def recover(self, state):
+        """Scarta i byte di un blocco scritto solo in parte o non confermato"""
+        if os.path.exists(self.path) and os.path.getsize(self.path) > state['size']:
+            logger.warning("Archivio %s: scartato un blocco non confermato", self.path)
+            with open(self.path, 'r+b') as handle:
+                handle.truncate(state['size'])
+
+    def append(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'ab') as handle:
+            with gzip.GzipFile(fileobj=handle, mode='wb') as archive:
+                for record in records:
+                    archive.write((json.dumps(record, default=_json_default) + '\n').encode('utf-8'))
+            handle.flush()
+            os.fsync(handle.fileno())
+            return handle.tell()
+
+
+class RetentionManager:
+    def __init__(self, rules, archive_path, batch_size=500, pause=0.05):
+        self.rules = rules
+        self.writer = ArchiveWriter(archive_path)
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def _query(self, rule, now):
+        age = func.coalesce(VMRequest.updated_at, VMRequest.created_at)
+        return db.session.query(VMRequest.id).filter(VMRequest.status == rule.status, age < rule.cutoff(now))
+
+    def counts(self, now=None):
+        """Righe archiviabili oggi per ogni regola"""
+        now = now or get_local_time()
+        return [(rule, self._query(rule, now).count()) for rule in self.rules]
+
+    def run(self, max_batches=None, should_stop=None):
+        """
+        Archivia finché restano righe (o fino a max_batches blocchi). Restituisce i totali,
+        con busy=True se un altro processo sta già archiviando
+        """
+        with self.writer.lock() as acquired:
+            if not acquired:
+                logger.info("Archivio %s in uso da un altro processo: esecuzione saltata", self.writer.path)
+                return {'archived': 0, 'batches': 0, 'busy': True}
+            return self._run(max_batches, should_stop)
+
+    def _run(self, max_batches, should_stop):
+        state = self.writer.load_state()
+        self.writer.recover(state)
+        stats = {'archived': 0, 'batches': 0}
+        if state['pending']:
+            # Blocco già nell'archivio ma non cancellato prima dell'interruzione
+            self._delete(state['pending'])
+            self.writer.save_state(state['size'], [])
+            stats['archived'] += len(state['pending'])
+            stats['batches'] += 1
+
+        now = get_local_time()
+        for rule in self.rules:
+            last_id = 0
+            while max_batches is None or stats['batches'] < max_batches:
+                if should_stop and should_stop():
+                    return stats
+                ids = [row[0] for row in
+                       self._query(rule, now).filter(VMRequest.id > last_id)
+                       .order_by(VMRequest.id).limit(self.batch_size)]
+                if not ids:
+                    break
+                self._archive_batch(rule, ids)
+                last_id = ids[-1]
+                stats['archived'] += len(ids)
+                stats['batches'] += 1
+                if self.pause:
+                    time.sleep(self.pause)
+        return stats
+
+    def _archive_batch(self, rule, ids):
+        requests = VMRequest.query.filter(VMRequest.id.in_(ids)).order_by(VMRequest.id).all()
+        jobs = {}
+        for job in ProvisioningJob.query.filter(ProvisioningJob.vm_request_id.in_(ids)).order_by(ProvisioningJob.id):
+            jobs.setdefault(job.vm_request_id, []).append(_columns(job))
+        archived_at = get_local_time()
+        records = [{
+            'archived_at': archived_at,
+            'rule': repr(rule),
+            'vm_request': _columns(vm_request),
+            'provisioning_jobs': jobs.get(vm_request.id, [])
+        } for vm_request in requests]
+        # Chiude la transazione di lettura prima della scrittura su disco
+        db.session.rollback()
+
+        size = self.writer.append(records)
+        self.writer.save_state(size, ids)
+        self._delete(ids)
+        self.writer.save_state(size, [])
+
+    def _delete(self, ids):
+        db.session.execute(
+            update(VMIDReservation).where(VMIDReservation.vm_request_id.in_(ids)).values(vm_request_id=None)
+        )
+        db.session.execute(delete(ProvisioningJob).where(ProvisioningJob.vm_request_id.in_(ids)))
+        db.session.execute(delete(VMRequest).where(VMRequest.id.in_(ids)))
+        db.session.commit()
+
+
+def manager_from_config(app, rules=None, archive_path=None):
+    return RetentionManager(
+        rules if rules is not None else parse_rules(app.config['RETENTION_RULES']),
+        archive_path or app.config['RETENTION_ARCHIVE'] or os.path.join(app.instance_path, 'archive', 'vm_request.jsonl.gz'),
+        batch_size=app.config['RETENTION_BATCH_SIZE'],
+        pause=app.config['RETENTION_BATCH_PAUSE']
+    )
+
+
+class RetentionService(PeriodicService):
+    name = 'retention'
+    exclusive = True
+
+    def __init__(self, app=None, interval=0):
+        self.manager = None
+        super().__init__(app, interval=interval)
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.interval = app.config.get('RETENTION_INTERVAL', self.interval)
+        self.manager = manager_from_config(app)
+
+    def start(self):
+        if not self.interval or not self.manager.rules:
+            return
+        super().start()
+
+    def run_once(self):
+        stats = self.manager.run(should_stop=self._stop.is_set)
+        if stats['archived']:
+            logger.info("Archiviate %d richieste in %d blocchi in %s",
+                        stats['archived'], stats['batches'], self.manager.writer.path)
@@ -0,0 +1,95 @@
+"""Archivia le richieste concluse secondo le regole di conservazione.
+
+Sostituisce clean_vm_requests.py: invece di cancellare tutto tranne alcuni
+vm_name, sposta le richieste rifiutate/fallite/dismesse più vecchie della
+soglia in un archivio gzip (JSON Lines), a blocchi con transazioni brevi.
+Se l'operazione viene interrotta basta rilanciare lo script: il blocco in
+corso viene completato senza duplicati.
+
+Uso:
+    # mostra quante righe verrebbero archiviate per ogni regola (RETENTION_RULES)
+    python scripts/archive_vm_requests.py --dry-run
+
+    # archivia con le regole configurate, chiedendo conferma
+    python scripts/archive_vm_requests.py
+
+    # regole e archivio espliciti, senza prompt
+    python scripts/archive_vm_requests.py --rule rejected:30 --rule failed:30 \\
+        --archive /backup/vm_request-2026.jsonl.gz --yes
+
+    # conta i record presenti in un archivio
+    python scripts/archive_vm_requests.py --inspect /backup/vm_request-2026.jsonl.gz
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from retention import iter_archive, manager_from_config, parse_rules
+
+
+def inspect_archive(path):
+    count = 0
+    rules = {}
+    for record in iter_archive(path):
+        count += 1
+        rules[record['rule']] = rules.get(record['rule'], 0) + 1
+    print(f"{path}: {count} richieste archiviate")
+    for rule, rule_count in sorted(rules.items()):
+        print(f"  {rule:<24} {rule_count}")
+
+
+def main(args):
+    if args.inspect:
+        inspect_archive(args.inspect)
+        return 0
+
+    with app.app_context():
+        rules = parse_rules(','.join(args.rule)) if args.rule else None
+        manager = manager_from_config(app, rules=rules, archive_path=args.archive)
+        if args.batch_size:
+            manager.batch_size = args.batch_size
+        if not manager.rules:
+            print("Nessuna regola di conservazione configurata. Esco.")
+            return 0
+
+        state = manager.writer.load_state()
+        if state['pending']:
+            print(f"Ripresa: {len(state['pending'])} righe già archiviate da cancellare")
+
+        total = 0
+        for rule, count in manager.counts():
+            print(f"Regola {rule!r}: {count} righe da archiviare")
+            total += count
+        print(f"Archivio: {manager.writer.path}")
+
+        if args.dry_run or (total == 0 and not state['pending']):
+            if total == 0:
+                print("Nessuna riga da archiviare. Esco.")
+            return 0
+
+        if not args.yes:
+            ans = input("Procedere con l'archiviazione? [y/N]: ").strip().lower()
+            if ans != 'y':
+                print("Operazione annullata dall'utente.")
+                return 0
+
+        stats = manager.run()
+        if stats.get('busy'):
+            print("Archiviazione già in corso in un altro processo. Riprova più tardi.")
+            return 1
+        print(f"Archiviate {stats['archived']} righe in {stats['batches']} blocchi. Operazione completata.")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sposta le richieste concluse in un archivio compresso')
+    parser.add_argument('--rule', action='append', metavar='STATO:GIORNI', help='Regola da usare al posto di RETENTION_RULES')
+    parser.add_argument('--archive', help='File di archivio (default: RETENTION_ARCHIVE)')
+    parser.add_argument('--batch-size', type=int, help='Righe per blocco (default: RETENTION_BATCH_SIZE)')
+    parser.add_argument('--dry-run', action='store_true', help='Mostra solo i conteggi')
+    parser.add_argument('--yes', action='store_true', help='Esegui senza chiedere conferma')
+    parser.add_argument('--inspect', metavar='ARCHIVIO', help='Riepiloga il contenuto di un archivio ed esce')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,260 @@
+"""Benchmark end-to-end delle approvazioni contro il simulatore di ProxMox.
+
+Avvia il simulatore HTTPS (fake_proxmox.py), configura l'applicazione Flask
+reale su un database SQLite temporaneo, crea le richieste in attesa e le
+approva tramite la route /approve_request con più client amministratore in
+parallelo. Misura approvazioni al minuto e latenze p50/p99 dal click di
+approvazione alla creazione del container (o all'IP con --wait-ip).
+
+Uso:
+    # 100 approvazioni, 4 client, latenze realistiche dei task
+    python scripts/benchmark_provisioning.py --requests 100 --clients 4 \\
+        --latency default=0.02 --task-duration clone=2 --task-duration start=1
+
+    # con errori iniettati e risultati salvati in JSON
+    python scripts/benchmark_provisioning.py --fail clone.post=0.05 --json risultati.json
+
+    # con il warm pool riempito prima della misura
+    python scripts/benchmark_provisioning.py --requests 20 --warm-pool bronze:10,silver:5,gold:5 --task-duration clone=2
+
+    # linked clone contro clone completo (i template del simulatore sono su local-zfs)
+    python scripts/benchmark_provisioning.py --clone-strategy full --task-duration clone=2
+    python scripts/benchmark_provisioning.py --clone-strategy linked --task-duration clone=2 --task-duration linkclone=0.2
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_proxmox import FakeCluster, FakeProxmoxServer, add_profile_arguments, build_profile
+from metrics import summarize
+
+DONE_EVENTS = {'completed', 'failed'}
+IP_DONE_EVENTS = {'failed', 'ip_acquired', 'ip_unavailable'}
+
+
+def configure_environment(args, server):
+    # Da impostare prima di importare app: la configurazione viene letta all'import
+    database = os.path.join(tempfile.mkdtemp(prefix='benchmark-'), 'benchmark.db')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{database}',
+        'PROXMOX_HOST': server.address,
+        'PROXMOX_USER': 'root@pam',
+        'PROXMOX_PASSWORD': 'benchmark',
+        'PROXMOX_VERIFY_SSL': 'False',
+        'PROVISIONING_WORKERS': str(args.workers),
+        'PROVISIONING_NODE_CONCURRENCY': str(args.node_concurrency),
+        'PROXMOX_POOL_SIZE': str(args.pool_size),
+        'IP_RESOLVER_INTERVAL': '1',
+        # I servizi che servono alla misura vengono avviati esplicitamente
+        'BACKGROUND_SERVICES': 'False',
+        'WARM_POOL_SIZES': args.warm_pool or '',
+        'PROXMOX_CLONE_STRATEGY': args.clone_strategy
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Il simulatore usa un certificato autofirmato: l'avviso di urllib3 a ogni chiamata è atteso
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return database
+
+
+def seed(app, db, count, tiers):
+    from models import User, VMRequest
+    from werkzeug.security import generate_password_hash
+
+    with app.app_context():
+        admin = User(username='admin', email='admin@benchmark.local',
+                     password_hash=generate_password_hash('admin'), is_admin=True)
+        user = User(username='studente', email='studente@benchmark.local',
+                    password_hash=generate_password_hash('studente'))
+        db.session.add_all([admin, user])
+        db.session.flush()
+        requests = [
+            VMRequest(user_id=user.id, vm_type=tiers[index % len(tiers)], vm_name=f'bench-{index:05d}', status='pending')
+            for index in range(count)
+        ]
+        db.session.add_all(requests)
+        db.session.commit()
+        return [vm_request.id for vm_request in requests]
+
+
+def run(args):
+    server = FakeProxmoxServer(FakeCluster(build_profile(args), nodes=args.nodes)).start()
+    configure_environment(args, server)
+
+    from app import app, ip_resolver, warm_pool
+    from migrations import apply_migrations
+    from models import db, VMRequest
+    from progress import progress_broker
+    import metrics
+
+    with app.app_context():
+        apply_migrations()
+    request_ids = seed(app, db, args.requests, args.tiers)
+    if args.wait_ip:
+        ip_resolver.start()
+    if warm_pool.enabled:
+        # Il pool viene riempito prima della misura, come dopo un periodo senza approvazioni
+        filled_at = time.perf_counter()
+        with app.app_context():
+            warm_pool.run_once()
+            levels = warm_pool.levels()
+        print(f"Warm pool pronto in {time.perf_counter() - filled_at:.1f}s: "
+              + ', '.join(f"{tier} {level['ready']}" for tier, level in levels.items()))
+
+    done_events = IP_DONE_EVENTS if args.wait_ip else DONE_EVENTS
+    submitted = {}
+    finished = {}
+    outcomes = {}
+    http_latencies = []
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def on_event(request_id, record):
+        if record['event'] not in done_events:
+            return
+        with lock:
+            if request_id in finished or request_id not in submitted:
+                return
+            finished[request_id] = time.perf_counter()
+            outcomes[request_id] = record['event']
+            if len(finished) == len(request_ids):
+                all_done.set()
+
+    progress_broker.add_listener(on_event)
+
+    pending = queue.Queue()
+    for request_id in request_ids:
+        pending.put(request_id)
+
+    def approver():
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin'})
+        while True:
+            try:
+                request_id = pending.get_nowait()
+            except queue.Empty:
+                return
+            start = time.perf_counter()
+            with lock:
+                submitted[request_id] = start
+            response = client.post(f'/approve_request/{request_id}')
+            elapsed = time.perf_counter() - start
+            with lock:
+                http_latencies.append(elapsed)
+            if response.status_code != 302:
+                print(f"Approvazione {request_id} fallita: HTTP {response.status_code}")
+            if args.rate:
+                time.sleep(max(0.0, args.clients / args.rate - elapsed))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=approver, name=f'approver-{index}') for index in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    completed_in_time = all_done.wait(args.timeout)
+    wall = time.perf_counter() - started
+
+    with app.app_context():
+        clone_strategies = dict(
+            db.session.query(VMRequest.clone_strategy, db.func.count(VMRequest.id))
+            .filter(VMRequest.id.in_(request_ids), VMRequest.clone_strategy.isnot(None))
+            .group_by(VMRequest.clone_strategy)
+            .all()
+        )
+
+    with lock:
+        latencies = [finished[rid] - submitted[rid] for rid in finished]
+        succeeded = sum(1 for rid in outcomes if outcomes[rid] in ('completed', 'ip_acquired'))
+        failed = len(outcomes) - succeeded
+        end = max(finished.values()) if finished else time.perf_counter()
+
+    elapsed = end - started
+    proxmox_ops = {
+        f'{operation} ({outcome})': {'count': count, 'mean_ms': round(total / count * 1000, 2)}
+        for (operation, outcome), (count, total) in sorted(metrics.PROXMOX_REQUEST_SECONDS.totals().items())
+        if count
+    }
+    result = {
+        'requests': args.requests,
+        'clients': args.clients,
+        'workers': args.workers,
+        'nodes': args.nodes,
+        'wait_ip': args.wait_ip,
+        'succeeded': succeeded,
+        'failed': failed,
+        'unfinished': args.requests - len(finished),
+        'timed_out': not completed_in_time,
+        'elapsed_seconds': round(elapsed, 3),
+        'wall_seconds': round(wall, 3),
+        'approvals_per_minute': round(succeeded / elapsed * 60, 2) if elapsed > 0 else None,
+        'approval_latency_seconds': summarize(latencies),
+        'approve_route_seconds': summarize(http_latencies),
+        'proxmox_operations': proxmox_ops,
+        'clone_strategies': clone_strategies,
+        'warm_pool': {
+            f'{tier} ({result})': count
+            for (tier, result), count in sorted(metrics.WARM_POOL_CLAIMS.values().items())
+        }
+    }
+
+    if args.wait_ip:
+        ip_resolver.stop()
+    server.stop()
+    return result
+
+
+def print_report(result):
+    def fmt(value):
+        return '-' if value is None else f'{value:.3f}s'
+
+    print(f"Approvazioni: {result['succeeded']} riuscite, {result['failed']} fallite, "
+          f"{result['unfinished']} non completate su {result['requests']}")
+    print(f"Durata: {result['elapsed_seconds']}s, throughput: {result['approvals_per_minute']} approvazioni/minuto")
+    for label, key in (('Latenza approvazione', 'approval_latency_seconds'), ('Route /approve_request', 'approve_route_seconds')):
+        stats = result[key]
+        print(f"{label}: p50 {fmt(stats['p50'])}  p90 {fmt(stats['p90'])}  p99 {fmt(stats['p99'])}  max {fmt(stats['max'])}")
+    if result['clone_strategies']:
+        print("Clone: " + ', '.join(f"{strategy} {count}" for strategy, count in sorted(result['clone_strategies'].items())))
+    if result['warm_pool']:
+        print("Warm pool: " + ', '.join(f"{key} {count}" for key, count in result['warm_pool'].items()))
+    print("Chiamate ProxMox (media):")
+    for operation, stats in result['proxmox_operations'].items():
+        print(f"  {operation:<40} {stats['count']:>6}  {stats['mean_ms']:>9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark delle approvazioni contro il simulatore di ProxMox')
+    parser.add_argument('--requests', type=int, default=50, help='Numero di richieste da approvare')
+    parser.add_argument('--clients', type=int, default=4, help='Client amministratore che approvano in parallelo')
+    parser.add_argument('--rate', type=float, default=None, help='Approvazioni al secondo complessive (default: il più veloce possibile)')
+    parser.add_argument('--tiers', nargs='+', default=['bronze', 'silver', 'gold'], help='Tier assegnati a rotazione')
+    parser.add_argument('--workers', type=int, default=8, help='PROVISIONING_WORKERS')
+    parser.add_argument('--node-concurrency', type=int, default=2, help='PROVISIONING_NODE_CONCURRENCY')
+    parser.add_argument('--pool-size', type=int, default=8, help='PROXMOX_POOL_SIZE')
+    parser.add_argument('--clone-strategy', choices=['auto', 'linked', 'full'], default='auto', help='PROXMOX_CLONE_STRATEGY')
+    parser.add_argument('--warm-pool', metavar='TIER:N,...', help='WARM_POOL_SIZES, riempito prima della misura')
+    parser.add_argument('--wait-ip', action='store_true', help="Misura fino all'ottenimento dell'IP invece che alla creazione")
+    parser.add_argument('--timeout', type=float, default=600, help='Attesa massima (secondi) per il completamento')
+    parser.add_argument('--json', dest='json_path', help='Salva i risultati in formato JSON')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+    if args.json_path:
+        with open(args.json_path, 'w') as handle:
+            json.dump(result, handle, indent=2)
+        print(f"Risultati salvati in {args.json_path}")
+    return 0 if not result['unfinished'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""Applica le migrazioni dello schema al database configurato.
+
+Uso:
+    # applica le migrazioni mancanti
+    python scripts/migrate.py
+
+    # mostra versione corrente e migrazioni in attesa senza applicarle
+    python scripts/migrate.py --status
+
+    # verifica che le query delle dashboard usino gli indici
+    python scripts/migrate.py --check-plan
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from migrations import apply_migrations, current_version, pending_migrations, check_query_plans
+
+
+def main(status_only: bool, check_plan: bool):
+    with app.app_context():
+        if status_only:
+            print(f"Versione schema corrente: {current_version()}")
+            for version, description, _ in pending_migrations():
+                print(f"  In attesa: {version:03d} {description}")
+            return 0
+
+        applied = apply_migrations(verbose=True)
+        if not applied:
+            print(f"Schema già aggiornato (versione {current_version()}).")
+
+        if check_plan:
+            failures = 0
+            for name, index, ok, plan in check_query_plans():
+                print(f"[{'OK' if ok else 'NO'}] {name} (indice atteso: {index})")
+                if not ok:
+                    failures += 1
+                    print('    ' + plan.replace('\n', '\n    '))
+            return 1 if failures else 0
+        return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrazioni dello schema del portale')
+    parser.add_argument('--status', action='store_true', help='Mostra lo stato senza applicare nulla')
+    parser.add_argument('--check-plan', action='store_true', help='Verifica i piani di esecuzione delle query delle dashboard')
+    args = parser.parse_args()
+    sys.exit(main(status_only=args.status, check_plan=args.check_plan))
@@ -0,0 +1,39 @@
+"""Lease dei servizi in background esclusivi tra più processi"""
+
+from datetime import timedelta
+
+
+def test_service_lease_is_held_by_one_process_until_it_expires(ctx, monkeypatch):
+    import background
+    from app import db
+    from models import ServiceLease, get_local_time
+
+    assert background.acquire_lease('test-lease', 60)
+    assert background.acquire_lease('test-lease', 60)
+
+    monkeypatch.setattr(background, 'process_owner', lambda: 'altro-worker:1')
+    assert not background.acquire_lease('test-lease', 60)
+
+    # Il processo che lo teneva è terminato: scaduto il lease il servizio passa all'altro
+    db.session.get(ServiceLease, 'test-lease').expires_at = get_local_time() - timedelta(seconds=1)
+    db.session.commit()
+    assert background.acquire_lease('test-lease', 60)
+    assert db.session.get(ServiceLease, 'test-lease').owner == 'altro-worker:1'
+
+
+def test_reconciler_runs_in_one_process_only(ctx, monkeypatch):
+    import background
+    from app import app, proxmox_api
+    from reconciler import ClusterReconciler
+
+    calls = []
+    get_cluster_resources = proxmox_api.get_cluster_resources
+    monkeypatch.setattr(proxmox_api, 'get_cluster_resources',
+                        lambda resource_type=None: calls.append(resource_type) or get_cluster_resources(resource_type))
+
+    # Due worker con il proprio reconciler: solo quello che prende il lease interroga il cluster
+    for owner in ('worker-a:1', 'worker-b:1', 'worker-a:1'):
+        monkeypatch.setattr(background, 'process_owner', lambda owner=owner: owner)
+        ClusterReconciler(app, proxmox_api).run_cycle()
+
+    assert calls == ['vm', 'vm']
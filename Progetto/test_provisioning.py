@@ -0,0 +1,130 @@
+"""
+Coda di provisioning contro il simulatore fake_proxmox.py: job condivisi tra più
+processi tramite owner e lease, job ripreso con il clone già partito, clone fallito
+che lascia il container nel cluster.
+"""
+
+import time
+from datetime import timedelta
+
+
+def _running_job(user_id, name, **values):
+    from app import db
+    from models import ProvisioningJob, VMRequest
+
+    vm_request = VMRequest(user_id=user_id, vm_type='bronze', vm_name=name, status='provisioning')
+    db.session.add(vm_request)
+    db.session.commit()
+    job = ProvisioningJob(vm_request_id=vm_request.id, requested_by=user_id, status='running', **values)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+def _wait_unlocked(cluster, vmid, timeout=10):
+    deadline = time.time() + timeout
+    while cluster.containers[vmid].get('lock') and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def _wait_job(job_id, timeout=30):
+    from app import db
+    from models import ProvisioningJob
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        db.session.expire_all()
+        job = db.session.get(ProvisioningJob, job_id)
+        if job.status in ('completed', 'failed'):
+            return job
+        time.sleep(0.1)
+    return job
+
+
+def test_resume_takes_only_jobs_whose_lease_expired(user_id, monkeypatch):
+    from app import db, provisioning_queue
+    from background import process_owner
+    from models import ProvisioningJob, get_local_time
+
+    now = get_local_time()
+    live = _running_job(user_id, 'vivo', owner='altro-worker:1', lease_expires_at=now + timedelta(minutes=5))
+    orphan = _running_job(user_id, 'orfano', owner='altro-worker:2', lease_expires_at=now - timedelta(minutes=5))
+    submitted = []
+    monkeypatch.setattr(provisioning_queue, 'submit', submitted.append)
+
+    provisioning_queue.resume_pending()
+
+    assert submitted == [orphan]
+    db.session.expire_all()
+    assert db.session.get(ProvisioningJob, live).owner == 'altro-worker:1'
+    assert db.session.get(ProvisioningJob, live).status == 'running'
+    adopted = db.session.get(ProvisioningJob, orphan)
+    assert (adopted.owner, adopted.status) == (process_owner(), 'queued')
+
+    # Un secondo processo che riprende nello stesso momento non trova più nulla da prendere
+    monkeypatch.setattr('provisioning.process_owner', lambda: 'altro-worker:3')
+    provisioning_queue.resume_pending()
+    assert submitted == [orphan]
+
+    ProvisioningJob.query.filter(ProvisioningJob.id.in_([live, orphan])).update(
+        {'status': 'failed'}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def test_resumed_job_adopts_clone_started_before_crash(cluster, user_id):
+    from app import db, provisioning_queue, proxmox_api
+    from models import ProvisioningJob, VMIDReservation, VMRequest
+
+    vm_request = VMRequest(user_id=user_id, vm_type='bronze', vm_name='ripreso', status='provisioning')
+    db.session.add(vm_request)
+    db.session.commit()
+    job = ProvisioningJob(vm_request_id=vm_request.id, requested_by=user_id, status='running')
+    db.session.add(job)
+    db.session.commit()
+
+    # Il processo si è fermato dopo aver prenotato il VMID e avviato il clone
+    allocator = provisioning_queue.vmid_allocator
+    vmid = allocator.claim(vm_request.id)
+    assert allocator.claim(vm_request.id) == vmid
+    proxmox_api.api.nodes('pve1').lxc(3335).clone.post(newid=vmid, hostname='ripreso', full=1)
+    guests_before = {key for key, guest in cluster.containers.items() if not guest['template']}
+
+    assert provisioning_queue.resume_pending() == 1
+    _wait_job(job.id)
+
+    vm_request = db.session.get(VMRequest, vm_request.id)
+    assert vm_request.status == 'approved'
+    assert vm_request.vm_id == vmid
+    assert cluster.containers[vmid]['status'] == 'running'
+    # Nessun secondo clone: il container interrotto è stato adottato
+    assert {key for key, guest in cluster.containers.items() if not guest['template']} == guests_before
+    assert VMIDReservation.query.filter_by(vmid=vmid).one().status == 'in_use'
+
+
+def test_failed_clone_keeps_vmid_until_container_is_gone(cluster, user_id, monkeypatch):
+    from app import db, provisioning_queue, proxmox_api, reconciler
+    from models import VMIDReservation, VMRequest
+
+    vm_request = VMRequest(user_id=user_id, vm_type='bronze', vm_name='scaduto', status='pending')
+    db.session.add(vm_request)
+    db.session.commit()
+    request_id = vm_request.id
+    # Il task di clone supera la scadenza ma prosegue sul nodo
+    monkeypatch.setattr(proxmox_api, 'task_timeout', 0.3)
+    job = provisioning_queue.enqueue(vm_request, user_id)
+    assert _wait_job(job.id).status == 'failed'
+    monkeypatch.undo()
+
+    assert db.session.get(VMRequest, request_id).status == 'rejected'
+    reservation = VMIDReservation.query.filter_by(vm_request_id=request_id).one()
+    vmid = reservation.vmid
+    assert reservation.status == 'reserved'
+    assert vmid in cluster.containers
+
+    # Terminato il clone, il reconciler distrugge il container e solo allora libera il VMID
+    _wait_unlocked(cluster, vmid)
+    reconciler.run_once()
+    db.session.expire_all()
+    assert vmid not in cluster.containers
+    assert VMIDReservation.query.filter_by(vmid=vmid).count() == 0
@@ -0,0 +1,67 @@
+"""
+Strategia di clone contro il simulatore fake_proxmox.py: si ripiega sul clone completo
+solo se ProxMox rifiuta subito il linked clone, mai dopo l'avvio del task.
+"""
+
+import time
+
+import pytest
+
+from fake_proxmox import FakeProxmoxError
+
+
+def _record_clones(cluster, monkeypatch, reject_linked=None):
+    calls = []
+    clone = cluster._clone
+
+    def recording(node, source, params):
+        calls.append(int(params.get('full', 0)))
+        if reject_linked and not calls[-1]:
+            raise FakeProxmoxError(500, reject_linked)
+        return clone(node, source, params)
+    monkeypatch.setattr(cluster, '_clone', recording)
+    return calls
+
+
+def _destroy(cluster, proxmox_api, vmid):
+    deadline = time.time() + 10
+    while vmid in cluster.containers and cluster.containers[vmid].get('lock') and time.time() < deadline:
+        time.sleep(0.1)
+    assert proxmox_api.destroy_vm(None, vmid)['success']
+
+
+def test_full_clone_when_storage_has_no_linked_clone_feature(cluster, monkeypatch):
+    from app import proxmox_api
+
+    calls = _record_clones(cluster, monkeypatch,
+                           reject_linked="linked clone feature for 'local:3335/base.raw' is not available")
+    node, strategy = proxmox_api._clone_template('pve1', 3335, 'pve1', {'newid': 4101, 'hostname': 'pieno'},
+                                                 'linked', 'bronze')
+    assert (node, strategy) == ('pve1', 'full')
+    assert calls == [0, 1]
+    _destroy(cluster, proxmox_api, 4101)
+
+
+def test_other_clone_rejections_are_not_retried_as_full_clone(cluster, monkeypatch):
+    from app import proxmox_api
+    from proxmox_api import CloneRejectedError
+
+    calls = _record_clones(cluster, monkeypatch, reject_linked='storage local-zfs is offline')
+    with pytest.raises(CloneRejectedError):
+        proxmox_api._clone_template('pve1', 3335, 'pve1', {'newid': 4102, 'hostname': 'offline'}, 'linked', 'bronze')
+    assert calls == [0]
+    assert 4102 not in cluster.containers
+
+
+def test_linked_clone_failing_after_task_start_is_not_retried(cluster, monkeypatch):
+    from app import proxmox_api
+    from proxmox_api import ProxmoxTaskError
+
+    calls = _record_clones(cluster, monkeypatch)
+    # Il task è partito (il container esiste) e poi fallisce o scade
+    monkeypatch.setattr(proxmox_api, 'task_timeout', 0.3)
+    with pytest.raises(ProxmoxTaskError):
+        proxmox_api._clone_template('pve1', 3335, 'pve1', {'newid': 4103, 'hostname': 'scaduto'}, 'linked', 'bronze')
+    monkeypatch.undo()
+    assert calls == [0]
+    _destroy(cluster, proxmox_api, 4103)
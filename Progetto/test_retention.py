@@ -0,0 +1,72 @@
+"""
+Archiviazione delle richieste concluse: ripresa dopo un'interruzione tra la scrittura
+dell'archivio e la cancellazione delle righe, un solo processo alla volta sull'archivio.
+"""
+
+from datetime import datetime
+
+import pytest
+
+OLD = datetime(2000, 1, 1)
+
+
+def test_retention_resumes_after_crash_between_archive_and_delete(cluster, user_id, tmp_path, monkeypatch):
+    from app import db
+    from models import VMRequest
+    from retention import RetentionManager, RetentionRule, iter_archive
+
+    requests = [
+        VMRequest(user_id=user_id, vm_type='bronze', vm_name=f'dismessa-{i}', status='decommissioned',
+                  created_at=OLD, updated_at=OLD)
+        for i in range(5)
+    ]
+    db.session.add_all(requests)
+    db.session.commit()
+    ids = {vm_request.id for vm_request in requests}
+
+    path = str(tmp_path / 'vm_request.jsonl.gz')
+    rules = [RetentionRule('decommissioned', 30)]
+    manager = RetentionManager(rules, path, batch_size=3, pause=0)
+
+    def crash(batch_ids):
+        raise RuntimeError("processo interrotto")
+
+    # Il primo blocco finisce nell'archivio ma le righe non vengono cancellate
+    monkeypatch.setattr(manager, '_delete', crash)
+    with pytest.raises(RuntimeError):
+        manager.run()
+    monkeypatch.undo()
+    db.session.rollback()
+    assert VMRequest.query.filter(VMRequest.id.in_(ids)).count() == 5
+    # ...e il blocco successivo era stato scritto solo in parte
+    with open(path, 'ab') as handle:
+        handle.write(b'\x1f\x8b blocco troncato')
+
+    stats = RetentionManager(rules, path, batch_size=3, pause=0).run()
+
+    assert stats['archived'] == 5
+    assert VMRequest.query.filter(VMRequest.id.in_(ids)).count() == 0
+    archived = [record['vm_request']['id'] for record in iter_archive(path)]
+    assert sorted(archived) == sorted(ids)
+
+
+def test_retention_skips_run_while_another_process_holds_the_archive(cluster, user_id, tmp_path):
+    from app import db
+    from models import VMRequest
+    from retention import RetentionManager, RetentionRule
+
+    vm_request = VMRequest(user_id=user_id, vm_type='bronze', vm_name='conteso', status='rejected',
+                           created_at=OLD, updated_at=OLD)
+    db.session.add(vm_request)
+    db.session.commit()
+    path = str(tmp_path / 'vm_request.jsonl.gz')
+    rules = [RetentionRule('rejected', 30)]
+
+    holder = RetentionManager(rules, path, pause=0)
+    with holder.writer.lock() as acquired:
+        assert acquired
+        stats = RetentionManager(rules, path, pause=0).run()
+    assert stats == {'archived': 0, 'batches': 0, 'busy': True}
+    assert db.session.get(VMRequest, vm_request.id) is not None
+
+    assert RetentionManager(rules, path, pause=0).run()['archived'] == 1
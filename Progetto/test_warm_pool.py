@@ -0,0 +1,104 @@
+"""
+Warm pool contro il simulatore fake_proxmox.py: refill e claim dei container pronti,
+clone fallito o interrotto che tiene il VMID finché il container non è distrutto.
+"""
+
+import time
+from datetime import datetime
+
+OLD = datetime(2000, 1, 1)
+
+
+def _wait_unlocked(cluster, vmid, timeout=10):
+    deadline = time.time() + timeout
+    while cluster.containers[vmid].get('lock') and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def _pool(sizes):
+    from app import app, proxmox_api, provisioning_queue
+    from warm_pool import WarmPool
+
+    pool = WarmPool(app, proxmox_api, provisioning_queue.vmid_allocator)
+    pool.sizes = sizes
+    return pool
+
+
+def test_refill_then_claim_hands_each_container_to_one_request(cluster, user_id):
+    from app import db
+    from models import VMIDReservation, VMRequest, WarmContainer
+
+    pool = _pool({'bronze': 1})
+    pool.run_once()
+    warm = WarmContainer.query.filter_by(tier='bronze', status='ready').one()
+    assert cluster.containers[warm.vmid]['status'] == 'stopped'
+    assert VMIDReservation.query.filter_by(vmid=warm.vmid).one().status == 'in_use'
+    # Pool al livello configurato: nessun altro clone
+    pool.run_once()
+    assert WarmContainer.query.filter_by(tier='bronze').count() == 1
+
+    first, second = (VMRequest(user_id=user_id, vm_type='bronze', vm_name=name, status='provisioning')
+                     for name in ('primo', 'secondo'))
+    db.session.add_all([first, second])
+    db.session.commit()
+
+    claimed = pool.claim('bronze', first.id)
+    assert (claimed.vmid, claimed.status, claimed.vm_request_id) == (warm.vmid, 'claimed', first.id)
+    assert VMIDReservation.query.filter_by(vmid=warm.vmid).one().vm_request_id == first.id
+    # Un job ripreso ritrova lo stesso container, un'altra richiesta trova il pool vuoto
+    assert pool.claim('bronze', first.id).id == claimed.id
+    assert pool.claim('bronze', second.id) is None
+
+    # Job fallito dopo il claim: il reaper distrugge il container e libera il VMID
+    first.status = second.status = 'rejected'
+    db.session.commit()
+    pool._reap()
+    assert WarmContainer.query.filter_by(vmid=warm.vmid).count() == 0
+    assert VMIDReservation.query.filter_by(vmid=warm.vmid).count() == 0
+    assert warm.vmid not in cluster.containers
+
+
+def test_failed_refill_keeps_vmid_until_clone_is_destroyed(cluster, ctx, monkeypatch):
+    from app import proxmox_api
+    from models import VMIDReservation, WarmContainer
+
+    pool = _pool({'bronze': 1})
+    # Il task di clone supera la scadenza ma prosegue sul nodo
+    monkeypatch.setattr(proxmox_api, 'task_timeout', 0.3)
+    assert not pool._refill_one('bronze')
+    monkeypatch.undo()
+
+    warm = WarmContainer.query.filter_by(tier='bronze').one()
+    assert warm.status == 'cloning'
+    assert VMIDReservation.query.filter_by(vmid=warm.vmid).count() == 1
+    assert warm.vmid in cluster.containers
+
+    _wait_unlocked(cluster, warm.vmid)
+    vmid = warm.vmid
+    assert pool.discard(warm)
+    assert VMIDReservation.query.filter_by(vmid=vmid).count() == 0
+    assert vmid not in cluster.containers
+
+
+def test_reap_removes_stale_clone_only_once_it_can_be_destroyed(cluster, user_id):
+    from app import db, proxmox_api, provisioning_queue, warm_pool
+    from models import VMIDReservation, WarmContainer
+
+    vmid = provisioning_queue.vmid_allocator.claim()
+    proxmox_api.api.nodes('pve1').lxc(3335).clone.post(newid=vmid, hostname=f'warm-bronze-{vmid}', full=1)
+    # Riga di un refill interrotto: ancora 'cloning' e senza nodo
+    warm = WarmContainer(tier='bronze', template='3335', vmid=vmid, status='cloning', created_at=OLD)
+    db.session.add(warm)
+    db.session.commit()
+
+    # Clone ancora in corso: il container non si può distruggere e il VMID resta prenotato
+    warm_pool._reap()
+    assert WarmContainer.query.filter_by(vmid=vmid).count() == 1
+    assert VMIDReservation.query.filter_by(vmid=vmid).count() == 1
+    assert vmid in cluster.containers
+
+    _wait_unlocked(cluster, vmid)
+    warm_pool._reap()
+    assert WarmContainer.query.filter_by(vmid=vmid).count() == 0
+    assert VMIDReservation.query.filter_by(vmid=vmid).count() == 0
+    assert vmid not in cluster.containers
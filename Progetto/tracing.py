@@ -0,0 +1,198 @@
+"""
+Tracciamento a span del percorso di provisioning. Ogni richiesta HTTP (o job,
+o ciclo di un servizio in background) ha un trace_id di correlazione; gli span
+annidati vengono scritti come log JSON con la durata e segnalati come lenti
+oltre la soglia configurata.
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger('tracing')
+
+# Soglie (millisecondi) oltre le quali uno span è segnalato come lento:
+# 'call' per le singole chiamate, 'task' per le operazioni lunghe (clone, job)
+SLOW_THRESHOLDS = {
+    'call': 1000,
+    'task': 120000
+}
+
+_TRACE_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]{8,64}$')
+
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_timings = contextvars.ContextVar('trace_timings', default=None)
+
+
+def configure(slow_ms=None, slow_task_ms=None):
+    if slow_ms is not None:
+        SLOW_THRESHOLDS['call'] = slow_ms
+    if slow_task_ms is not None:
+        SLOW_THRESHOLDS['task'] = slow_task_ms
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def valid_trace_id(value):
+    return bool(value) and bool(_TRACE_ID_PATTERN.match(value))
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+class Span:
+    def __init__(self, name, kind, attrs):
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.trace_id = _trace_id.get()
+        self.span_id = uuid.uuid4().hex[:16]
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent else None
+        self.duration_ms = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+@contextmanager
+def trace(trace_id=None, collect_timings=False):
+    """
+    Apre un contesto di tracciamento con il trace_id indicato (o uno nuovo).
+    Con collect_timings le durate degli span vengono sommate per nome, per Server-Timing.
+    """
+    tokens = [
+        (_trace_id, _trace_id.set(trace_id if valid_trace_id(trace_id) else new_trace_id())),
+        (_current_span, _current_span.set(None)),
+        (_timings, _timings.set({} if collect_timings else None))
+    ]
+    try:
+        yield _trace_id.get()
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def timings():
+    """Durate (ms) e numero di span per nome raccolte nel contesto corrente"""
+    return _timings.get() or {}
+
+
+@contextmanager
+def span(name, kind='call', **attrs):
+    current = Span(name, kind, attrs)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration_ms = (time.perf_counter() - start) * 1000
+        _finish(current, error)
+
+
+def traced(name=None, kind='call', attrs=()):
+    """
+    Decoratore che esegue la funzione in uno span. attrs elenca i parametri
+    della funzione da riportare come attributi dello span.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            span_attrs = {}
+            if attrs:
+                bound = signature.bind_partial(*args, **kwargs)
+                span_attrs = {key: bound.arguments[key] for key in attrs if key in bound.arguments}
+            with span(span_name, kind=kind, **span_attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _finish(current, error):
+    collected = _timings.get()
+    if collected is not None:
+        total, count = collected.get(current.name, (0.0, 0))
+        collected[current.name] = (total + current.duration_ms, count + 1)
+
+    threshold = SLOW_THRESHOLDS.get(current.kind, SLOW_THRESHOLDS['call'])
+    slow = current.duration_ms >= threshold
+    record = {
+        'span': current.name,
+        'trace_id': current.trace_id,
+        'span_id': current.span_id,
+        'parent_id': current.parent_id,
+        'duration_ms': round(current.duration_ms, 2),
+        'status': 'error' if error else 'ok',
+        'slow': slow
+    }
+    if error is not None:
+        record['error'] = f"{type(error).__name__}: {error}"
+    if current.attrs:
+        record['attrs'] = current.attrs
+
+    level = logging.WARNING if slow or error else logging.INFO
+    if logger.isEnabledFor(level):
+        logger.log(level, 'span %s %.1f ms', current.name, current.duration_ms, extra={'span_record': record})
+
+
+class JSONFormatter(logging.Formatter):
+    """Una riga JSON per record, con il trace_id corrente per correlare anche i log ordinari"""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name
+        }
+        span_record = getattr(record, 'span_record', None)
+        if span_record:
+            data.update(span_record)
+        else:
+            data['message'] = record.getMessage()
+            if _trace_id.get():
+                data['trace_id'] = _trace_id.get()
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def configure_logging(level='INFO', json_format=True):
+    handler = logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+
+def server_timing_header(total_ms=None, limit=10):
+    """Valore dell'header Server-Timing con le durate per nome di span, dalle più lunghe"""
+    entries = sorted(timings().items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    parts = []
+    if total_ms is not None:
+        parts.append(f'total;dur={total_ms:.1f}')
+    for name, (duration, count) in entries:
+        metric = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        parts.append(f'{metric};dur={duration:.1f};desc="{count}x"')
+    return ', '.join(parts)
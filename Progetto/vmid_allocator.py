@@ -0,0 +1,99 @@
+"""
+Allocazione dei VMID tramite un registro di prenotazioni nel database.
+Ogni VMID viene prenotato con un INSERT sulla chiave primaria, quindi due
+processi o thread non possono ottenere lo stesso ID; i candidati vengono
+presi a blocchi dal range configurato, scartando quelli già presenti nel cluster.
+"""
+
+import logging
+import threading
+from collections import deque
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, VMIDReservation, get_local_time
+from tracing import traced
+
+logger = logging.getLogger(__name__)
+
+
+class VMIDExhaustedError(Exception):
+    """Nessun VMID libero nel range configurato"""
+
+
+class VMIDAllocator:
+    def __init__(self, proxmox_api, start=1000, end=9999, block_size=20):
+        self.proxmox_api = proxmox_api
+        self.start = start
+        self.end = end
+        self.block_size = block_size
+        self._cursor = start
+        self._block = deque()
+        self._lock = threading.Lock()
+
+    def _cluster_vmids(self):
+        try:
+            resources = self.proxmox_api.get_cluster_resources('vm')
+        except Exception as e:
+            logger.warning("Errore nel recupero dei VMID del cluster: %s", e)
+            return set()
+        return {int(res['vmid']) for res in resources if res.get('vmid') is not None}
+
+    def _lease_block(self):
+        """Riserva in memoria il prossimo blocco di candidati liberi sia nel registro sia nel cluster"""
+        used = self._cluster_vmids()
+        reserved = {
+            row.vmid for row in db.session.query(VMIDReservation.vmid)
+            .filter(VMIDReservation.vmid.between(self.start, self.end))
+        }
+
+        scanned = 0
+        size = self.end - self.start + 1
+        while len(self._block) < self.block_size and scanned < size:
+            vmid = self._cursor
+            self._cursor = self.start if vmid >= self.end else vmid + 1
+            scanned += 1
+            if vmid not in used and vmid not in reserved:
+                self._block.append(vmid)
+
+    def reserved_for(self, vm_request_id):
+        """VMID prenotato e non ancora in uso per la richiesta (job interrotto da un riavvio), oppure None"""
+        existing = VMIDReservation.query.filter_by(vm_request_id=vm_request_id, status='reserved').first()
+        return existing.vmid if existing else None
+
+    @traced('VMIDAllocator.claim', attrs=('vm_request_id',))
+    def claim(self, vm_request_id=None):
+        """
+        Prenota un VMID per la richiesta e lo restituisce. Una richiesta ha al più una
+        prenotazione aperta: un job ripreso dopo un riavvio ritrova la propria, anche se
+        il clone era già partito (il chiamante decide se adottare o distruggere il container).
+        """
+        with self._lock:
+            if vm_request_id is not None:
+                existing = self.reserved_for(vm_request_id)
+                if existing is not None:
+                    return existing
+
+            for _ in range(2):
+                if not self._block:
+                    self._lease_block()
+                while self._block:
+                    vmid = self._block.popleft()
+                    db.session.add(VMIDReservation(vmid=vmid, vm_request_id=vm_request_id))
+                    try:
+                        db.session.commit()
+                        return vmid
+                    except IntegrityError:
+                        # Prenotato nel frattempo da un altro processo
+                        db.session.rollback()
+
+            raise VMIDExhaustedError(f"Nessun VMID libero tra {self.start} e {self.end}")
+
+    def mark_in_use(self, vmid):
+        VMIDReservation.query.filter_by(vmid=vmid).update(
+            {'status': 'in_use', 'updated_at': get_local_time()}, synchronize_session=False
+        )
+
+    def release(self, vmid):
+        """Libera il VMID (clone fallito o container distrutto)"""
+        VMIDReservation.query.filter_by(vmid=vmid).delete(synchronize_session=False)
@@ -0,0 +1,204 @@
+"""
+Warm pool: per ogni tier vengono tenuti pronti alcuni container già clonati
+dal template e fermi. All'approvazione il worker ne prende uno (claim
+atomico sul database), imposta l'hostname e lo avvia, senza attendere il clone
+completo; il servizio in background clona nuovi container man mano che il
+pool si svuota.
+"""
+
+import logging
+from datetime import timedelta
+
+from background import PeriodicService
+from metrics import WARM_POOL_CLAIMS, WARM_POOL_REFILLS
+from models import db, VMIDReservation, VMRequest, WarmContainer, get_local_time
+
+logger = logging.getLogger(__name__)
+
+
+def parse_pool_sizes(spec):
+    """'bronze:3,silver:1' -> {'bronze': 3, 'silver': 1}"""
+    sizes = {}
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        tier, _, size = item.partition(':')
+        if not size.strip().isdigit():
+            raise ValueError(f"Dimensione del warm pool non valida: {item!r} (formato tier:numero)")
+        sizes[tier.strip()] = int(size)
+    return sizes
+
+
+class WarmPool(PeriodicService):
+    name = 'warm-pool'
+    exclusive = True
+
+    def __init__(self, app=None, proxmox_api=None, vmid_allocator=None, interval=30):
+        self.proxmox_api = proxmox_api
+        self.vmid_allocator = vmid_allocator
+        self.sizes = {}
+        self.templates = {}
+        super().__init__(app, interval=interval)
+
+    def init_app(self, app, proxmox_api=None, vmid_allocator=None):
+        super().init_app(app)
+        if proxmox_api is not None:
+            self.proxmox_api = proxmox_api
+        if vmid_allocator is not None:
+            self.vmid_allocator = vmid_allocator
+        self.interval = app.config.get('WARM_POOL_INTERVAL', self.interval)
+        self.templates = {tier: str(template) for tier, template in app.config['VM_TEMPLATES'].items()}
+        self.sizes = {}
+        for tier, size in parse_pool_sizes(app.config.get('WARM_POOL_SIZES')).items():
+            if tier not in self.templates:
+                logger.warning("Tier %r del warm pool senza template in VM_TEMPLATES: ignorato", tier)
+            elif size > 0:
+                self.sizes[tier] = size
+
+    @property
+    def enabled(self):
+        return bool(self.sizes)
+
+    def start(self):
+        if self.enabled:
+            super().start()
+
+    def claim(self, tier, vm_request_id):
+        """
+        Assegna alla richiesta un container pronto del tier, oppure None se il pool è vuoto.
+        Un job ripreso dopo un riavvio ritrova il container che aveva già preso.
+        """
+        if not self.sizes.get(tier):
+            return None
+
+        existing = WarmContainer.query.filter_by(vm_request_id=vm_request_id, status='claimed').first()
+        if existing:
+            return existing
+
+        for _ in range(3):
+            candidate = (
+                db.session.query(WarmContainer.id)
+                .filter_by(tier=tier, template=self.templates.get(tier), status='ready')
+                .order_by(WarmContainer.created_at)
+                .first()
+            )
+            if candidate is None:
+                break
+            claimed = WarmContainer.query.filter_by(id=candidate.id, status='ready').update(
+                {'status': 'claimed', 'vm_request_id': vm_request_id, 'claimed_at': get_local_time()},
+                synchronize_session=False
+            )
+            if claimed:
+                warm = db.session.get(WarmContainer, candidate.id)
+                VMIDReservation.query.filter_by(vmid=warm.vmid).update(
+                    {'vm_request_id': vm_request_id}, synchronize_session=False
+                )
+                db.session.commit()
+                WARM_POOL_CLAIMS.inc(tier=tier, result='hit')
+                self.wake()
+                return warm
+            # Preso nel frattempo da un altro worker
+            db.session.rollback()
+
+        WARM_POOL_CLAIMS.inc(tier=tier, result='miss')
+        self.wake()
+        return None
+
+    def discard(self, warm):
+        """
+        Elimina un container del pool non utilizzabile: distrugge il guest e libera il VMID.
+        Un clone interrotto non ha ancora il nodo: il guest viene cercato nel cluster. Se la
+        distruzione non riesce (ad esempio clone ancora in corso) la riga resta e il VMID
+        prenotato, il reaper ritenta al ciclo successivo. Restituisce True se eliminato.
+        """
+        result = self.proxmox_api.destroy_vm(warm.node, warm.vmid)
+        if not result['success']:
+            logger.warning("Container %s del warm pool non distrutto, nuovo tentativo più tardi: %s",
+                           warm.vmid, result.get('error'))
+            db.session.rollback()
+            return False
+        self.vmid_allocator.release(warm.vmid)
+        db.session.delete(warm)
+        db.session.commit()
+        return True
+
+    def _reap(self):
+        """
+        Scarta i clone interrotti da un riavvio, i container di template non più configurati
+        e quelli presi da richieste che non sono più in creazione (job fallito dopo il claim)
+        """
+        orphans = (
+            WarmContainer.query.join(VMRequest, WarmContainer.vm_request_id == VMRequest.id)
+            .filter(WarmContainer.status == 'claimed', VMRequest.status != 'provisioning')
+            .all()
+        )
+        for warm in orphans:
+            logger.info("Rimozione del container %s preso dalla richiesta %s non più in creazione", warm.vmid, warm.vm_request_id)
+            self.discard(warm)
+
+        # Confronto fatto dal database: le date lette da SQLite non hanno fuso orario
+        stale_before = get_local_time() - timedelta(seconds=self.proxmox_api.task_timeout + 60)
+        stale = (
+            WarmContainer.query
+            .filter(WarmContainer.status == 'cloning', WarmContainer.created_at < stale_before)
+            .all()
+        )
+        for warm in stale:
+            logger.info("Rimozione del clone interrotto %s dal warm pool", warm.vmid)
+            self.discard(warm)
+
+        for warm in WarmContainer.query.filter_by(status='ready').all():
+            if warm.template != self.templates.get(warm.tier) or warm.tier not in self.sizes:
+                logger.info("Rimozione del container %s dal warm pool (%s)", warm.vmid, warm.status)
+                self.discard(warm)
+
+    def _refill_one(self, tier):
+        template = self.templates[tier]
+        vmid = self.vmid_allocator.claim()
+        warm = WarmContainer(tier=tier, template=template, vmid=vmid)
+        db.session.add(warm)
+        db.session.commit()
+
+        result = self.proxmox_api.clone_stopped(tier, template, vmid, hostname=f'warm-{tier}-{vmid}')
+        if not result['success']:
+            WARM_POOL_REFILLS.inc(tier=tier, outcome='error')
+            # Il clone può essere partito (scadenza, task fallito a metà): il VMID si libera solo
+            # se il container non esiste o è stato distrutto, altrimenti la riga resta 'cloning'
+            # e la rimuove il reaper
+            self.discard(warm)
+            return False
+
+        self.vmid_allocator.mark_in_use(vmid)
+        warm.node = result['node']
+        warm.clone_strategy = result.get('clone_strategy')
+        warm.status = 'ready'
+        db.session.commit()
+        WARM_POOL_REFILLS.inc(tier=tier, outcome='ok')
+        return True
+
+    def levels(self):
+        """Container pronti e in preparazione per tier"""
+        rows = (
+            db.session.query(WarmContainer.tier, WarmContainer.status, db.func.count(WarmContainer.id))
+            .filter(WarmContainer.status.in_(['cloning', 'ready']))
+            .group_by(WarmContainer.tier, WarmContainer.status)
+        )
+        levels = {tier: {'ready': 0, 'cloning': 0} for tier in self.sizes}
+        for tier, status, count in rows:
+            levels.setdefault(tier, {'ready': 0, 'cloning': 0})[status] = count
+        return levels
+
+    def run_once(self):
+        self._reap()
+        # Un clone alla volta, un tier dopo l'altro: il refill occupa al massimo uno slot del nodo del template
+        while not self._stop.is_set():
+            levels = self.levels()
+            deficits = [tier for tier, size in self.sizes.items()
+                        if levels[tier]['ready'] + levels[tier]['cloning'] < size]
+            if not deficits:
+                return
+            # Prima il tier più scoperto in proporzione alla dimensione configurata
+            tier = min(deficits, key=lambda t: (levels[t]['ready'] + levels[t]['cloning']) / self.sizes[t])
+            if not self._refill_one(tier):
+                return